@@ -0,0 +1,358 @@
+# This file is part of python-diffrevision
+# Copyright (C) 2011 Francois Savard 
+#
+# python-diffrevision is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-diffrevision is distributed in the hope that
+# it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-diffrevision (see license.txt)
+# If not, see <http://www.gnu.org/licenses/>.
+
+# Crash-safe writes of the payload files (revision directories, blobs,
+# packs) for Storage.
+#
+# A file is never written in place: the data goes to a temporary file next
+# to it, which is renamed over it once its data is on disk, so a crash
+# leaves either the old file or the new one, never half of the new one.
+#
+# Inside a transaction, writes (and removals) are staged: the temporary
+# files are written right away, but only synced and renamed when the
+# transaction commits, just before the db commit (flush), so the db never
+# refers to files which aren't on disk yet. All files of the transaction are
+# synced in one go (e.g. all the revisions created by a 'diff' scan), then
+# their directories, once each, which costs much less than syncing each file
+# as it's written. A file replaced is first moved aside under a backup name,
+# and removals wait for the db commit to succeed (apply_removals, which also
+# deletes the backups), so the db never refers to files already removed
+# either. A rollback deletes the temporary files, and if the files were
+# already put in place (the db commit failed), the new ones too, putting the
+# backups back: payloads are then as the db says they are. Only data appended
+# (see append) stays, unused.
+# Outside a transaction, each write is synced and renamed right away.
+#
+# Staged files are visible to exists/read of the same thread, like the rest
+# of the transaction.
+#
+# With durable_writes = False in the config, files are still renamed into
+# place, but never synced (faster on slow disks, at the risk of losing the
+# last changes on a crash).
+
+import os, sys
+import threading
+
+if __name__ == '__main__':
+    # otw when running tests we can't import other modules
+    this_files_path = os.path.split(os.path.abspath(__file__))[0]
+    sys.path.append(os.path.join(this_files_path,".."))
+
+TEMP_SUFFIX = ".tmp"
+BACKUP_SUFFIX = ".bak"
+
+def get_temp_path(path):
+    return "%s.%d%s" % (path, os.getpid(), TEMP_SUFFIX)
+
+def get_backup_path(path):
+    return "%s.%d%s" % (path, os.getpid(), BACKUP_SUFFIX)
+
+def sync_file(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# directories need a sync of their own for renames and new entries to last
+sync_directory = sync_file
+
+def remove_file_and_empty_directory(path):
+    if not os.path.exists(path):
+        return
+    os.remove(path)
+    dir_path = os.path.dirname(path)
+    if not os.listdir(dir_path):
+        os.rmdir(dir_path)
+
+class AtomicFiles(object):
+    def __init__(self, durable=True):
+        self.durable = durable
+
+        # per thread, like transactions
+        self.local = threading.local()
+
+    # pending changes of the calling thread's transaction: final path ->
+    # temporary path, or None for a removal
+    def get_pending(self):
+        pending = getattr(self.local, 'pending', None)
+        if pending is None:
+            pending = self.local.pending = {}
+            # files appended to, synced on commit
+            self.local.appended = set()
+            # directories with new entries, synced on commit
+            self.local.directories = set()
+            # files put in place by flush: final path -> backup of the file
+            # replaced, or None if there was none
+            self.local.replaced = {}
+        return pending
+
+    # creates path's directory (and its parents) if needed, returns the
+    # directories to sync for the new entries to last
+    def make_directories(self, dir_path):
+        to_sync = [dir_path]
+        missing = []
+        while not os.path.isdir(dir_path):
+            missing.append(dir_path)
+            dir_path = os.path.dirname(dir_path)
+            to_sync.append(dir_path)
+        if missing:
+            os.makedirs(missing[0])
+        return to_sync
+
+    def write(self, path, data, staged=False):
+        directories = self.make_directories(os.path.dirname(path))
+
+        temp_path = get_temp_path(path)
+        f = open(temp_path, "wb")
+        try:
+            f.write(data)
+            if self.durable and not staged:
+                f.flush()
+                os.fsync(f.fileno())
+        finally:
+            f.close()
+
+        if staged:
+            self.get_pending()[path] = temp_path
+            self.local.directories.update(directories)
+            return
+
+        os.rename(temp_path, path)
+        if self.durable:
+            for dir_path in directories:
+                sync_directory(dir_path)
+
+    # Appends to a file (see PackStore), returns the offset the data was
+    # written at. Appends aren't renamed, their file is only synced.
+    def append(self, path, data, staged=False):
+        directories = self.make_directories(os.path.dirname(path))
+
+        f = open(path, "ab")
+        try:
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            f.write(data)
+            if self.durable and not staged:
+                f.flush()
+                os.fsync(f.fileno())
+        finally:
+            f.close()
+
+        if staged:
+            self.get_pending()
+            self.local.appended.add(path)
+            self.local.directories.update(directories)
+        elif self.durable:
+            for dir_path in directories:
+                sync_directory(dir_path)
+
+        return offset
+
+    # The directory of the file is removed too if it's left empty (so
+    # payloads moving to the db don't leave empty revision directories
+    # behind).
+    def remove(self, path, staged=False):
+        pending = self.get_pending()
+        temp_path = pending.pop(path, None)
+        if temp_path is not None and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+        if staged:
+            if os.path.exists(path):
+                pending[path] = None
+            return
+
+        remove_file_and_empty_directory(path)
+
+    def exists(self, path):
+        pending = self.get_pending()
+        if path in pending:
+            return pending[path] is not None
+        return os.path.exists(path)
+
+    def read(self, path):
+        f = open(self.get_pending().get(path) or path, "rb")
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    # before the db commit: the writes put in place, the files they replace
+    # moved to their backup, the removals left pending
+    def flush(self):
+        pending = self.get_pending()
+        written = [(path, temp_path) for path, temp_path \
+                        in pending.iteritems() if temp_path is not None]
+        if not written and not self.local.appended:
+            return
+
+        if self.durable:
+            for path, temp_path in written:
+                sync_file(temp_path)
+            for path in self.local.appended:
+                if os.path.exists(path):
+                    sync_file(path)
+
+        directories = self.local.directories
+        replaced = self.local.replaced
+        for path, temp_path in written:
+            if os.path.exists(path):
+                replaced[path] = get_backup_path(path)
+                os.rename(path, replaced[path])
+            else:
+                replaced[path] = None
+            os.rename(temp_path, path)
+            directories.add(os.path.dirname(path))
+            del pending[path]
+
+        if self.durable:
+            for dir_path in directories:
+                if os.path.isdir(dir_path):
+                    sync_directory(dir_path)
+
+        self.local.appended.clear()
+        directories.clear()
+
+    # after the db commit: the removals, and the backups, which nothing
+    # refers to anymore
+    def apply_removals(self):
+        pending = self.get_pending()
+
+        directories = set()
+        for path, temp_path in pending.iteritems():
+            assert temp_path is None
+            remove_file_and_empty_directory(path)
+            directories.add(os.path.dirname(path))
+
+        for backup_path in self.local.replaced.itervalues():
+            if backup_path is not None and os.path.exists(backup_path):
+                os.remove(backup_path)
+                directories.add(os.path.dirname(backup_path))
+
+        if self.durable:
+            for dir_path in directories:
+                if os.path.isdir(dir_path):
+                    sync_directory(dir_path)
+
+        pending.clear()
+        self.local.replaced.clear()
+
+    # on rollback, before or after flush (the db commit failed)
+    def discard(self):
+        pending = self.get_pending()
+        for temp_path in pending.itervalues():
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        for path, backup_path in self.local.replaced.iteritems():
+            if backup_path is not None:
+                os.rename(backup_path, path)
+            else:
+                remove_file_and_empty_directory(path)
+
+        pending.clear()
+        self.local.replaced.clear()
+        self.local.appended.clear()
+        self.local.directories.clear()
+
+###################
+# tests
+
+def test_staged_writes_renamed_and_synced_on_commit():
+    import tempfile, shutil
+
+    tmpdir = tempfile.mkdtemp()
+    files = AtomicFiles()
+
+    synced = []
+    global sync_file, sync_directory
+    real_sync_file = sync_file
+    def counting_sync(path):
+        synced.append(path)
+        real_sync_file(path)
+    sync_file = sync_directory = counting_sync
+
+    try:
+        old_path = os.path.join(tmpdir, "old.txt")
+        files.write(old_path, "old")
+        assert open(old_path).read() == "old"
+        del synced[:]
+
+        paths = [os.path.join(tmpdir, "doc", "rev%d" % i, "content.txt") \
+                    for i in range(3)]
+        for i, path in enumerate(paths):
+            files.write(path, "content %d" % i, staged=True)
+        files.remove(old_path, staged=True)
+
+        # not in place before the commit, but visible to reads
+        assert not os.path.exists(paths[0])
+        assert files.exists(paths[0]) and files.read(paths[0]) == "content 0"
+        assert os.path.exists(old_path) and not files.exists(old_path)
+        assert synced == []
+
+        files.flush()
+        assert [open(p).read() for p in paths] == \
+                    ["content %d" % i for i in range(3)]
+        assert [name for name in os.listdir(os.path.dirname(paths[0]))] \
+                    == ["content.txt"]
+        # each file once, then each directory once
+        assert sorted(synced[:3]) == sorted([get_temp_path(p) for p in paths])
+        assert len(synced) == len(set(synced))
+
+        # removed once the db is committed
+        assert os.path.exists(old_path) and not files.exists(old_path)
+        del synced[:]
+        files.apply_removals()
+        assert not os.path.exists(old_path)
+        assert synced == [tmpdir]
+
+        # nothing left of a rolled back transaction
+        files.write(paths[0], "rolled back", staged=True)
+        files.discard()
+        assert open(paths[0]).read() == "content 0"
+        assert os.listdir(os.path.dirname(paths[0])) == ["content.txt"]
+
+        # nor of one whose db commit failed after the flush
+        files.write(paths[0], "replaced", staged=True)
+        files.write(paths[1], "replaced", staged=True)
+        files.write(paths[1], "replaced twice", staged=True)
+        new_path = os.path.join(tmpdir, "doc", "rev9", "content.txt")
+        files.write(new_path, "new", staged=True)
+        files.flush()
+        assert open(paths[0]).read() == "replaced"
+        files.discard()
+        assert [open(p).read() for p in paths] == \
+                    ["content %d" % i for i in range(3)]
+        assert not os.path.exists(os.path.dirname(new_path))
+        assert os.listdir(os.path.dirname(paths[0])) == ["content.txt"]
+
+        # and the backups go once it succeeded
+        files.write(paths[0], "replaced", staged=True)
+        files.flush()
+        files.apply_removals()
+        assert open(paths[0]).read() == "replaced"
+        assert os.listdir(os.path.dirname(paths[0])) == ["content.txt"]
+    finally:
+        sync_file = real_sync_file
+        sync_directory = real_sync_file
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    test_staged_writes_renamed_and_synced_on_commit()
@@ -0,0 +1,204 @@
+# This file is part of python-diffrevision
+# Copyright (C) 2011 Francois Savard 
+#
+# python-diffrevision is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-diffrevision is distributed in the hope that
+# it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-diffrevision (see license.txt)
+# If not, see <http://www.gnu.org/licenses/>.
+
+# Content-addressed store for revision payloads (content, changelist...).
+#
+# Each distinct payload is written once, in blobs/<2 first hex chars>/<hash>,
+# whatever the number of revisions having the same bytes (e.g. when a note is
+# reverted, or synced back and forth between two machines).
+# The 'blob_refs' table maps (revision id, payload filename) to a hash, and
+# the 'blobs' table keeps a reference count for each hash, so a blob file is
+# deleted when the last revision referencing it goes away.
+#
+# Nothing is committed here: the caller (Revision, usually) commits once the
+# revision row and its payloads are all written.
+
+import os, sys
+import hashlib
+
+if __name__ == '__main__':
+    # otw when running tests we can't import other modules
+    this_files_path = os.path.split(os.path.abspath(__file__))[0]
+    sys.path.append(os.path.join(this_files_path,".."))
+
+BLOBS_DIRNAME = 'blobs'
+
+BLOBS_TABLE_NAME = 'blobs'
+BLOB_REFS_TABLE_NAME = 'blob_refs'
+
+CREATE_BLOBS_TABLE_STATEMENT = \
+    "create table if not exists "+BLOBS_TABLE_NAME+"("+\
+                            "hash varchar(40) PRIMARY KEY,"+\
+                            "refcount integer not null,"+\
+                            "size integer not null)"
+CREATE_BLOB_REFS_TABLE_STATEMENT = \
+    "create table if not exists "+BLOB_REFS_TABLE_NAME+"("+\
+                            "revision_id integer not null,"+\
+                            "filename varchar(64) not null,"+\
+                            "hash varchar(40) not null,"+\
+                            "PRIMARY KEY (revision_id, filename))"
+
+def hash_data(data):
+    return hashlib.sha1(data).hexdigest()
+
+class BlobStore(object):
+    def __init__(self, storage):
+        self.storage = storage
+
+        self.blobs_abspath = \
+            os.path.join(storage.config.diffrevision_base_directory,
+                            BLOBS_DIRNAME)
+
+    def create_tables(self):
+        self.storage.db_cursor.execute(CREATE_BLOBS_TABLE_STATEMENT)
+        self.storage.db_cursor.execute(CREATE_BLOB_REFS_TABLE_STATEMENT)
+
+    def get_blob_path(self, hash):
+        return os.path.join(self.blobs_abspath, hash[:2], hash)
+
+    # hash of the payload 'filename' of a revision, or None if that payload
+    # isn't in the blob store
+    def get_hash(self, revision_id, filename):
+        self.storage.db_cursor.execute("SELECT hash"+\
+                                " FROM "+BLOB_REFS_TABLE_NAME+\
+                                " WHERE revision_id=? AND filename=?;",
+                                (revision_id, filename))
+        row = self.storage.db_cursor.fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def contains(self, revision_id, filename):
+        return self.get_hash(revision_id, filename) is not None
+
+    def read_blob(self, hash):
+        return self.storage.read_payload_file(self.get_blob_path(hash))
+
+    def read(self, revision_id, filename):
+        hash = self.get_hash(revision_id, filename)
+        if hash is None:
+            return None
+        return self.read_blob(hash)
+
+    def write(self, revision_id, filename, data):
+        hash = hash_data(data)
+
+        old_hash = self.get_hash(revision_id, filename)
+        if old_hash == hash:
+            return hash
+
+        self.incref(hash, data)
+
+        if old_hash is None:
+            self.storage.db_cursor.execute(\
+                'INSERT INTO '+BLOB_REFS_TABLE_NAME+\
+                ' (revision_id, filename, hash) VALUES (?, ?, ?)',
+                    (revision_id, filename, hash))
+        else:
+            self.storage.db_cursor.execute(\
+                'UPDATE '+BLOB_REFS_TABLE_NAME+' SET hash=?'+\
+                ' WHERE revision_id=? AND filename=?',
+                    (hash, revision_id, filename))
+            self.decref(old_hash)
+
+        return hash
+
+    def remove(self, revision_id, filename):
+        hash = self.get_hash(revision_id, filename)
+        if hash is None:
+            return
+
+        self.storage.db_cursor.execute(\
+                'DELETE FROM '+BLOB_REFS_TABLE_NAME+\
+                ' WHERE revision_id=? AND filename=?',
+                    (revision_id, filename))
+        self.decref(hash)
+
+    def incref(self, hash, data):
+        self.storage.db_cursor.execute(\
+                'UPDATE '+BLOBS_TABLE_NAME+' SET refcount=refcount+1'+\
+                ' WHERE hash=?', (hash,))
+
+        if self.storage.db_cursor.rowcount > 0:
+            return
+
+        # first reference to this content: write the blob
+        self.storage.write_payload_file(self.get_blob_path(hash), data)
+
+        self.storage.db_cursor.execute(\
+                'INSERT INTO '+BLOBS_TABLE_NAME+\
+                ' (hash, refcount, size) VALUES (?, 1, ?)',
+                    (hash, len(data)))
+
+    def decref(self, hash):
+        self.storage.db_cursor.execute(\
+                'UPDATE '+BLOBS_TABLE_NAME+' SET refcount=refcount-1'+\
+                ' WHERE hash=?', (hash,))
+
+        self.storage.db_cursor.execute(\
+                'SELECT refcount FROM '+BLOBS_TABLE_NAME+' WHERE hash=?',
+                    (hash,))
+        row = self.storage.db_cursor.fetchone()
+
+        if row is not None and row[0] <= 0:
+            self.storage.db_cursor.execute(\
+                'DELETE FROM '+BLOBS_TABLE_NAME+' WHERE hash=?', (hash,))
+
+            self.storage.remove_payload_file(self.get_blob_path(hash))
+
+    def get_refcount(self, hash):
+        self.storage.db_cursor.execute(\
+                'SELECT refcount FROM '+BLOBS_TABLE_NAME+' WHERE hash=?',
+                    (hash,))
+        row = self.storage.db_cursor.fetchone()
+        if row is None:
+            return 0
+        return row[0]
+
+###################
+# tests
+
+def test_blob_store_refcounts():
+    from core.storage import setup_temp_db, teardown_temp_db
+
+    storage = setup_temp_db()
+    blobs = storage.blob_store
+
+    h1 = blobs.write(1, "content.txt", "same bytes")
+    h2 = blobs.write(2, "content.txt", "same bytes")
+
+    assert h1 == h2
+    assert blobs.get_refcount(h1) == 2
+    assert blobs.read(2, "content.txt") == "same bytes"
+    assert len(os.listdir(os.path.dirname(blobs.get_blob_path(h1)))) == 1
+
+    # rewriting a payload drops the reference to the old bytes
+    h3 = blobs.write(2, "content.txt", "other bytes")
+    assert blobs.get_refcount(h1) == 1
+    assert blobs.get_refcount(h3) == 1
+
+    blobs.remove(1, "content.txt")
+    assert blobs.get_refcount(h1) == 0
+    assert not os.path.exists(blobs.get_blob_path(h1))
+    assert blobs.read(1, "content.txt") is None
+
+    teardown_temp_db(storage)
+
+if __name__ == '__main__':
+    test_blob_store_refcounts()
@@ -0,0 +1,370 @@
+# This file is part of python-diffrevision
+# Copyright (C) 2011 Francois Savard 
+#
+# python-diffrevision is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-diffrevision is distributed in the hope that
+# it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-diffrevision (see license.txt)
+# If not, see <http://www.gnu.org/licenses/>.
+
+# Garbage collection of the store, for the 'compact' command.
+#
+# Hidden revisions, and "retired" ones (scheduled further than
+# compact_retired_after_days in the future, e.g. after the last 99999 days
+# interval of FixedScheduler), will never be reviewed again. Depending on the
+# 'compact_policy' option, they are either deleted, or first copied to
+# archive.zip (full text, changelist and metadata of each revision) then
+# deleted. The latest revision of a document is always kept, since the next
+# diff is taken against it.
+#
+# Revisions are processed in batches, each committed on its own, so the
+# command can be stopped (see compact_revisions' stop_requested) and run again
+# later to continue. A batch's revisions are archived, and the archive closed
+# and synced, before their deletion is committed.
+
+import os, sys
+import json
+import zipfile
+import shutil
+import datetime
+
+if __name__ == '__main__':
+    # otw when running tests we can't import other modules
+    this_files_path = os.path.split(os.path.abspath(__file__))[0]
+    sys.path.append(os.path.join(this_files_path,".."))
+
+from core.storage import Revision, REVISIONS_TABLE_NAME, ALL_COL_NAMES, \
+                DOCUMENTS_TABLE_NAME, REVISION_CONTENT_FILENAME, \
+                REVISION_DELTA_FILENAME, CHANGELIST_BINARY_FILENAME, \
+                TIMESTAMP_FORMAT, REVISION_DIRECTORY_LAYOUTS
+from core.blob_store import BLOBS_TABLE_NAME
+from core.atomic_files import sync_file
+
+# values for the 'compact_policy' config option
+COMPACT_POLICY_ARCHIVE = 'archive'
+COMPACT_POLICY_DROP = 'drop'
+
+DEFAULT_RETIRED_AFTER_DAYS = 10000
+DEFAULT_BATCH_SIZE = 100
+
+ARCHIVE_FILENAME = 'archive.zip'
+ARCHIVE_METADATA_FILENAME = 'revision.json'
+
+def get_archive_path(storage):
+    return os.path.join(storage.config.diffrevision_base_directory,
+                        ARCHIVE_FILENAME)
+
+# hidden or retired revisions, except the head of each document
+def get_compactable_revisions(storage, retired_after_date, limit):
+    storage.db_cursor.execute("SELECT "+ALL_COL_NAMES+\
+                " FROM "+REVISIONS_TABLE_NAME+\
+                " WHERE (hidden = 1 OR scheduled_date > ?)"+\
+                " AND id NOT IN (SELECT head_revision_id"+\
+                    " FROM "+DOCUMENTS_TABLE_NAME+\
+                    " WHERE head_revision_id IS NOT NULL)"+\
+                " ORDER BY document_relative_path, datetime_diffed_on"+\
+                " LIMIT ?;",
+                (retired_after_date, limit))
+
+    return [Revision.create_from_record(storage, row, load_diff_content=False)\
+                for row in storage.db_cursor.fetchall()]
+
+# Later revisions may be stored as a delta against rev (see
+# Revision.get_delta_dependents): store their full text instead, so they
+# don't depend on rev anymore. Returns how many there were.
+def make_dependent_revisions_keyframes(rev):
+    dependents = rev.get_delta_dependents()
+
+    for dependent in dependents:
+        # full text written before the delta is removed, so the revision
+        # stays readable at every step
+        dependent.set_file_content(REVISION_CONTENT_FILENAME,
+                                   dependent.content)
+        dependent.remove_file(REVISION_DELTA_FILENAME)
+        rev.storage.set_delta_base(dependent, None)
+
+    return len(dependents)
+
+# Entries already in archived_names (the names in the archive) are skipped:
+# the revisions of a batch rolled back after they were archived are archived
+# again by the next run.
+def archive_revision(rev, archive, archived_names):
+    base = rev.get_relative_path_plus_timestamp()
+
+    metadata = {'id': rev.id,
+                'document_relative_path': rev.document_relative_path,
+                'datetime_diffed_on': \
+                        rev.datetime_diffed_on.strftime(TIMESTAMP_FORMAT),
+                'scheduled_date': str(rev.scheduled_date),
+                'num_revisions_done': rev.num_revisions_done,
+                'hidden': rev.hidden}
+
+    entries = [(ARCHIVE_METADATA_FILENAME, json.dumps(metadata)),
+               (REVISION_CONTENT_FILENAME,
+                    rev.content.encode(rev.storage.config.notes_codec)),
+               (CHANGELIST_BINARY_FILENAME, rev.changelist.to_bytes())]
+    for filename, data in entries:
+        name = os.path.join(base, filename)
+        if name not in archived_names:
+            archive.writestr(name, data)
+            archived_names.add(name)
+
+# Returns (number of revisions compacted, whether it stopped before the end).
+# stop_requested is checked between batches.
+def compact_revisions(storage, policy, retired_after_date,
+                        batch_size=DEFAULT_BATCH_SIZE,
+                        stop_requested=lambda: False):
+    assert policy in (COMPACT_POLICY_ARCHIVE, COMPACT_POLICY_DROP)
+
+    num_compacted = 0
+
+    while True:
+        if stop_requested():
+            return num_compacted, True
+
+        revs = get_compactable_revisions(storage, retired_after_date,
+                                         batch_size)
+        if not revs:
+            return num_compacted, False
+
+        # revision directories are only removed once the batch is committed,
+        # so an error in the middle of a batch doesn't lose anything
+        directories = []
+        with storage.transaction():
+            archive = None
+            if policy == COMPACT_POLICY_ARCHIVE:
+                archive = zipfile.ZipFile(get_archive_path(storage), "a",
+                                          zipfile.ZIP_DEFLATED)
+                archived_names = set(archive.namelist())
+
+            try:
+                for rev in revs:
+                    make_dependent_revisions_keyframes(rev)
+                    if archive is not None:
+                        archive_revision(rev, archive, archived_names)
+                    rev.perform_delete(remove_directory=False)
+                    for layout in REVISION_DIRECTORY_LAYOUTS:
+                        directories.append(\
+                            storage.get_revision_directory_path(rev, layout))
+            finally:
+                # zipfile only writes the archive's directory on close
+                if archive is not None:
+                    archive.close()
+
+            # the archive is on disk before the revisions it holds are
+            # deleted for good
+            if archive is not None and storage.atomic_files.durable:
+                sync_file(get_archive_path(storage))
+
+        for dir_path in directories:
+            if os.path.isdir(dir_path):
+                shutil.rmtree(dir_path)
+
+        num_compacted += len(revs)
+
+# Revision directories without a revision in the db (left by an interrupted
+# compaction, or by payloads moved to the db stores), as a list of paths.
+def find_orphan_revision_directories(storage):
+    orphans = []
+
+    for doc_relative_path, doc_dir in storage.iter_document_directories():
+        known = set([rev.datetime_diffed_on.strftime(TIMESTAMP_FORMAT) \
+                for rev in storage.iter_revisions_for_document_path_sorted(\
+                                doc_relative_path, load_diff_content=False)])
+
+        for name in os.listdir(doc_dir):
+            if name not in known:
+                orphans.append(os.path.join(doc_dir, name))
+
+    return orphans
+
+# Removes the orphaned revision directories, and the document directories
+# left empty. Returns the number of directories removed.
+def remove_orphan_revision_directories(storage):
+    num_removed = 0
+
+    for dir_path in find_orphan_revision_directories(storage):
+        shutil.rmtree(dir_path)
+        num_removed += 1
+
+    for doc_relative_path, doc_dir in \
+                        list(storage.iter_document_directories()):
+        if not os.listdir(doc_dir):
+            # with the shard directories above it, if they're empty too
+            storage.remove_empty_directories(doc_dir)
+            num_removed += 1
+
+    return num_removed
+
+# blob files without a row in the blobs table, as a list of paths
+def find_orphan_blob_files(storage):
+    blobs_abspath = storage.blob_store.blobs_abspath
+    if not os.path.isdir(blobs_abspath):
+        return []
+
+    known = set([row[0] for row in storage.iter_rows(\
+                            "SELECT hash FROM "+BLOBS_TABLE_NAME+";")])
+
+    orphans = []
+    for prefix in os.listdir(blobs_abspath):
+        prefix_dir = os.path.join(blobs_abspath, prefix)
+        for hash in os.listdir(prefix_dir):
+            if hash not in known:
+                orphans.append(os.path.join(prefix_dir, hash))
+
+    return orphans
+
+# Returns the number of orphaned blob files removed.
+def remove_orphan_blobs(storage):
+    orphans = find_orphan_blob_files(storage)
+    for blob_path in orphans:
+        os.remove(blob_path)
+    return len(orphans)
+
+# Gives the space freed in the db file back to the filesystem, and refreshes
+# the statistics of the query planner.
+def optimize_db(storage):
+    storage.db_connection.commit()
+    storage.db_cursor.execute("VACUUM;")
+    storage.db_cursor.execute("ANALYZE;")
+    storage.db_cursor.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+    storage.db_connection.commit()
+
+def get_disk_usage(path, excluded_paths=()):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            file_path = os.path.join(dirpath, filename)
+            if file_path not in excluded_paths:
+                total += os.path.getsize(file_path)
+    return total
+
+###################
+# tests
+
+def test_compact_drop_keeps_heads_and_delta_chains():
+    from core.storage import setup_temp_db, teardown_temp_db, \
+                                insert_test_revision
+
+    storage = setup_temp_db()
+    storage.config.delta_keyframe_interval = 4
+
+    start = datetime.datetime.now() - datetime.timedelta(days=2)
+    revs = [insert_test_revision(storage, "mynotes.txt",
+                    start + datetime.timedelta(minutes=i),
+                    u"line\n" * (i+1)) for i in range(4)]
+    other = insert_test_revision(storage, "othernotes.txt", start, u"other")
+
+    # revs[1] and revs[2] are deltas against revs[0], revs[3] against revs[2]
+    assert revs[2].has_file(REVISION_DELTA_FILENAME)
+    assert [r.id for r in revs[0].get_delta_dependents()] == \
+                [revs[2].id, revs[1].id]
+    revs[1].set_hidden_state(True)
+    # retired
+    revs[0].update_scheduled_date(datetime.date.today() + \
+                                    datetime.timedelta(days=99999))
+    # heads are never compacted
+    revs[3].set_hidden_state(True)
+    other.set_hidden_state(True)
+
+    orphan_dir = os.path.join(storage.revisions_content_abspath,
+                              "mynotes.txt", "2001-01-01-00-00-00")
+    os.makedirs(orphan_dir)
+
+    batches = []
+    def stop_after_one_batch():
+        batches.append(1)
+        return len(batches) > 1
+
+    retired_after = datetime.date.today() + datetime.timedelta(days=1000)
+    num, interrupted = compact_revisions(storage, COMPACT_POLICY_DROP,
+                                retired_after, batch_size=1,
+                                stop_requested=stop_after_one_batch)
+    assert (num, interrupted) == (1, True)
+
+    num, interrupted = compact_revisions(storage, COMPACT_POLICY_DROP,
+                                         retired_after)
+    assert (num, interrupted) == (1, False)
+
+    remaining = storage.get_revisions_for_document_path_sorted("mynotes.txt")
+    assert [r.id for r in remaining] == [revs[2].id, revs[3].id]
+    assert remaining[0].content == u"line\n" * 3
+    assert remaining[1].content == u"line\n" * 4
+    assert not remaining[0].has_file(REVISION_DELTA_FILENAME)
+
+    assert Revision.get_revision_from_id(storage, other.id) is not None
+    assert not os.path.exists(revs[0].get_full_directory_path())
+
+    assert remove_orphan_revision_directories(storage) == 1
+    assert not os.path.exists(orphan_dir)
+
+    optimize_db(storage)
+
+    teardown_temp_db(storage)
+
+def test_compact_archive():
+    from core.storage import setup_temp_db, teardown_temp_db, \
+                                insert_test_revision, PAYLOAD_STORAGE_BLOBS
+
+    storage = setup_temp_db()
+    storage.config.payload_storage = PAYLOAD_STORAGE_BLOBS
+
+    start = datetime.datetime.now() - datetime.timedelta(days=2)
+    r1 = insert_test_revision(storage, "mynotes.txt", start, u"old \xe9")
+    insert_test_revision(storage, "mynotes.txt",
+                         start + datetime.timedelta(minutes=1), u"new")
+    r1.set_hidden_state(True)
+
+    # a blob left behind
+    stray_blob = storage.blob_store.get_blob_path("ab" * 20)
+    os.makedirs(os.path.dirname(stray_blob))
+    open(stray_blob, "wb").close()
+
+    # a batch failing after its revisions were archived
+    perform_delete = Revision.perform_delete
+    def failing_delete(self, remove_directory=True):
+        raise IOError("disk full")
+    Revision.perform_delete = failing_delete
+    try:
+        compact_revisions(storage, COMPACT_POLICY_ARCHIVE,
+                          datetime.date.today())
+        assert False
+    except IOError:
+        pass
+    finally:
+        Revision.perform_delete = perform_delete
+    assert Revision.get_revision_from_id(storage, r1.id) is not None
+
+    num, interrupted = compact_revisions(storage, COMPACT_POLICY_ARCHIVE,
+                                         datetime.date.today())
+    assert (num, interrupted) == (1, False)
+    assert Revision.get_revision_from_id(storage, r1.id) is None
+
+    # archived once
+    archive = zipfile.ZipFile(get_archive_path(storage))
+    assert len(archive.namelist()) == 3
+    base = r1.get_relative_path_plus_timestamp()
+    assert archive.read(os.path.join(base, REVISION_CONTENT_FILENAME))\
+                .decode("utf-8") == u"old \xe9"
+    assert json.loads(archive.read(os.path.join(base,
+                        ARCHIVE_METADATA_FILENAME)))['id'] == r1.id
+    archive.close()
+
+    assert remove_orphan_blobs(storage) == 1
+    assert not os.path.exists(stray_blob)
+
+    teardown_temp_db(storage)
+
+if __name__ == '__main__':
+    test_compact_drop_keeps_heads_and_delta_chains()
+    test_compact_archive()
@@ -18,6 +18,8 @@
 # If not, see <http://www.gnu.org/licenses/>.
 
 import os, sys, copy, operator, time, datetime
+import itertools
+import signal
 
 if __name__ == '__main__':
     # otw when running tests we can't import other modules
@@ -25,7 +27,14 @@ if __name__ == '__main__':
     sys.path.append(os.path.join(this_files_path,".."))
 
 from storage import Storage, Revision, get_formatted_date, get_formatted_datetime
+from revision_table import date_to_epoch_day, epoch_day_to_date
 from note_listing import get_new_document_paths
+from store_lock import print_waiting_for_lock
+import compaction
+import fsck as integrity_check
+import store_export
+import payload_dictionary
+import tiering
 
 from generation.static_html_generator import StaticHtmlGenerator
 from diffing.diff_runner import DiffRunner
@@ -39,16 +48,17 @@ def add_to_ignore_list(arguments, config):
         return
 
     storage = Storage(config)
-    
-    new_files = get_new_document_paths(config, storage)
 
-    storage.add_docs_to_ignored_list(new_files)
+    with storage.lock(on_wait=print_waiting_for_lock):
+        new_files = get_new_document_paths(config, storage)
 
-    for d in new_files:
-        print "Now ignoring changes to", d
+        storage.add_docs_to_ignored_list(new_files)
 
-    if len(new_files) == 0:
-        print "(No new files to ignore)"
+        for d in new_files:
+            print "Now ignoring changes to", d
+
+        if len(new_files) == 0:
+            print "(No new files to ignore)"
 
 def add_to_watched_list(arguments, config):
     if arguments:
@@ -58,16 +68,17 @@ def add_to_watched_list(arguments, config):
         return
 
     storage = Storage(config)
-    
-    new_files = get_new_document_paths(config, storage)
 
-    storage.add_docs_to_watched_list(new_files)
+    with storage.lock(on_wait=print_waiting_for_lock):
+        new_files = get_new_document_paths(config, storage)
 
-    for d in new_files:
-        print "Now tracking", d
+        storage.add_docs_to_watched_list(new_files)
 
-    if len(new_files) == 0:
-        print "(No new files to add)"
+        for d in new_files:
+            print "Now tracking", d
+
+        if len(new_files) == 0:
+            print "(No new files to add)"
 
 def show_new_files(config):
     storage = Storage(config)
@@ -82,36 +93,77 @@ def show_new_files(config):
     if len(new_files) == 0:
         print "(No new files)"
 
-def generate_for_today(arguments, config):
-    storage = Storage(config)
+# Returns (days in advance, maximum number of reviews or None), or None if
+# the arguments of 'today' are invalid.
+def parse_today_arguments(arguments, default_limit=None):
+    arguments = list(arguments)
+
+    limit = default_limit
+    if '--limit' in arguments:
+        position = arguments.index('--limit')
+        try:
+            limit = int(arguments[position+1])
+        except (IndexError, ValueError):
+            return None
+        if limit <= 0:
+            return None
+        del arguments[position:position+2]
 
-    invalid = False
     if len(arguments) not in (0,1):
-        invalid = True
+        return None
 
     days_in_advance = 0
     if len(arguments) == 1:
         try:
             days_in_advance = int(arguments[0])
-        except:
-            invalid = True
+        except ValueError:
+            return None
 
-    if invalid:
-        print "Sole argument accepted by 'today' is a number of days"
-        print "for advance review."
-        return
+    return days_in_advance, limit
 
-    the_date = datetime.date.today() + datetime.timedelta(days=days_in_advance)
-    rev_objs = Revision.get_all_revisions_scheduled_before(storage, the_date)
+def generate_for_today(arguments, config):
+    storage = Storage(config)
+
+    parsed = parse_today_arguments(arguments,
+                                   getattr(config, 'today_limit', None))
 
-    if len(rev_objs) == 0:
-        print "No revisions for today, so not generating anything."
-        print "(If you want to review in advance, add a number of days as"
-        print " after 'diffrevision.py today', e.g. 'diffrevision.py t 2'"
+    if parsed is None:
+        print "Arguments accepted by 'today' are a number of days"
+        print "for advance review, and --limit followed by the maximum"
+        print "number of reviews to generate."
         return
 
-    generator = StaticHtmlGenerator(storage.config, storage)
-    generator.generate_pages_and_index_for_revisions(rev_objs)
+    days_in_advance, limit = parsed
+
+    the_date = datetime.date.today() + datetime.timedelta(days=days_in_advance)
+
+    # the local server takes the lock itself, when hiding a review
+    with storage.lock(exclusive=False, on_wait=print_waiting_for_lock):
+        # only the most overdue ones with a limit, the others are left for
+        # the next sessions
+        rev_objs = Revision.iter_all_revisions_scheduled_before(storage,
+                                                    the_date, limit=limit)
+
+        # revisions are streamed to the generator, we only peek at the first
+        # one
+        first_rev_obj = next(rev_objs, None)
+
+        if first_rev_obj is None:
+            print "No revisions for today, so not generating anything."
+            print "(If you want to review in advance, add a number of days as"
+            print " after 'diffrevision.py today', e.g. 'diffrevision.py t 2'"
+            return
+
+        generator = StaticHtmlGenerator(storage.config, storage)
+        generator.generate_pages_and_index_for_revisions(\
+                            itertools.chain([first_rev_obj], rev_objs))
+
+        if limit is not None:
+            num_due = storage.count_revisions_scheduled_before(the_date)
+            if num_due > limit:
+                print "Generated the", limit, "most overdue of", num_due, \
+                        "reviews due, the others will come once those are"\
+                        " finished."
 
     print "When you're done, you must manually call " 
     print "    'diffrevision.py finished [list of revision numbers]'"
@@ -120,7 +172,7 @@ def generate_for_today(arguments, config):
     if getattr(storage.config, 'use_local_server', False):
         print "STARTING LOCAL SERVER on port", localserver.SERVER_PORT
         localserver.LocalReviewServer.set_global_storage(storage)
-        server = localserver.HTTPServer(('localhost', localserver.SERVER_PORT), localserver.LocalReviewServer)
+        server = localserver.ThreadedHTTPServer(('localhost', localserver.SERVER_PORT), localserver.LocalReviewServer)
         print 'Use <Ctrl-C> to stop'
         server.serve_forever()
 
@@ -129,6 +181,52 @@ def perform_diff(config, scheduler_getter):
 
     diffrunner.scan_files_for_changes()
 
+    # the notes change over time, and so do the strings they have in common
+    dictionaries = diffrunner.storage.payload_dictionaries
+    if dictionaries.is_requested() and not dictionaries.is_enabled():
+        print_dictionary_compression_unavailable()
+    elif dictionaries.is_enabled() and dictionaries.needs_rotation(\
+                getattr(config, 'payload_dictionary_rotation_days',
+                        payload_dictionary.DEFAULT_ROTATION_DAYS)):
+        train_payload_dictionary(config, diffrunner.storage)
+
+def print_dictionary_compression_unavailable():
+    print "Warning: payload_compression = 'dictionary' only applies with"\
+            " payload_storage = 'sqlite' in the configuration, payloads are"\
+            " compressed without a dictionary"
+
+# Trains a new compression dictionary on the notes (see
+# core/payload_dictionary.py), kept if it does better than the current one.
+def train_payload_dictionary(config, storage=None):
+    if storage is None:
+        storage = Storage(config)
+
+    dictionaries = storage.payload_dictionaries
+    if not dictionaries.is_requested():
+        print "payload_compression isn't 'dictionary' in the configuration,"\
+                " no dictionary would be used"
+        return
+    if not dictionaries.is_enabled():
+        print_dictionary_compression_unavailable()
+        return
+
+    with storage.lock(on_wait=print_waiting_for_lock):
+        samples = dictionaries.get_samples(getattr(config,
+                    'payload_dictionary_sample_documents',
+                    payload_dictionary.DEFAULT_SAMPLE_DOCUMENTS))
+        dictionary_id, current_size, new_size = dictionaries.train(samples,
+                    getattr(config, 'payload_dictionary_size',
+                            payload_dictionary.DEFAULT_DICTIONARY_SIZE))
+        storage.commit()
+
+    print "Compressed size of", len(samples), "sample notes:", \
+            current_size, "bytes now,", new_size, "with a new dictionary"
+    if dictionary_id is None:
+        print "Keeping the current dictionary"
+    else:
+        print "New payloads will use dictionary", dictionary_id, \
+                "(run 'convert_storage' to recompress the others)"
+
 def log_number_revisions(config, number):
     logfile = os.path.join(config.diffrevision_base_directory, "revision_log.txt")
     f = open(logfile, "a")
@@ -138,23 +236,26 @@ def log_number_revisions(config, number):
 def reviews_finished(arguments, config):
     storage = Storage(config)
     
-    for revid_str in arguments:
-        revid = int(revid_str)
+    # all reschedulings are committed at once
+    with storage.lock(on_wait=print_waiting_for_lock), \
+            storage.transaction():
+        for revid_str in arguments:
+            revid = int(revid_str)
 
-        rev_obj = Revision.get_revision_from_id(storage, revid)
+            rev_obj = Revision.get_revision_from_id(storage, revid)
 
-        rev_obj.num_revisions_done += 1
+            rev_obj.num_revisions_done += 1
 
-        new_date = config.get_scheduler(rev_obj.document_relative_path)\
-                    .get_next_date(\
-                        revision_object=rev_obj,
-                        from_date=datetime.date.today())
+            new_date = config.get_scheduler(rev_obj.document_relative_path)\
+                        .get_next_date(\
+                            revision_object=rev_obj,
+                            from_date=datetime.date.today())
 
-        rev_obj.update_scheduled_date(new_date, update_num_revisions=True)
+            rev_obj.update_scheduled_date(new_date, update_num_revisions=True)
 
-        print "Revision for", rev_obj.document_relative_path, \
-            "(", get_formatted_datetime(rev_obj.datetime_diffed_on), ")",\
-            "scheduled for ", get_formatted_date(new_date)
+            print "Revision for", rev_obj.document_relative_path, \
+                "(", get_formatted_datetime(rev_obj.datetime_diffed_on), ")",\
+                "scheduled for ", get_formatted_date(new_date)
    
     # also logging revisions that were "deleted" during the revision session
     log_number_revisions(config, len(arguments))
@@ -166,6 +267,220 @@ def list_all(config):
 
     Revision.print_all_revisions(storage)
 
+def print_forecast(arguments, config):
+    num_days = 14
+    if arguments:
+        try:
+            num_days = int(arguments[0])
+        except ValueError:
+            print "Sole argument accepted by 'forecast' is a number of days."
+            return
+
+    storage = Storage(config)
+
+    table = storage.load_revision_table()
+
+    today = date_to_epoch_day(datetime.date.today())
+    due_by_day = table.count_due_by_day(today, num_days)
+
+    print "Revisions due on each of the next", num_days, "days",\
+            "(overdue ones count for today):"
+    for day_offset, count in enumerate(due_by_day):
+        print "   ", get_formatted_date(epoch_day_to_date(today+day_offset)),\
+                count
+
+    print "Total:", len(table), "revisions,", sum(table.hidden), "hidden"
+
+def convert_content_storage(config):
+    storage = Storage(config)
+
+    with storage.lock(on_wait=print_waiting_for_lock):
+        watched = storage.get_all_watched_document_paths()
+
+        print "Rewriting revision content for", len(watched), "documents"
+
+        num_revisions = 0
+        for doc_relative_path in watched:
+            num_revisions += \
+                storage.convert_document_content_storage(doc_relative_path)
+
+        print "Rewrote", num_revisions, "revisions"
+
+# moves the revision directories to the layout set by
+# 'revision_directory_layout' in the config
+def relayout(config):
+    storage = Storage(config)
+
+    with storage.lock(on_wait=print_waiting_for_lock):
+        print "Moving revision directories to the '%s' layout" \
+                    % (storage.get_revision_directory_layout(),)
+
+        num_moved = 0
+        for rev in Revision.iter_all_revisions(storage):
+            if storage.move_revision_directory(rev):
+                num_moved += 1
+
+        print "Moved", num_moved, "revision directories"
+
+def compact(config):
+    storage = Storage(config)
+
+    with storage.lock(on_wait=print_waiting_for_lock):
+        policy = getattr(config, 'compact_policy',
+                            compaction.COMPACT_POLICY_ARCHIVE)
+        retired_after_date = datetime.date.today() + datetime.timedelta(\
+                days=getattr(config, 'compact_retired_after_days',
+                                compaction.DEFAULT_RETIRED_AFTER_DAYS))
+        batch_size = getattr(config, 'compact_batch_size',
+                                compaction.DEFAULT_BATCH_SIZE)
+
+        # the archive grows, so it doesn't count in the space reclaimed
+        excluded_paths = [compaction.get_archive_path(storage)]
+        usage_before = compaction.get_disk_usage(\
+                        config.diffrevision_base_directory, excluded_paths)
+
+        # Ctrl-C lets the current batch finish and be committed
+        interruptions = []
+        def request_stop(signum, frame):
+            print "Stopping after the current batch..."
+            interruptions.append(signum)
+        previous_handler = signal.signal(signal.SIGINT, request_stop)
+
+        try:
+            print "Compacting hidden and retired revisions (policy: %s)" \
+                        % (policy,)
+            num_compacted, interrupted = compaction.compact_revisions(\
+                        storage, policy, retired_after_date, batch_size,
+                        stop_requested=lambda: len(interruptions) > 0)
+            print "Compacted", num_compacted, "revisions"
+
+            if not interrupted:
+                print "Removed", \
+                    compaction.remove_orphan_revision_directories(storage), \
+                    "orphaned directories"
+                print "Removed", compaction.remove_orphan_blobs(storage), \
+                    "orphaned blobs"
+                print "Removed", \
+                    storage.payload_dictionaries.remove_unused(), \
+                    "unused compression dictionaries"
+                num_packs, reclaimed = tiering.repack_sparse_packs(storage)
+                print "Rewrote", num_packs, "packs, freeing", reclaimed, \
+                        "bytes"
+                print "Optimizing the database"
+                compaction.optimize_db(storage)
+        finally:
+            signal.signal(signal.SIGINT, previous_handler)
+
+        usage_after = compaction.get_disk_usage(\
+                        config.diffrevision_base_directory, excluded_paths)
+        print "Reclaimed", usage_before - usage_after, "bytes"
+
+        if interrupted:
+            print "Interrupted: run 'compact' again to continue."
+
+# moves the payloads of revisions not due for a long time to pack files
+# (see core/tiering.py)
+def tier(config):
+    storage = Storage(config)
+
+    with storage.lock(on_wait=print_waiting_for_lock):
+        horizon_date = datetime.date.today() + datetime.timedelta(\
+                days=getattr(config, 'tier_cold_after_days',
+                                tiering.DEFAULT_COLD_AFTER_DAYS))
+
+        # Ctrl-C lets the current batch finish and be committed
+        interruptions = []
+        def request_stop(signum, frame):
+            print "Stopping after the current batch..."
+            interruptions.append(signum)
+        previous_handler = signal.signal(signal.SIGINT, request_stop)
+
+        try:
+            print "Packing revisions hidden or scheduled after", \
+                    get_formatted_date(horizon_date)
+            num_packed, interrupted = tiering.pack_cold_revisions(\
+                        storage, horizon_date,
+                        stop_requested=lambda: len(interruptions) > 0)
+            print "Packed", num_packed, "revisions"
+
+            if not interrupted:
+                num_packs, reclaimed = tiering.repack_sparse_packs(storage)
+                print "Rewrote", num_packs, "packs, freeing", reclaimed, \
+                        "bytes"
+        finally:
+            signal.signal(signal.SIGINT, previous_handler)
+
+        if interrupted:
+            print "Interrupted: run 'tier' again to continue."
+
+# Checks the store (see core/fsck.py) and prints the problems found.
+# Returns the number of problems.
+def fsck(arguments, config):
+    storage = Storage(config)
+
+    with storage.lock(exclusive=False, on_wait=print_waiting_for_lock):
+        if len(arguments) > 0:
+            num_workers = int(arguments[0])
+        else:
+            num_workers = getattr(config, 'fsck_workers',
+                                    integrity_check.DEFAULT_NUM_WORKERS)
+
+        start = time.time()
+
+        num_revisions, problems = integrity_check.check_revisions(storage,
+                                                                  num_workers)
+        problems.extend(integrity_check.check_store(storage))
+
+        for problem in problems:
+            print problem
+
+        print "Checked", num_revisions, "revisions in %.1f seconds:" \
+                    % (time.time() - start,), len(problems), "problems"
+
+        return len(problems)
+
+def export_store(arguments, config):
+    if len(arguments) != 1:
+        print "Usage: export <archive file>"
+        return
+
+    storage = Storage(config)
+
+    with storage.lock(exclusive=False, on_wait=print_waiting_for_lock):
+        print "Exporting to", arguments[0]
+        num_revisions = store_export.export_store(storage, arguments[0])
+        print "Exported", num_revisions, "revisions"
+
+def import_store(arguments, config):
+    if len(arguments) != 1:
+        print "Usage: import <archive file>"
+        return
+
+    storage = Storage(config)
+
+    with storage.lock(on_wait=print_waiting_for_lock):
+        # Ctrl-C lets the current batch finish and be committed
+        interruptions = []
+        def request_stop(signum, frame):
+            print "Stopping after the current batch..."
+            interruptions.append(signum)
+        previous_handler = signal.signal(signal.SIGINT, request_stop)
+
+        try:
+            print "Importing", arguments[0]
+            num_imported, num_skipped, interrupted = \
+                    store_export.import_store(storage, arguments[0],
+                        stop_requested=lambda: len(interruptions) > 0)
+        finally:
+            signal.signal(signal.SIGINT, previous_handler)
+
+        print "Imported", num_imported, "revisions"
+        if num_skipped:
+            print "Skipped", num_skipped, "revisions already imported"
+
+        if interrupted:
+            print "Interrupted: run 'import' again to continue."
+
 #############
 # tests
 
@@ -206,6 +521,33 @@ def test__reviews_finished__basic():
     shutil.rmtree(notes_dir)
     teardown_temp_db(store)
 
+def test__parse_today_arguments():
+    assert parse_today_arguments([]) == (0, None)
+    assert parse_today_arguments(["2"], default_limit=50) == (2, 50)
+    assert parse_today_arguments(["--limit", "200"]) == (0, 200)
+    assert parse_today_arguments(["2", "--limit", "200"]) == (2, 200)
+    assert parse_today_arguments(["--limit", "200", "2"]) == (2, 200)
+    assert parse_today_arguments(["--limit"]) is None
+    assert parse_today_arguments(["--limit", "0"]) is None
+    assert parse_today_arguments(["2", "3"]) is None
+    assert parse_today_arguments(["tomorrow"]) is None
+
+# the same checks for the page size of the local server's /duereviews
+def test__parse_due_reviews_query():
+    parse = localserver.parse_due_reviews_query
+    assert parse({}) == (0, localserver.DUE_REVIEWS_PAGE_SIZE, None)
+    assert parse({'days': ['2'], 'limit': ['10'],
+                  'after': ['2012-01-03,1234']}) == \
+                (2, 10, (datetime.date(2012, 1, 3), 1234))
+    assert parse({'limit': ['100000']}) == \
+                (0, localserver.MAX_DUE_REVIEWS_PAGE_SIZE, None)
+    assert parse({'limit': ['0']}) is None
+    assert parse({'limit': ['-1']}) is None
+    assert parse({'limit': ['many']}) is None
+    assert parse({'after': ['2012-01-03']}) is None
+
 if __name__ == '__main__':
     test__reviews_finished__basic()
+    test__parse_today_arguments()
+    test__parse_due_reviews_query()
 
@@ -0,0 +1,138 @@
+# This file is part of python-diffrevision
+# Copyright (C) 2011 Francois Savard 
+#
+# python-diffrevision is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-diffrevision is distributed in the hope that
+# it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-diffrevision (see license.txt)
+# If not, see <http://www.gnu.org/licenses/>.
+
+# SQLite connections for Storage: one connection (and cursor) per thread,
+# opened on first use, in WAL mode.
+#
+# With WAL, readers (the local server, 'today') don't block the writer
+# ('diff' run from cron, for example) and the writer doesn't block them.
+# Writers still exclude each other, so connections wait up to busy_timeout
+# seconds for the lock instead of failing right away with
+# 'database is locked'.
+
+import os, sys
+import threading
+import sqlite3
+
+if __name__ == '__main__':
+    # otw when running tests we can't import other modules
+    this_files_path = os.path.split(os.path.abspath(__file__))[0]
+    sys.path.append(os.path.join(this_files_path,".."))
+
+from core.sql_stats import InstrumentedConnection
+
+DEFAULT_BUSY_TIMEOUT = 30 # seconds
+
+class ConnectionManager(object):
+    def __init__(self, db_path, busy_timeout=DEFAULT_BUSY_TIMEOUT):
+        self.db_path = db_path
+        self.busy_timeout = busy_timeout
+
+        # per-thread connection, cursor and transaction depth
+        self.local = threading.local()
+
+    def open_connection(self):
+        # the detect_types option makes sure timestamp and date columns
+        # are converted correclty in the Python layer
+        # statements are timed (and their plans checked in tests), see
+        # core.sql_stats
+        connection = sqlite3.connect(self.db_path,
+                detect_types=sqlite3.PARSE_DECLTYPES,
+                timeout=self.busy_timeout,
+                factory=InstrumentedConnection)
+
+        # WAL mode is persistent, but setting it again is harmless
+        connection.execute("PRAGMA journal_mode=WAL;")
+        connection.execute("PRAGMA busy_timeout=%d;" \
+                                % (int(self.busy_timeout*1000),))
+
+        return connection
+
+    def get_connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.open_connection()
+            self.local.connection = connection
+            self.local.cursor = connection.cursor()
+            self.local.transaction_depth = 0
+        return connection
+
+    def get_cursor(self):
+        self.get_connection()
+        return self.local.cursor
+
+    def get_transaction_depth(self):
+        self.get_connection()
+        return self.local.transaction_depth
+
+    def set_transaction_depth(self, depth):
+        self.get_connection()
+        self.local.transaction_depth = depth
+
+    # closes the connection of the calling thread (connections of other
+    # threads are closed when those threads end)
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+            self.local.cursor = None
+
+###################
+# tests
+
+def test_connection_per_thread_and_wal():
+    import tempfile, shutil
+
+    tmpdir = tempfile.mkdtemp()
+    manager = ConnectionManager(os.path.join(tmpdir, "test.sqlite3"),
+                                busy_timeout=1)
+
+    assert manager.get_connection() is manager.get_connection()
+    assert manager.get_cursor().execute("PRAGMA journal_mode;")\
+                        .fetchone()[0] == "wal"
+
+    manager.get_cursor().execute("create table t (x integer)")
+    manager.get_cursor().execute("insert into t values (1)")
+    manager.get_connection().commit()
+
+    # a write transaction stays open in this thread...
+    manager.get_cursor().execute("insert into t values (2)")
+
+    results = []
+    def read_in_other_thread():
+        results.append(manager.get_connection())
+        results.append(manager.get_cursor().execute(\
+                            "SELECT COUNT(*) FROM t").fetchone()[0])
+        manager.close()
+
+    # ...which doesn't block readers, who see the last committed state
+    reader = threading.Thread(target=read_in_other_thread)
+    reader.start()
+    reader.join()
+
+    assert results[0] is not manager.get_connection()
+    assert results[1] == 1
+
+    manager.get_connection().commit()
+    manager.close()
+    shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    test_connection_per_thread_and_wal()
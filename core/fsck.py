@@ -0,0 +1,337 @@
+# This file is part of python-diffrevision
+# Copyright (C) 2011 Francois Savard 
+#
+# python-diffrevision is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-diffrevision is distributed in the hope that
+# it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-diffrevision (see license.txt)
+# If not, see <http://www.gnu.org/licenses/>.
+
+# Integrity check of the store, for the 'fsck' command. Nothing is modified,
+# problems are only reported (see 'compact' to remove orphans).
+#
+# For each revision:
+#  - its content (complete text, or delta replayed on its base revision)
+#    and changelist (binary or old text format) exist and can be read
+#  - the content decodes with notes_codec, the changelist parses
+#  - payloads in the blob store match their hash
+# and the head recorded in the documents table is the latest revision of its
+# document, with the right content hash.
+#
+# Documents are checked in parallel by a pool of fsck_workers threads (most
+# of the time goes to reading files, which releases the GIL). Each document's
+# revisions are checked in chronological order by the same worker, so every
+# delta is applied once, to the content of its base, checked before it.
+#
+# Then, for the store as a whole: revision directories and blob files without
+# a revision, payload and delta base rows without a revision, blob
+# refcounts.
+
+import os, sys
+import zlib
+from multiprocessing.pool import ThreadPool
+
+if __name__ == '__main__':
+    # otw when running tests we can't import other modules
+    this_files_path = os.path.split(os.path.abspath(__file__))[0]
+    sys.path.append(os.path.join(this_files_path,".."))
+
+from core.storage import REVISIONS_TABLE_NAME, DOCUMENTS_TABLE_NAME, \
+                REVISION_CONTENT_FILENAME, REVISION_DELTA_FILENAME, \
+                CHANGELIST_FILENAME, CHANGELIST_BINARY_FILENAME, \
+                DELTA_ENCODING, DELTA_BASES_TABLE_NAME
+from core.blob_store import hash_data, BLOBS_TABLE_NAME, BLOB_REFS_TABLE_NAME
+from core.payload_table import PAYLOADS_TABLE_NAME
+from core.pack_store import PACK_ENTRIES_TABLE_NAME
+from core.compaction import find_orphan_revision_directories, \
+                find_orphan_blob_files
+from generation.wikidpad_formatter import StringOps
+from diffing.changelist import Changelist
+
+DEFAULT_NUM_WORKERS = 4
+
+# documents handed to a worker at a time
+DOCUMENTS_PER_TASK = 8
+
+# Reads a payload without going through the payload cache (a full check
+# would only evict the entries useful to the other commands), and checks it
+# against its hash when it's in the blob store. Returns None and adds to
+# problems if it can't be read.
+def read_checked_payload(rev, filename, problems):
+    where = rev.get_relative_path_plus_timestamp()
+    try:
+        data = rev.storage.read_payload(rev, filename)
+    except (IOError, OSError, zlib.error), e:
+        problems.append("%s: can't read %s (%s)" % (where, filename, e))
+        return None
+
+    expected_hash = rev.storage.get_payload_hash(rev, filename)
+    if expected_hash is not None and hash_data(data) != expected_hash:
+        problems.append("%s: %s doesn't match its checksum" \
+                            % (where, filename))
+
+    return data
+
+# returns the revision's content, or None if it can't be rebuilt
+def check_content(rev, base_content, problems):
+    storage = rev.storage
+    where = rev.get_relative_path_plus_timestamp()
+
+    if storage.has_payload(rev, REVISION_DELTA_FILENAME):
+        delta = read_checked_payload(rev, REVISION_DELTA_FILENAME, problems)
+        if delta is None:
+            return None
+        if base_content is None:
+            problems.append("%s: delta without a readable base revision"\
+                                % (where,))
+            return None
+        # a corrupted delta may fail in any way
+        try:
+            return StringOps.applyBinCompact(\
+                        base_content.encode(DELTA_ENCODING), delta)\
+                            .decode(DELTA_ENCODING)
+        except Exception, e:
+            problems.append("%s: can't apply %s (%s)" \
+                                % (where, REVISION_DELTA_FILENAME, e))
+            return None
+
+    if not storage.has_payload(rev, REVISION_CONTENT_FILENAME):
+        problems.append("%s: missing content" % (where,))
+        return None
+
+    data = read_checked_payload(rev, REVISION_CONTENT_FILENAME, problems)
+    if data is None:
+        return None
+    try:
+        return data.decode(storage.config.notes_codec)
+    except UnicodeDecodeError, e:
+        problems.append("%s: %s doesn't decode with %s (%s)" \
+                % (where, REVISION_CONTENT_FILENAME,
+                   storage.config.notes_codec, e))
+        return None
+
+def check_changelist(rev, problems):
+    storage = rev.storage
+    where = rev.get_relative_path_plus_timestamp()
+
+    if storage.has_payload(rev, CHANGELIST_BINARY_FILENAME):
+        data = read_checked_payload(rev, CHANGELIST_BINARY_FILENAME, problems)
+        if data is not None:
+            try:
+                Changelist.from_bytes(data)
+            except (ValueError, IndexError), e:
+                problems.append("%s: can't parse %s (%s)" \
+                                % (where, CHANGELIST_BINARY_FILENAME, e))
+    elif storage.has_payload(rev, CHANGELIST_FILENAME):
+        data = read_checked_payload(rev, CHANGELIST_FILENAME, problems)
+        if data is not None:
+            try:
+                Changelist.from_text(data.decode(storage.config.notes_codec))
+            except (ValueError, UnicodeDecodeError), e:
+                problems.append("%s: can't parse %s (%s)" \
+                                % (where, CHANGELIST_FILENAME, e))
+    else:
+        problems.append("%s: missing changelist" % (where,))
+
+# Checks all revisions of a document, and its head (a DocumentHead, or None
+# if it has none). Returns (number of revisions checked, problems).
+def check_document(storage, doc_relative_path, head):
+    problems = []
+
+    revs = storage.get_revisions_for_document_path_sorted(doc_relative_path,
+                                                    load_diff_content=False)
+
+    # contents by revision id, for the deltas against them
+    contents = {}
+    content = None
+    previous = None
+    for rev in revs:
+        base_id = storage.get_delta_base_id(rev)
+        if base_id is None and previous is not None:
+            base_id = previous.id
+        content = check_content(rev, contents.get(base_id), problems)
+        contents[rev.id] = content
+        check_changelist(rev, problems)
+        previous = rev
+
+    if revs:
+        latest = revs[-1]
+        if head is None or head.revision_id != latest.id:
+            problems.append("%s: head in the documents table is %s,"\
+                            " latest revision is %s" % (doc_relative_path,
+                                head.revision_id if head else None,
+                                latest.id))
+        elif head.content_hash is not None and content is not None and \
+                hash_data(content.encode(storage.config.notes_codec)) != \
+                    head.content_hash:
+            problems.append("%s: wrong content hash in the documents table"\
+                                % (doc_relative_path,))
+
+    return len(revs), problems
+
+# Checks all documents with revisions, using num_workers threads.
+# Returns (number of revisions checked, problems).
+def check_revisions(storage, num_workers=DEFAULT_NUM_WORKERS):
+    doc_relative_paths = [row[0] for row in storage.iter_rows(\
+                "SELECT DISTINCT document_relative_path"+\
+                " FROM "+REVISIONS_TABLE_NAME+";")]
+    heads = storage.get_document_heads()
+
+    def check(doc_relative_path):
+        return check_document(storage, doc_relative_path,
+                              heads.get(doc_relative_path))
+
+    num_revisions = 0
+    problems = []
+
+    # workers get a db connection of their own, see Storage.db_connection
+    pool = ThreadPool(max(1, num_workers))
+    try:
+        for doc_num_revisions, doc_problems in \
+                pool.imap_unordered(check, doc_relative_paths,
+                                    DOCUMENTS_PER_TASK):
+            num_revisions += doc_num_revisions
+            problems.extend(doc_problems)
+    finally:
+        pool.close()
+        pool.join()
+
+    return num_revisions, sorted(problems)
+
+def check_store(storage):
+    problems = []
+
+    for dir_path in find_orphan_revision_directories(storage):
+        problems.append("orphaned revision directory: %s" % (dir_path,))
+
+    for blob_path in find_orphan_blob_files(storage):
+        problems.append("orphaned blob file: %s" % (blob_path,))
+
+    for table_name in (BLOB_REFS_TABLE_NAME, PAYLOADS_TABLE_NAME,
+                       PACK_ENTRIES_TABLE_NAME):
+        for revision_id, filename in storage.iter_rows(\
+                "SELECT revision_id, filename FROM "+table_name+\
+                " WHERE revision_id NOT IN"+\
+                    " (SELECT id FROM "+REVISIONS_TABLE_NAME+");"):
+            problems.append("%s of revision %s in the %s table, but no"\
+                            " such revision" % (filename, revision_id,
+                                                table_name))
+
+    for revision_id, in storage.iter_rows(\
+                "SELECT revision_id FROM "+DELTA_BASES_TABLE_NAME+\
+                " WHERE revision_id NOT IN"+\
+                    " (SELECT id FROM "+REVISIONS_TABLE_NAME+");"):
+        problems.append("delta base of revision %s in the %s table, but no"\
+                        " such revision" % (revision_id,
+                                            DELTA_BASES_TABLE_NAME))
+
+    for hash, refcount, num_refs in storage.iter_rows(\
+                "SELECT "+BLOBS_TABLE_NAME+".hash, refcount,"+\
+                " COUNT("+BLOB_REFS_TABLE_NAME+".hash)"+\
+                " FROM "+BLOBS_TABLE_NAME+\
+                " LEFT JOIN "+BLOB_REFS_TABLE_NAME+\
+                " ON "+BLOB_REFS_TABLE_NAME+".hash = "+\
+                        BLOBS_TABLE_NAME+".hash"+\
+                " GROUP BY "+BLOBS_TABLE_NAME+".hash;"):
+        if refcount != num_refs:
+            problems.append("blob %s has a refcount of %d, but %d references"\
+                                % (hash, refcount, num_refs))
+        if not os.path.exists(storage.blob_store.get_blob_path(hash)):
+            problems.append("missing blob file: %s" % (hash,))
+
+    for hash, in storage.iter_rows("SELECT DISTINCT hash"+\
+                " FROM "+BLOB_REFS_TABLE_NAME+\
+                " WHERE hash NOT IN (SELECT hash FROM "+BLOBS_TABLE_NAME+");"):
+        problems.append("blob %s is referenced, but not in the %s table" \
+                            % (hash, BLOBS_TABLE_NAME))
+
+    for doc_relative_path, revision_id in storage.iter_rows(\
+                "SELECT document_relative_path, head_revision_id"+\
+                " FROM "+DOCUMENTS_TABLE_NAME+\
+                " WHERE head_revision_id IS NOT NULL"+\
+                " AND head_revision_id NOT IN"+\
+                    " (SELECT id FROM "+REVISIONS_TABLE_NAME+");"):
+        problems.append("%s: head revision %s doesn't exist" \
+                            % (doc_relative_path, revision_id))
+
+    return problems
+
+###################
+# tests
+
+def test_fsck_reports_damaged_payloads_and_orphans():
+    import datetime
+    from core.storage import setup_temp_db, teardown_temp_db, \
+                                insert_test_revision, PAYLOAD_STORAGE_BLOBS
+
+    storage = setup_temp_db()
+    storage.config.delta_keyframe_interval = 2
+
+    start = datetime.datetime(2012, 1, 1, 10)
+    revs = [insert_test_revision(storage, "mynotes.txt",
+                    start + datetime.timedelta(minutes=i),
+                    u"line \xe9\n" * (i+1)) for i in range(3)]
+    assert revs[1].has_file(REVISION_DELTA_FILENAME)
+
+    storage.config.payload_storage = PAYLOAD_STORAGE_BLOBS
+    other = insert_test_revision(storage, "othernotes.txt", start, u"other")
+    broken = insert_test_revision(storage, "broken.txt", start, u"broken",
+                                  changelist=u"5")
+
+    # a healthy store, whatever the number of workers
+    for num_workers in (1, 3):
+        assert check_revisions(storage, num_workers) == (5, [])
+    assert check_store(storage) == []
+
+    # the keyframe of mynotes.txt can't be decoded anymore, so the delta
+    # after it can't be applied either
+    f = open(os.path.join(revs[0].get_full_directory_path(),
+                          REVISION_CONTENT_FILENAME), "wb")
+    f.write("\xff\xfe")
+    f.close()
+    os.remove(os.path.join(revs[2].get_full_directory_path(),
+                           CHANGELIST_BINARY_FILENAME))
+
+    # a blob modified in place
+    blob_path = storage.blob_store.get_blob_path(\
+                    other.get_file_hash(REVISION_CONTENT_FILENAME))
+    f = open(blob_path, "wb")
+    f.write("tampered")
+    f.close()
+
+    os.remove(storage.blob_store.get_blob_path(\
+                    broken.get_file_hash(CHANGELIST_BINARY_FILENAME)))
+
+    orphan_dir = os.path.join(storage.revisions_content_abspath,
+                              "mynotes.txt", "2001-01-01-00-00-00")
+    os.makedirs(orphan_dir)
+
+    num_revisions, problems = check_revisions(storage, 2)
+    assert num_revisions == 5
+    assert len(problems) == 6
+    assert "can't read changelist.bin" in problems[0]
+    assert "doesn't decode" in problems[1]
+    assert "delta without a readable base revision" in problems[2]
+    assert "missing changelist" in problems[3]
+    assert "content.txt doesn't match its checksum" in problems[4]
+    assert "wrong content hash in the documents table" in problems[5]
+
+    problems = check_store(storage)
+    assert len(problems) == 2
+    assert "orphaned revision directory" in problems[0]
+    assert "missing blob file" in problems[1]
+
+    teardown_temp_db(storage)
+
+if __name__ == '__main__':
+    test_fsck_reports_damaged_payloads_and_orphans()
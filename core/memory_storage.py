@@ -0,0 +1,554 @@
+# This file is part of python-diffrevision
+# Copyright (C) 2011 Francois Savard 
+#
+# python-diffrevision is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-diffrevision is distributed in the hope that
+# it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-diffrevision (see license.txt)
+# If not, see <http://www.gnu.org/licenses/>.
+
+# Storage backend keeping everything in dicts (see core.storage_backend), so
+# tests and benchmarks with many documents and revisions don't touch the
+# disk, e.g.
+#     store = MemoryStorage(config)
+#     DiffRunner(config, scheduler_getter, store=store).scan_files_for_changes()
+#
+# Nothing is persisted. Transactions are emulated with an undo log: while
+# one is open, every change records its inverse, and a rollback replays them
+# backwards, so a transaction costs what it changes, not the size of the
+# store.
+
+import os, sys
+import bisect
+import heapq
+import itertools
+
+if __name__ == '__main__':
+    # otw when running tests we can't import other modules
+    this_files_path = os.path.split(os.path.abspath(__file__))[0]
+    sys.path.append(os.path.join(this_files_path,".."))
+
+from core.storage_backend import StorageBackend
+from core.storage import Revision, DocumentHead, PAYLOAD_FILENAMES
+from core.blob_store import hash_data
+from core.revision_table import RevisionTable, date_to_epoch_day
+from core.payload_cache import PayloadCache
+
+class MemoryStorage(StorageBackend):
+    def __init__(self, config):
+        StorageBackend.__init__(self, config)
+
+        # payloads are already in memory
+        self.payload_cache = PayloadCache(0)
+
+        self.transaction_depth = 0
+        # (function, args) undoing each change of the open transaction, in
+        # order, None outside transactions
+        self.undo_log = None
+
+        self.next_revision_id = 1
+
+        # records in the same layout as the revisions table rows (see
+        # Revision.create_from_record), by id
+        self.revision_records = {}
+        # ids of each document's revisions, sorted by datetime_diffed_on,
+        # and their datetime_diffed_on alongside, to bisect into
+        self.revision_ids_by_document = {}
+        self.revision_datetimes_by_document = {}
+        # (scheduled_date, id) of the revisions, sorted, for the due
+        # revisions: not hidden ones, then hidden ones
+        self.due_keys = []
+        self.hidden_due_keys = []
+        # data by (revision id, filename)
+        self.payloads = {}
+        # watched documents, with their DocumentHead (None if they don't
+        # have a revision yet)
+        self.documents = {}
+        self.ignored_documents = set()
+        # base revision id by revision id, see StorageBackend.set_delta_base
+        self.delta_bases = {}
+        # the reverse: set of dependent revision ids by base revision id
+        self.delta_dependents = {}
+
+    def begin(self):
+        self.undo_log = []
+
+    def commit(self):
+        self.undo_log = None
+
+    def rollback(self):
+        for fn, args in reversed(self.undo_log or []):
+            fn(*args)
+        self.undo_log = None
+
+    # All changes to the dicts, lists and sets go through these, to be
+    # undone on rollback
+
+    def log_undo(self, fn, *args):
+        if self.undo_log is not None:
+            self.undo_log.append((fn, args))
+
+    def set_entry(self, entries, key, value):
+        if key in entries:
+            self.log_undo(entries.__setitem__, key, entries[key])
+        else:
+            self.log_undo(entries.pop, key)
+        entries[key] = value
+
+    def pop_entry(self, entries, key):
+        if key not in entries:
+            return None
+        value = entries.pop(key)
+        self.log_undo(entries.__setitem__, key, value)
+        return value
+
+    def insert_item(self, items, position, item):
+        items.insert(position, item)
+        self.log_undo(items.pop, position)
+
+    def delete_item(self, items, position):
+        self.log_undo(items.insert, position, items[position])
+        del items[position]
+
+    def add_member(self, members, member):
+        if member not in members:
+            members.add(member)
+            self.log_undo(members.discard, member)
+
+    def discard_member(self, members, member):
+        if member in members:
+            members.discard(member)
+            self.log_undo(members.add, member)
+
+    # the list or set at key in entries, added if missing
+    def get_or_add_entry(self, entries, key, empty):
+        if key not in entries:
+            self.set_entry(entries, key, empty)
+        return entries[key]
+
+    def create_revision(self, revision_id, load_diff_content):
+        return Revision.create_from_record(self,
+                                self.revision_records[revision_id],
+                                load_diff_content=load_diff_content)
+
+    ##############
+    # Revisions
+
+    def insert_revision(self, rev):
+        revision_id = rev.id
+        if revision_id is None:
+            revision_id = self.next_revision_id
+        self.log_undo(setattr, self, 'next_revision_id', self.next_revision_id)
+        self.next_revision_id = max(self.next_revision_id, revision_id + 1)
+
+        self.set_entry(self.revision_records, revision_id, (revision_id,
+                rev.document_relative_path, rev.datetime_diffed_on,
+                rev.scheduled_date, rev.num_revisions_done,
+                1 if rev.hidden else 0))
+        self.add_due_key(self.revision_records[revision_id])
+
+        ids = self.get_or_add_entry(self.revision_ids_by_document,
+                                    rev.document_relative_path, [])
+        datetimes = self.get_or_add_entry(self.revision_datetimes_by_document,
+                                          rev.document_relative_path, [])
+        # revisions mostly come in chronological order, i.e. appended
+        position = bisect.bisect_right(datetimes, rev.datetime_diffed_on)
+        self.insert_item(ids, position, revision_id)
+        self.insert_item(datetimes, position, rev.datetime_diffed_on)
+
+        return revision_id
+
+    def get_datetimes(self, doc_relative_path):
+        return self.revision_datetimes_by_document.get(doc_relative_path, [])
+
+    def get_due_keys(self, hidden):
+        return self.hidden_due_keys if hidden else self.due_keys
+
+    def add_due_key(self, record):
+        keys = self.get_due_keys(record[5])
+        key = (record[3], record[0])
+        self.insert_item(keys, bisect.bisect_right(keys, key), key)
+
+    def remove_due_key(self, record):
+        keys = self.get_due_keys(record[5])
+        self.delete_item(keys,
+                         bisect.bisect_left(keys, (record[3], record[0])))
+
+    def update_revision_record(self, revision_id, column, value):
+        self.remove_due_key(self.revision_records[revision_id])
+        record = list(self.revision_records[revision_id])
+        record[column] = value
+        self.set_entry(self.revision_records, revision_id, tuple(record))
+        self.add_due_key(self.revision_records[revision_id])
+
+    def update_revision_schedule(self, revision_id, scheduled_date,
+                                    num_revisions_done=None):
+        self.update_revision_record(revision_id, 3, scheduled_date)
+        if num_revisions_done is not None:
+            self.update_revision_record(revision_id, 4, num_revisions_done)
+
+    def update_revision_hidden(self, revision_id, hidden):
+        self.update_revision_record(revision_id, 5, 1 if hidden else 0)
+
+    def delete_revision(self, rev, remove_directory=True):
+        for filename in PAYLOAD_FILENAMES:
+            self.pop_entry(self.payloads, (rev.id, filename))
+        self.remove_delta_base(rev.id)
+
+        record = self.pop_entry(self.revision_records, rev.id)
+        self.remove_due_key(record)
+        ids = self.revision_ids_by_document[record[1]]
+        datetimes = self.revision_datetimes_by_document[record[1]]
+        position = bisect.bisect_left(datetimes, record[2])
+        while ids[position] != rev.id:
+            position += 1
+        self.delete_item(ids, position)
+        self.delete_item(datetimes, position)
+
+    def get_revision_from_id(self, id, load_diff_content=False):
+        if id not in self.revision_records:
+            return None
+        return self.create_revision(id, load_diff_content)
+
+    def iter_all_revisions(self, load_diff_content=False):
+        for revision_id in sorted(self.revision_records.keys()):
+            yield self.create_revision(revision_id, load_diff_content)
+
+    def get_due_key_lists(self, include_hidden):
+        if include_hidden:
+            return [self.due_keys, self.hidden_due_keys]
+        return [self.due_keys]
+
+    # (scheduled_date, id) of the revisions due by date, after after, in
+    # order
+    def iter_due_order_keys(self, date, include_hidden, after):
+        ranges = []
+        for keys in self.get_due_key_lists(include_hidden):
+            start = 0
+            if after is not None:
+                start = bisect.bisect_right(keys, tuple(after))
+            end = bisect.bisect_right(keys, (date, sys.maxint))
+            ranges.append(itertools.imap(keys.__getitem__,
+                                         xrange(start, end)))
+        return heapq.merge(*ranges)
+
+    def iter_revisions_scheduled_before(self, date, include_hidden=False,
+                                        load_diff_content=False,
+                                        limit=None, after=None):
+        keys = self.iter_due_order_keys(date, include_hidden, after)
+        if limit is not None:
+            keys = itertools.islice(keys, limit)
+
+        # taken before the caller reschedules any of the revisions
+        for scheduled_date, revision_id in list(keys):
+            yield self.create_revision(revision_id, load_diff_content)
+
+    def count_revisions_scheduled_before(self, date, include_hidden=False):
+        return sum([bisect.bisect_right(keys, (date, sys.maxint)) \
+                        for keys in self.get_due_key_lists(include_hidden)])
+
+    def iter_revisions_for_document_path_sorted(self, doc_relative_path,
+                                                load_diff_content=True):
+        for revision_id in \
+                list(self.revision_ids_by_document.get(doc_relative_path, [])):
+            yield self.create_revision(revision_id, load_diff_content)
+
+    def get_previous_revision(self, rev, distance=1):
+        ids = self.revision_ids_by_document.get(rev.document_relative_path, [])
+        position = self.count_previous_revisions(rev)
+        if position < distance:
+            return None
+        return self.create_revision(ids[position-distance], False)
+
+    def get_next_revision(self, rev):
+        ids = self.revision_ids_by_document.get(rev.document_relative_path, [])
+        position = bisect.bisect_right(\
+                            self.get_datetimes(rev.document_relative_path),
+                            rev.datetime_diffed_on)
+        if position == len(ids):
+            return None
+        return self.create_revision(ids[position], False)
+
+    def count_previous_revisions(self, rev):
+        return bisect.bisect_left(\
+                            self.get_datetimes(rev.document_relative_path),
+                            rev.datetime_diffed_on)
+
+    def get_revision_as_of(self, doc_relative_path, dt):
+        ids = self.revision_ids_by_document.get(doc_relative_path, [])
+        position = bisect.bisect_right(self.get_datetimes(doc_relative_path),
+                                       dt)
+        if position == 0:
+            return None
+        return self.create_revision(ids[position-1], False)
+
+    def get_delta_base_id(self, rev):
+        return self.delta_bases.get(rev.id)
+
+    def remove_delta_base(self, revision_id):
+        base_revision_id = self.pop_entry(self.delta_bases, revision_id)
+        if base_revision_id is not None:
+            dependent_ids = self.delta_dependents[base_revision_id]
+            self.discard_member(dependent_ids, revision_id)
+            if not dependent_ids:
+                self.pop_entry(self.delta_dependents, base_revision_id)
+
+    def set_delta_base(self, rev, base_revision_id):
+        self.remove_delta_base(rev.id)
+        if base_revision_id is not None:
+            self.set_entry(self.delta_bases, rev.id, base_revision_id)
+            self.add_member(self.get_or_add_entry(self.delta_dependents,
+                                                  base_revision_id, set()),
+                            rev.id)
+
+    def get_delta_dependent_ids(self, rev):
+        return sorted(self.delta_dependents.get(rev.id, ()))
+
+    def load_revision_table(self):
+        table = RevisionTable()
+        for revision_id in sorted(self.revision_records.keys()):
+            record = self.revision_records[revision_id]
+            table.append(record[0], record[1],
+                         date_to_epoch_day(record[3]), record[4], record[5])
+        return table
+
+    ##############
+    # Payloads
+
+    def has_payload(self, rev, filename):
+        return (rev.id, filename) in self.payloads
+
+    # hashing doesn't cost a disk access here
+    def get_payload_hash(self, rev, filename):
+        data = self.payloads.get((rev.id, filename))
+        if data is None:
+            return None
+        return hash_data(data)
+
+    def read_payload(self, rev, filename):
+        try:
+            return self.payloads[(rev.id, filename)]
+        except KeyError:
+            raise IOError("No payload %s for revision %s" % (filename, rev.id))
+
+    def write_payload(self, rev, filename, data):
+        self.set_entry(self.payloads, (rev.id, filename), data)
+
+    def remove_payload(self, rev, filename):
+        self.pop_entry(self.payloads, (rev.id, filename))
+
+    ##############
+    # Documents
+
+    def get_document_heads(self):
+        return dict([(path, head) for path, head in self.documents.iteritems()\
+                        if head is not None])
+
+    def get_document_head(self, doc_relative_path):
+        return self.documents.get(doc_relative_path)
+
+    def update_document_head(self, doc_relative_path, revision_id,
+                                datetime_diffed_on, content_hash):
+        head = self.documents.get(doc_relative_path)
+        if head is None or head.datetime_diffed_on <= datetime_diffed_on:
+            self.set_entry(self.documents, doc_relative_path,
+                    DocumentHead(revision_id, datetime_diffed_on, content_hash))
+
+    def get_all_watched_document_paths(self):
+        return sorted(self.documents.keys())
+
+    def get_ignored_document_relative_paths(self):
+        return sorted(self.ignored_documents)
+
+    def add_docs_to_watched_list(self, docs_relative_paths):
+        for path in docs_relative_paths:
+            if path not in self.documents:
+                self.set_entry(self.documents, path, None)
+
+    def add_docs_to_ignored_list(self, docs_relative_paths):
+        for path in docs_relative_paths:
+            self.add_member(self.ignored_documents, path)
+
+###################
+# tests
+
+def setup_memory_storage():
+    from core.storage import mock_config
+    return MemoryStorage(mock_config("/nonexistent"))
+
+def test_memory_storage_revisions_and_deltas():
+    import datetime
+
+    storage = setup_memory_storage()
+    storage.config.delta_keyframe_interval = 3
+
+    start = datetime.datetime(2012, 1, 1, 10)
+    for i in range(5):
+        r = Revision(storage)
+        r.document_relative_path = "mynotes.txt"
+        r.datetime_diffed_on = start + datetime.timedelta(minutes=i)
+        r.scheduled_date = datetime.date(2012, 1, 3)
+        r.num_revisions_done = 0
+        r.content = u"line\n" * (i+1)
+        r.changelist = u"%d" % (i,)
+        r.perform_insert()
+
+    revs = storage.get_revisions_for_document_path_sorted("mynotes.txt")
+    assert [r.content for r in revs] == [u"line\n" * (i+1) for i in range(5)]
+    assert revs[4].has_file("content.delta")
+    # 2 revisions after the keyframe, so against the keyframe itself
+    assert revs[2].get_delta_base().id == revs[0].id
+    assert storage.get_delta_dependent_ids(revs[0]) == [revs[2].id]
+    assert storage.get_document_text_at("mynotes.txt",
+                    start + datetime.timedelta(minutes=2, seconds=30)) == \
+                u"line\n" * 3
+    assert storage.get_document_text_at("mynotes.txt", start) == u"line\n"
+    assert storage.get_document_text_at("mynotes.txt",
+                    start - datetime.timedelta(seconds=1)) is None
+    assert revs[3].count_previous_revisions() == 3
+    assert revs[3].get_next_revision().id == revs[4].id
+    assert revs[0].get_previous_revision() is None
+
+    head = storage.get_document_head("mynotes.txt")
+    assert head.revision_id == revs[4].id
+    assert head.content_hash == hash_data((u"line\n" * 5).encode("utf-8"))
+
+    revs[1].set_hidden_state(True)
+    revs[2].update_scheduled_date(datetime.date(2012, 2, 1),
+                                  update_num_revisions=True)
+    due = list(Revision.iter_all_revisions_scheduled_before(storage,
+                                            datetime.date(2012, 1, 3)))
+    assert [r.id for r in due] == [revs[0].id, revs[3].id, revs[4].id]
+    page = Revision.get_all_revisions_scheduled_before(storage,
+                    datetime.date(2012, 1, 3), limit=2,
+                    after=due[0].get_due_order_key())
+    assert [r.id for r in page] == [revs[3].id, revs[4].id]
+    assert storage.count_revisions_scheduled_before(\
+                                datetime.date(2012, 1, 3)) == 3
+    due = list(Revision.iter_all_revisions_scheduled_before(storage,
+                            datetime.date(2012, 1, 3), include_hidden=True))
+    assert [r.id for r in due] == [revs[i].id for i in (0, 1, 3, 4)]
+    assert storage.count_revisions_scheduled_before(\
+                    datetime.date(2012, 2, 1), include_hidden=True) == 5
+    assert storage.load_revision_table().count_by_num_revisions_done() == [5]
+
+    # a failed transaction leaves nothing behind
+    try:
+        with storage.transaction():
+            revs[0].set_hidden_state(True)
+            raise ValueError()
+    except ValueError:
+        pass
+    assert not Revision.get_revision_from_id(storage, revs[0].id).hidden
+
+    # histories stay sorted through deletes and late inserts
+    revs[4].perform_delete()
+    assert revs[3].get_next_revision() is None
+    assert storage.get_delta_dependent_ids(revs[3]) == []
+    late = Revision(storage)
+    late.document_relative_path = "mynotes.txt"
+    late.datetime_diffed_on = start + datetime.timedelta(seconds=90)
+    late.scheduled_date = datetime.date(2012, 1, 3)
+    late.num_revisions_done = 0
+    late.perform_insert(no_content=True)
+    assert [r.id for r in storage.get_revisions_for_document_path_sorted(\
+                    "mynotes.txt", load_diff_content=False)] == \
+                [revs[0].id, revs[1].id, late.id, revs[2].id, revs[3].id]
+    assert late.count_previous_revisions() == 2
+    assert [r.id for r in Revision.iter_all_revisions_scheduled_before(\
+                    storage, datetime.date(2012, 1, 3))] == \
+                [revs[0].id, revs[3].id, late.id]
+
+def test_memory_storage_rollback_undoes_every_change():
+    import copy, datetime
+
+    storage = setup_memory_storage()
+    storage.config.delta_keyframe_interval = 3
+    storage.add_docs_to_watched_list(["mynotes.txt"])
+
+    start = datetime.datetime(2012, 1, 1, 10)
+    def insert(path, i):
+        r = Revision(storage)
+        r.document_relative_path = path
+        r.datetime_diffed_on = start + datetime.timedelta(minutes=i)
+        r.scheduled_date = datetime.date(2012, 1, 3)
+        r.num_revisions_done = 0
+        r.content = u"line\n" * (i+1)
+        r.changelist = u"%d" % (i,)
+        r.perform_insert()
+        return r
+
+    for i in range(4):
+        insert("mynotes.txt", i)
+    revs = storage.get_revisions_for_document_path_sorted("mynotes.txt")
+
+    attributes = ['next_revision_id', 'revision_records',
+                  'revision_ids_by_document', 'revision_datetimes_by_document',
+                  'due_keys', 'hidden_due_keys', 'payloads', 'documents',
+                  'ignored_documents', 'delta_bases', 'delta_dependents']
+    before = copy.deepcopy([getattr(storage, a) for a in attributes])
+
+    try:
+        with storage.transaction():
+            insert("other.txt", 10)
+            insert("mynotes.txt", 10)
+            revs[1].perform_delete()
+            revs[2].set_hidden_state(True)
+            revs[3].update_scheduled_date(datetime.date(2012, 2, 1),
+                                          update_num_revisions=True)
+            storage.add_docs_to_watched_list(["other.txt"])
+            storage.add_docs_to_ignored_list(["ignored.txt"])
+            raise ValueError()
+    except ValueError:
+        pass
+
+    assert [getattr(storage, a) for a in attributes] == before
+    assert storage.undo_log is None
+    assert [r.content for r in storage.get_revisions_for_document_path_sorted(\
+                    "mynotes.txt")] == [u"line\n" * (i+1) for i in range(4)]
+
+def test_diff_runner_on_memory_storage():
+    import tempfile, shutil, time
+    from core.storage import write_test_file
+    from diffing.diff_runner import DiffRunner
+    from diffing.changelist import Changelist
+    from scheduling.fixed_scheduler import FixedScheduler
+
+    notes_dir = tempfile.mkdtemp()
+    storage = setup_memory_storage()
+    storage.config.notes_directory = notes_dir
+
+    notes_path = os.path.join(notes_dir, "notes1.txt")
+    write_test_file(notes_path, "First\nsecond")
+    storage.add_docs_to_watched_list(["notes1.txt"])
+
+    diffrunner = DiffRunner(storage.config,
+                            scheduler_getter=lambda x: FixedScheduler(),
+                            store=storage)
+    diffrunner.scan_files_for_changes()
+
+    write_test_file(notes_path, "First\nsecond\nthird")
+    future = time.time() + 60
+    os.utime(notes_path, (future, future))
+    diffrunner.scan_files_for_changes()
+
+    revs = storage.get_revisions_for_document_path_sorted("notes1.txt")
+    assert len(revs) == 2
+    assert revs[1].changelist == Changelist([(2, 3)])
+
+    shutil.rmtree(notes_dir)
+
+if __name__ == '__main__':
+    test_memory_storage_revisions_and_deltas()
+    test_memory_storage_rollback_undoes_every_change()
+    test_diff_runner_on_memory_storage()
@@ -29,7 +29,10 @@ def get_unfiltered_document_paths(config):
                 recognized_files.append(f)
     return recognized_files
 
+# keeps the order of minuend; subtrahend is turned into a set, so this stays
+# linear with many notes
 def list_minus_list(minuend, subtrahend):
+    subtrahend = set(subtrahend)
     ret = []
     for el in minuend:
         if not el in subtrahend:
@@ -0,0 +1,264 @@
+# This file is part of python-diffrevision
+# Copyright (C) 2011 Francois Savard 
+#
+# python-diffrevision is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-diffrevision is distributed in the hope that
+# it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-diffrevision (see license.txt)
+# If not, see <http://www.gnu.org/licenses/>.
+
+# Payloads of "cold" revisions (see core/tiering.py), appended to a few large
+# pack files under packs/ instead of one directory and a few files per
+# revision.
+#
+# Packs are only ever appended to. Each entry is
+#     revision id (4 bytes) + data length (4 bytes) + filename length
+#     (2 bytes), big endian, + filename + compressed data
+# so a pack can be read without the db if need be, and the pack_entries
+# table indexes where each payload's data starts. Pack files are memory
+# mapped for reading.
+#
+# Entries removed (revision deleted, payload rewritten elsewhere) stay in
+# their pack until it's repacked (see tiering.repack_sparse_packs).
+#
+# Same interface as BlobStore, and same rule: nothing is committed here.
+
+import os, sys
+import re
+import mmap
+import struct
+import threading
+
+if __name__ == '__main__':
+    # otw when running tests we can't import other modules
+    this_files_path = os.path.split(os.path.abspath(__file__))[0]
+    sys.path.append(os.path.join(this_files_path,".."))
+
+PACKS_DIRNAME = 'packs'
+
+PACK_ENTRIES_TABLE_NAME = 'pack_entries'
+PACK_ENTRIES_BY_PACK_INDEX_NAME = 'pack_entries_by_pack'
+
+CREATE_PACK_ENTRIES_TABLE_STATEMENT = \
+    "create table if not exists "+PACK_ENTRIES_TABLE_NAME+"("+\
+                            "revision_id integer not null,"+\
+                            "filename varchar(64) not null,"+\
+                            "pack_id integer not null,"+\
+                            "offset integer not null,"+\
+                            "length integer not null,"+\
+                            "PRIMARY KEY (revision_id, filename))"
+
+ENTRY_HEADER_FORMAT = '>IIH'
+ENTRY_HEADER_SIZE = struct.calcsize(ENTRY_HEADER_FORMAT)
+
+PACK_FILENAME_FORMAT = "pack-%06d.pack"
+PACK_FILENAME_REGEX = re.compile(r"^pack-(\d+)\.pack$")
+
+DEFAULT_MAX_PACK_BYTES = 64 * 1024 * 1024
+
+class PackStore(object):
+    def __init__(self, storage):
+        self.storage = storage
+
+        self.packs_abspath = \
+            os.path.join(storage.config.diffrevision_base_directory,
+                            PACKS_DIRNAME)
+
+        # pack appended to, see get_pack_to_append_to
+        self.current_pack_id = None
+
+        # read-only maps by pack id, remapped when the pack has grown
+        self.maps = {}
+        self.lock = threading.Lock()
+
+    def create_tables(self):
+        self.storage.db_cursor.execute(CREATE_PACK_ENTRIES_TABLE_STATEMENT)
+        self.storage.db_cursor.execute("CREATE INDEX IF NOT EXISTS "+\
+                    PACK_ENTRIES_BY_PACK_INDEX_NAME+\
+                    " ON "+PACK_ENTRIES_TABLE_NAME+" (pack_id)")
+
+    def get_pack_path(self, pack_id):
+        return os.path.join(self.packs_abspath, PACK_FILENAME_FORMAT % pack_id)
+
+    def get_pack_ids(self):
+        if not os.path.isdir(self.packs_abspath):
+            return []
+        pack_ids = []
+        for name in os.listdir(self.packs_abspath):
+            match = PACK_FILENAME_REGEX.match(name)
+            if match:
+                pack_ids.append(int(match.group(1)))
+        return sorted(pack_ids)
+
+    # the latest pack, or a new one once it's full
+    def get_pack_to_append_to(self):
+        if self.current_pack_id is None:
+            pack_ids = self.get_pack_ids()
+            self.current_pack_id = pack_ids[-1] if pack_ids else 1
+
+        max_bytes = getattr(self.storage.config, 'pack_max_bytes',
+                            DEFAULT_MAX_PACK_BYTES)
+        pack_path = self.get_pack_path(self.current_pack_id)
+        if os.path.exists(pack_path) and \
+                os.path.getsize(pack_path) >= max_bytes:
+            self.current_pack_id += 1
+
+        return self.current_pack_id
+
+    # later writes go to a new pack (see tiering.repack_sparse_packs)
+    def start_new_pack(self):
+        pack_ids = self.get_pack_ids()
+        self.current_pack_id = (pack_ids[-1] + 1) if pack_ids else 1
+
+    def get_entry(self, revision_id, filename):
+        self.storage.db_cursor.execute("SELECT pack_id, offset, length"+\
+                                " FROM "+PACK_ENTRIES_TABLE_NAME+\
+                                " WHERE revision_id=? AND filename=?;",
+                                (revision_id, filename))
+        return self.storage.db_cursor.fetchone()
+
+    def contains(self, revision_id, filename):
+        return self.get_entry(revision_id, filename) is not None
+
+    # the stored (compressed) bytes of an entry
+    def read_entry(self, pack_id, offset, length):
+        with self.lock:
+            pack_map = self.maps.get(pack_id)
+            if pack_map is None or offset + length > len(pack_map):
+                if pack_map is not None:
+                    pack_map.close()
+                f = open(self.get_pack_path(pack_id), "rb")
+                try:
+                    pack_map = mmap.mmap(f.fileno(), 0,
+                                         access=mmap.ACCESS_READ)
+                finally:
+                    f.close()
+                self.maps[pack_id] = pack_map
+
+            if offset + length > len(pack_map):
+                raise IOError("Pack %d is truncated" % (pack_id,))
+            return pack_map[offset:offset+length]
+
+    def read(self, revision_id, filename):
+        entry = self.get_entry(revision_id, filename)
+        if entry is None:
+            return None
+        return self.storage.payload_dictionaries.decompress(\
+                                            self.read_entry(*entry))
+
+    # appends already compressed bytes, returns (pack id, offset of the
+    # data)
+    def append_entry(self, revision_id, filename, stored):
+        pack_id = self.get_pack_to_append_to()
+
+        filename = str(filename)
+        entry_offset = self.storage.append_payload_file(\
+                self.get_pack_path(pack_id),
+                struct.pack(ENTRY_HEADER_FORMAT, revision_id, len(stored),
+                            len(filename)) + filename + stored)
+
+        return pack_id, entry_offset + ENTRY_HEADER_SIZE + len(filename)
+
+    def set_entry(self, revision_id, filename, pack_id, offset, length):
+        self.storage.db_cursor.execute(\
+                'INSERT OR REPLACE INTO '+PACK_ENTRIES_TABLE_NAME+\
+                ' (revision_id, filename, pack_id, offset, length)'+\
+                ' VALUES (?, ?, ?, ?, ?)',
+                    (revision_id, filename, pack_id, offset, length))
+
+    def write(self, revision_id, filename, data):
+        stored = self.storage.payload_dictionaries.compress(data)
+        pack_id, offset = self.append_entry(revision_id, filename, stored)
+        self.set_entry(revision_id, filename, pack_id, offset, len(stored))
+
+    def remove(self, revision_id, filename):
+        self.storage.db_cursor.execute(\
+                'DELETE FROM '+PACK_ENTRIES_TABLE_NAME+\
+                ' WHERE revision_id=? AND filename=?',
+                    (revision_id, filename))
+
+    # the first size bytes of the data of each entry still indexed, e.g. to
+    # find the dictionaries they use (see PayloadDictionaries.remove_unused)
+    def iter_entry_prefixes(self, size):
+        for pack_id, offset, length in self.storage.iter_rows(\
+                "SELECT pack_id, offset, length"+\
+                " FROM "+PACK_ENTRIES_TABLE_NAME+";"):
+            yield self.read_entry(pack_id, offset, min(length, size))
+
+    # size of the entries still indexed in a pack
+    def get_live_bytes(self, pack_id):
+        self.storage.db_cursor.execute(\
+                "SELECT COALESCE(SUM(length + ? + length(filename)), 0)"+\
+                " FROM "+PACK_ENTRIES_TABLE_NAME+" WHERE pack_id=?;",
+                (ENTRY_HEADER_SIZE, pack_id))
+        return self.storage.db_cursor.fetchone()[0]
+
+    def remove_pack_file(self, pack_id):
+        with self.lock:
+            pack_map = self.maps.pop(pack_id, None)
+            if pack_map is not None:
+                pack_map.close()
+        pack_path = self.get_pack_path(pack_id)
+        if os.path.exists(pack_path):
+            os.remove(pack_path)
+
+    def close(self):
+        with self.lock:
+            for pack_map in self.maps.values():
+                pack_map.close()
+            self.maps.clear()
+
+###################
+# tests
+
+def test_pack_store_append_read_remove():
+    from core.storage import setup_temp_db, teardown_temp_db
+
+    storage = setup_temp_db()
+    storage.config.pack_max_bytes = 20
+    packs = storage.pack_store
+
+    text = u"Some note\n\xe9t\xe9\n".encode("utf-8") * 50
+
+    packs.write(1, "content.txt", text)
+    packs.write(1, "changelist.bin", "CL\x01\x00")
+    assert packs.contains(1, "content.txt")
+    assert not packs.contains(2, "content.txt")
+    assert packs.read(1, "content.txt") == text
+    assert packs.read(1, "changelist.bin") == "CL\x01\x00"
+
+    # the first pack is full, and the map of the second one grows
+    assert packs.get_pack_ids() == [1, 2]
+    packs.write(2, "content.txt", "second")
+    assert packs.read(2, "content.txt") == "second"
+    assert packs.read(1, "changelist.bin") == "CL\x01\x00"
+
+    # entries can be found without the index
+    pack_id, offset, length = packs.get_entry(1, "content.txt")
+    f = open(packs.get_pack_path(pack_id), "rb")
+    revision_id, data_length, filename_length = struct.unpack(\
+                    ENTRY_HEADER_FORMAT, f.read(ENTRY_HEADER_SIZE))
+    assert (revision_id, f.read(filename_length)) == (1, "content.txt")
+    assert data_length == length
+    f.close()
+
+    live_bytes = packs.get_live_bytes(1)
+    assert live_bytes == os.path.getsize(packs.get_pack_path(1))
+    packs.remove(1, "content.txt")
+    assert packs.read(1, "content.txt") is None
+    assert packs.get_live_bytes(1) < live_bytes
+
+    teardown_temp_db(storage)
+
+if __name__ == '__main__':
+    test_pack_store_append_read_remove()
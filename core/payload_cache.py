@@ -0,0 +1,138 @@
+# This file is part of python-diffrevision
+# Copyright (C) 2011 Francois Savard 
+#
+# python-diffrevision is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-diffrevision is distributed in the hope that
+# it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-diffrevision (see license.txt)
+# If not, see <http://www.gnu.org/licenses/>.
+
+# LRU cache of revision payloads (the raw bytes of content, changelist...),
+# keyed by (revision id, payload filename), bounded by the total size of
+# the payloads it holds.
+#
+# Storage keeps one, used by Revision.get_file_bytes, so a revision loaded
+# several times in a session (e.g. by the local server) is only read once.
+# Revision.set_file_bytes and remove_file invalidate the entries they
+# change. The hits and misses counters help choosing 'payload_cache_bytes'.
+
+import threading
+from collections import OrderedDict
+
+DEFAULT_MAX_BYTES = 8 * 1024 * 1024
+
+class PayloadCache(object):
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+
+        # least recently used first
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+
+        # the local server uses the same Storage from several threads
+        self.lock = threading.Lock()
+
+    def get(self, revision_id, filename):
+        key = (revision_id, filename)
+        with self.lock:
+            data = self.entries.pop(key, None)
+            if data is None:
+                self.misses += 1
+                return None
+
+            # move to the most recently used end
+            self.entries[key] = data
+            self.hits += 1
+            return data
+
+    # doesn't count as a hit or a miss, nor makes the entry more recent
+    def contains(self, revision_id, filename):
+        with self.lock:
+            return (revision_id, filename) in self.entries
+
+    def put(self, revision_id, filename, data):
+        # payloads larger than the whole cache aren't worth evicting for
+        if len(data) > self.max_bytes:
+            return
+
+        key = (revision_id, filename)
+        with self.lock:
+            old_data = self.entries.pop(key, None)
+            if old_data is not None:
+                self.num_bytes -= len(old_data)
+
+            self.entries[key] = data
+            self.num_bytes += len(data)
+
+            while self.num_bytes > self.max_bytes:
+                evicted_key, evicted_data = self.entries.popitem(last=False)
+                self.num_bytes -= len(evicted_data)
+
+    def invalidate(self, revision_id, filename):
+        key = (revision_id, filename)
+        with self.lock:
+            data = self.entries.pop(key, None)
+            if data is not None:
+                self.num_bytes -= len(data)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.num_bytes = 0
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_ratio': (float(self.hits) / lookups) if lookups else 0.0,
+                    'entries': len(self.entries),
+                    'bytes': self.num_bytes,
+                    'max_bytes': self.max_bytes}
+
+###################
+# tests
+
+def test_payload_cache_lru_by_bytes():
+    cache = PayloadCache(max_bytes=10)
+
+    cache.put(1, "content.txt", "aaaa")
+    cache.put(2, "content.txt", "bbbb")
+
+    assert cache.get(1, "content.txt") == "aaaa"
+    assert cache.get(3, "content.txt") is None
+
+    # 1 was used more recently than 2, so 2 goes
+    cache.put(3, "content.txt", "cccc")
+    assert cache.get(2, "content.txt") is None
+    assert cache.get(1, "content.txt") == "aaaa"
+    assert cache.num_bytes == 8
+
+    # too big to be cached at all
+    cache.put(4, "content.txt", "d" * 11)
+    assert cache.get(4, "content.txt") is None
+
+    cache.invalidate(1, "content.txt")
+    assert cache.get(1, "content.txt") is None
+    assert cache.num_bytes == 4
+
+    stats = cache.get_stats()
+    assert stats['hits'] == 2
+    assert stats['misses'] == 4
+    assert stats['entries'] == 1
+
+if __name__ == '__main__':
+    test_payload_cache_lru_by_bytes()
@@ -0,0 +1,453 @@
+# This file is part of python-diffrevision
+# Copyright (C) 2011 Francois Savard 
+#
+# python-diffrevision is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-diffrevision is distributed in the hope that
+# it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-diffrevision (see license.txt)
+# If not, see <http://www.gnu.org/licenses/>.
+
+# Compression of the payloads of the 'payloads' table (see payload_table.py)
+# against a dictionary trained on the notes, with payload_compression =
+# 'dictionary' in the config.
+#
+# Notes are short and look alike (same markup, same headings, same
+# templates), and a short text compressed on its own doesn't find much to
+# refer back to. With a dictionary of the strings common to the notes
+# placed "before" each payload, deflate can refer to them from the first
+# byte.
+#
+# Python 2's zlib has no preset dictionary (zdict) parameter, so it's
+# emulated: a raw deflate compressor is fed the dictionary and sync-flushed
+# once, then copied for each payload, so only the output which follows the
+# dictionary is stored. Decompression replays the same way with a
+# decompressor which already went through the compressed dictionary.
+#
+# Dictionaries are kept in the payload_dictionaries table, and payloads
+# record the id of the one they were compressed with:
+#     'ZD' + dictionary id (4 bytes, big endian) + raw deflate data
+# Other payloads are plain zlib streams (which never start with 'Z'). New
+# dictionaries are trained from time to time as the notes change (see
+# 'payload_dictionary_rotation_days'), old ones are kept as long as payloads
+# use them ('convert_storage' recompresses everything with the current one,
+# 'compact' removes the ones not used anymore).
+#
+# Payload files and blobs are stored as they are, so dictionaries are only
+# used with payload_storage = 'sqlite', for the payloads table and the packs
+# 'tier' moves payloads to. With the other values, packed payloads are
+# compressed with plain zlib, and no dictionary is trained.
+
+import os, sys
+import zlib
+import struct
+import random
+import datetime
+import threading
+import sqlite3
+
+if __name__ == '__main__':
+    # otw when running tests we can't import other modules
+    this_files_path = os.path.split(os.path.abspath(__file__))[0]
+    sys.path.append(os.path.join(this_files_path,".."))
+
+PAYLOAD_DICTIONARIES_TABLE_NAME = 'payload_dictionaries'
+
+CREATE_PAYLOAD_DICTIONARIES_TABLE_STATEMENT = \
+    "create table if not exists "+PAYLOAD_DICTIONARIES_TABLE_NAME+"("+\
+                            "id integer primary key autoincrement,"+\
+                            "created_on timestamp not null,"+\
+                            "data blob not null)"
+
+# one row per training, whether its dictionary was kept or not (then
+# dictionary_id is NULL), see needs_rotation
+PAYLOAD_DICTIONARY_TRAININGS_TABLE_NAME = 'payload_dictionary_trainings'
+
+CREATE_PAYLOAD_DICTIONARY_TRAININGS_TABLE_STATEMENT = \
+    "create table if not exists "+PAYLOAD_DICTIONARY_TRAININGS_TABLE_NAME+"("+\
+                            "trained_on timestamp not null,"+\
+                            "dictionary_id integer)"
+
+# values for the 'payload_compression' config option
+PAYLOAD_COMPRESSION_ZLIB = 'zlib'
+PAYLOAD_COMPRESSION_DICTIONARY = 'dictionary'
+
+DICTIONARY_MAGIC = 'ZD'
+DICTIONARY_HEADER_SIZE = len(DICTIONARY_MAGIC) + 4
+
+# deflate only refers back 32KB, and payloads should be able to refer to
+# the whole dictionary
+DEFAULT_DICTIONARY_SIZE = 16 * 1024
+DEFAULT_SAMPLE_DOCUMENTS = 500
+DEFAULT_ROTATION_DAYS = 30
+
+# lines shorter than that aren't worth a back-reference
+MIN_LINE_LENGTH = 8
+
+# Builds a dictionary from sample texts (bytes): the lines found in more
+# than one sample, the most common last, since deflate encodes the closest
+# back-references in fewer bits.
+def train_dictionary(samples, max_size=DEFAULT_DICTIONARY_SIZE):
+    document_frequency = {}
+    for sample in samples:
+        for line in set(sample.splitlines(True)):
+            if len(line.strip()) >= MIN_LINE_LENGTH:
+                document_frequency[line] = \
+                                document_frequency.get(line, 0) + 1
+
+    common = [(frequency * len(line), line) for line, frequency \
+                in document_frequency.iteritems() if frequency > 1]
+    common.sort(reverse=True)
+
+    chosen = []
+    size = 0
+    for score, line in common:
+        if size + len(line) > max_size:
+            continue
+        chosen.append(line)
+        size += len(line)
+
+    chosen.sort(key=lambda line: (document_frequency[line], line))
+    return "".join(chosen)
+
+# id of the dictionary compressed data (or at least its first
+# DICTIONARY_HEADER_SIZE bytes) was compressed with, None for plain zlib
+def get_dictionary_id(data):
+    if not data.startswith(DICTIONARY_MAGIC):
+        return None
+    return struct.unpack('>I',
+                    data[len(DICTIONARY_MAGIC):DICTIONARY_HEADER_SIZE])[0]
+
+# Compressor and decompressor states right after the dictionary.
+class DictionaryCodec(object):
+    def __init__(self, dictionary):
+        self.compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        prefix = self.compressor.compress(dictionary) + \
+                    self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.decompressor.decompress(prefix)
+
+    def compress(self, data):
+        compressor = self.compressor.copy()
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data):
+        decompressor = self.decompressor.copy()
+        return decompressor.decompress(data) + decompressor.flush()
+
+class PayloadDictionaries(object):
+    def __init__(self, storage):
+        self.storage = storage
+
+        # DictionaryCodec by dictionary id; the local server uses the same
+        # Storage from several threads
+        self.codecs = {}
+        self.lock = threading.Lock()
+
+    def create_tables(self):
+        self.storage.db_cursor.execute(\
+                    CREATE_PAYLOAD_DICTIONARIES_TABLE_STATEMENT)
+
+    def create_trainings_table(self):
+        self.storage.db_cursor.execute(\
+                    CREATE_PAYLOAD_DICTIONARY_TRAININGS_TABLE_STATEMENT)
+
+    # whether payload_compression = 'dictionary' is set
+    def is_requested(self):
+        return getattr(self.storage.config, 'payload_compression',
+                    PAYLOAD_COMPRESSION_ZLIB) == PAYLOAD_COMPRESSION_DICTIONARY
+
+    # whether new payloads are compressed with a dictionary, see the top of
+    # the file
+    def is_enabled(self):
+        # imported here, storage imports this module
+        from core.storage import PAYLOAD_STORAGE_SQLITE
+
+        return self.is_requested() and \
+                self.storage.get_payload_storage() == PAYLOAD_STORAGE_SQLITE
+
+    # (id, created_on) of the latest dictionary, or None
+    def get_current(self):
+        self.storage.db_cursor.execute("SELECT id, created_on"+\
+                " FROM "+PAYLOAD_DICTIONARIES_TABLE_NAME+\
+                " ORDER BY id DESC LIMIT 1;")
+        return self.storage.db_cursor.fetchone()
+
+    def get_codec(self, dictionary_id):
+        with self.lock:
+            codec = self.codecs.get(dictionary_id)
+        if codec is not None:
+            return codec
+
+        self.storage.db_cursor.execute("SELECT data"+\
+                " FROM "+PAYLOAD_DICTIONARIES_TABLE_NAME+" WHERE id=?;",
+                (dictionary_id,))
+        row = self.storage.db_cursor.fetchone()
+        if row is None:
+            raise IOError("No payload dictionary %d" % (dictionary_id,))
+
+        codec = DictionaryCodec(str(row[0]))
+        with self.lock:
+            self.codecs[dictionary_id] = codec
+        return codec
+
+    def add(self, dictionary):
+        self.storage.db_cursor.execute(\
+                'INSERT INTO '+PAYLOAD_DICTIONARIES_TABLE_NAME+\
+                ' (created_on, data) VALUES (?, ?)',
+                    (datetime.datetime.now(), sqlite3.Binary(dictionary)))
+        return self.storage.db_cursor.lastrowid
+
+    def compress_with(self, dictionary_id, data):
+        return DICTIONARY_MAGIC + struct.pack('>I', dictionary_id) + \
+                    self.get_codec(dictionary_id).compress(data)
+
+    def compress(self, data):
+        current = self.get_current() if self.is_enabled() else None
+        if current is None:
+            return zlib.compress(data)
+        return self.compress_with(current[0], data)
+
+    # data may be a BLOB column value
+    def decompress(self, data):
+        data = str(data)
+        dictionary_id = get_dictionary_id(data)
+        if dictionary_id is None:
+            return zlib.decompress(data)
+
+        return self.get_codec(dictionary_id).decompress(\
+                                        data[DICTIONARY_HEADER_SIZE:])
+
+    # Content of the latest revision of up to num_documents documents,
+    # picked at random.
+    def get_samples(self, num_documents=DEFAULT_SAMPLE_DOCUMENTS):
+        # imported here, storage imports this module
+        from core.storage import REVISION_CONTENT_FILENAME
+
+        heads = self.storage.get_document_heads().values()
+        random.shuffle(heads)
+
+        samples = []
+        for head in heads[:num_documents]:
+            rev = self.storage.get_revision_from_id(head.revision_id)
+            if rev is not None:
+                samples.append(rev.content.encode(\
+                                    self.storage.config.notes_codec))
+        return samples
+
+    # Trains a dictionary on samples, and adds it if it compresses them
+    # better than the current one (the notes may not have changed much since
+    # the last one). Returns (new dictionary id or None, compressed size of
+    # the samples with the current dictionary or plain zlib, with the new
+    # one).
+    def train(self, samples, max_size=DEFAULT_DICTIONARY_SIZE):
+        current = self.get_current()
+        if current is None:
+            current_size = sum([len(zlib.compress(s)) for s in samples])
+        else:
+            current_size = sum([len(self.compress_with(current[0], s)) \
+                                    for s in samples])
+
+        dictionary = train_dictionary(samples, max_size)
+        codec = DictionaryCodec(dictionary)
+        new_size = sum([DICTIONARY_HEADER_SIZE + len(codec.compress(s)) \
+                            for s in samples])
+
+        dictionary_id = None
+        if dictionary and new_size < current_size:
+            dictionary_id = self.add(dictionary)
+
+        self.storage.db_cursor.execute(\
+                'INSERT INTO '+PAYLOAD_DICTIONARY_TRAININGS_TABLE_NAME+\
+                ' (trained_on, dictionary_id) VALUES (?, ?)',
+                    (datetime.datetime.now(), dictionary_id))
+
+        return dictionary_id, current_size, new_size
+
+    # when a dictionary was last trained, kept or not, or None
+    def get_last_training_date(self):
+        self.storage.db_cursor.execute("SELECT trained_on"+\
+                " FROM "+PAYLOAD_DICTIONARY_TRAININGS_TABLE_NAME+\
+                " ORDER BY trained_on DESC LIMIT 1;")
+        row = self.storage.db_cursor.fetchone()
+        if row is not None:
+            return row[0]
+
+        # dictionaries trained before trainings were recorded
+        current = self.get_current()
+        if current is not None:
+            return current[1]
+        return None
+
+    # True if no dictionary was ever trained, or if the last training is
+    # older than rotation_days. A training which kept the current
+    # dictionary counts, otw the same notes would be trained on again and
+    # again.
+    def needs_rotation(self, rotation_days=DEFAULT_ROTATION_DAYS):
+        last_training_date = self.get_last_training_date()
+        return last_training_date is None or last_training_date < \
+                datetime.datetime.now() - datetime.timedelta(days=rotation_days)
+
+    # Removes the dictionaries no payload uses anymore (in the payloads
+    # table or in the packs), except the current one. Returns the number of
+    # dictionaries removed.
+    def remove_unused(self):
+        # imported here, storage imports this module
+        from core.payload_table import PAYLOADS_TABLE_NAME
+
+        current = self.get_current()
+        if current is None:
+            return 0
+
+        used = set([current[0]])
+        for header, in self.storage.iter_rows(\
+                "SELECT DISTINCT substr(data, 1, ?)"+\
+                " FROM "+PAYLOADS_TABLE_NAME+\
+                " WHERE substr(data, 1, ?) = ?;",
+                (DICTIONARY_HEADER_SIZE, len(DICTIONARY_MAGIC),
+                 sqlite3.Binary(DICTIONARY_MAGIC))):
+            used.add(get_dictionary_id(str(header)))
+
+        for header in self.storage.pack_store.iter_entry_prefixes(\
+                                                DICTIONARY_HEADER_SIZE):
+            dictionary_id = get_dictionary_id(header)
+            if dictionary_id is not None:
+                used.add(dictionary_id)
+
+        self.storage.db_cursor.execute(\
+                "SELECT id FROM "+PAYLOAD_DICTIONARIES_TABLE_NAME+";")
+        unused = [row[0] for row in self.storage.db_cursor.fetchall() \
+                    if row[0] not in used]
+
+        for dictionary_id in unused:
+            self.storage.db_cursor.execute(\
+                    'DELETE FROM '+PAYLOAD_DICTIONARIES_TABLE_NAME+\
+                    ' WHERE id=?', (dictionary_id,))
+            with self.lock:
+                self.codecs.pop(dictionary_id, None)
+
+        return len(unused)
+
+###################
+# tests
+
+def make_test_note(i):
+    return ("+ Meeting notes %d\n" % i +
+            "[category: meetings] [status: open]\n" +
+            "++ Attendees\n * Alice Tremblay\n * Bob Gagnon\n" +
+            "++ Action items\n * follow up on item %d\n" % (i * 7) +
+            "++ Next meeting\n to be scheduled\n")
+
+def test_dictionary_compression_roundtrip_and_rotation():
+    from core.storage import setup_temp_db, teardown_temp_db, \
+                insert_test_revision, PAYLOAD_STORAGE_SQLITE, \
+                PAYLOAD_STORAGE_BLOBS
+
+    storage = setup_temp_db()
+    storage.config.payload_storage = PAYLOAD_STORAGE_SQLITE
+    storage.config.payload_compression = PAYLOAD_COMPRESSION_DICTIONARY
+    dictionaries = storage.payload_dictionaries
+
+    start = datetime.datetime(2012, 1, 1)
+    for i in range(10):
+        insert_test_revision(storage, "notes%d.txt" % i, start,
+                             make_test_note(i).decode("utf-8"))
+
+    # no dictionary yet: plain zlib
+    old = storage.payload_table.read(1, "content.txt")
+    storage.db_cursor.execute("SELECT data FROM payloads LIMIT 1")
+    assert str(storage.db_cursor.fetchone()[0])[:2] != DICTIONARY_MAGIC
+    assert dictionaries.needs_rotation()
+
+    samples = dictionaries.get_samples()
+    assert len(samples) == 10
+    first_id, zlib_size, new_size = dictionaries.train(samples)
+    assert first_id is not None and new_size < zlib_size
+    storage.commit()
+
+    note = make_test_note(99)
+    compressed = dictionaries.compress(note)
+    assert compressed.startswith(DICTIONARY_MAGIC)
+    assert len(compressed) < len(zlib.compress(note))
+    assert dictionaries.decompress(compressed) == note
+    # payloads compressed before the dictionary are still readable
+    assert storage.payload_table.read(1, "content.txt") == old
+
+    # only used with payloads in the db
+    storage.config.payload_storage = PAYLOAD_STORAGE_BLOBS
+    assert dictionaries.is_requested() and not dictionaries.is_enabled()
+    assert not dictionaries.compress(note).startswith(DICTIONARY_MAGIC)
+    storage.config.payload_storage = PAYLOAD_STORAGE_SQLITE
+
+    # the same notes again: the current dictionary is good enough
+    storage.db_cursor.execute("UPDATE "+PAYLOAD_DICTIONARIES_TABLE_NAME+\
+            " SET created_on = ?", (start,))
+    storage.db_cursor.execute("DELETE FROM "+\
+            PAYLOAD_DICTIONARY_TRAININGS_TABLE_NAME)
+    assert dictionaries.needs_rotation()
+    assert dictionaries.train(samples)[0] is None
+    # and isn't trained on again before rotation_days
+    assert not dictionaries.needs_rotation()
+
+    # the notes drift
+    drifted = ["* TODO call the plumber about the leaking faucet\n" +
+               "* TODO renew the passport before the summer trip\n" +
+               "* DONE %d\n" % i for i in range(10)]
+    second_id = dictionaries.train(drifted)[0]
+    assert second_id > first_id
+    assert dictionaries.decompress(compressed) == note
+    assert dictionaries.compress(note)[2:6] == struct.pack('>I', second_id)
+
+    # 'compressed' wasn't stored, so only the current dictionary is used
+    storage.payload_table.write(1, "content.txt", note)
+    assert dictionaries.remove_unused() == 1
+    assert storage.payload_table.read(1, "content.txt") == note
+
+    teardown_temp_db(storage)
+
+def test_dictionaries_of_packed_payloads_kept():
+    from core.storage import setup_temp_db, teardown_temp_db, \
+                PAYLOAD_STORAGE_SQLITE
+
+    storage = setup_temp_db()
+    storage.config.payload_storage = PAYLOAD_STORAGE_SQLITE
+    storage.config.payload_compression = PAYLOAD_COMPRESSION_DICTIONARY
+    dictionaries = storage.payload_dictionaries
+
+    first_id = dictionaries.train([make_test_note(i) for i in range(10)])[0]
+    note = make_test_note(99)
+    storage.payload_table.write(1, "content.txt", note)
+    storage.pack_store.write(2, "content.txt", note)
+    storage.commit()
+
+    # rotated, and the payloads table rewritten
+    drifted = ["* TODO call the plumber about the leaking faucet\n" +
+               "* TODO renew the passport before the summer trip\n" +
+               "* DONE %d\n" % i for i in range(10)]
+    second_id = dictionaries.train(drifted)[0]
+    assert second_id > first_id
+    storage.payload_table.write(1, "content.txt", note)
+
+    # what 'compact' runs: the packed payload still uses the first one
+    assert dictionaries.remove_unused() == 0
+    dictionaries.codecs.clear()
+    assert storage.pack_store.read(2, "content.txt") == note
+
+    storage.pack_store.remove(2, "content.txt")
+    assert dictionaries.remove_unused() == 1
+
+    teardown_temp_db(storage)
+
+if __name__ == '__main__':
+    test_dictionary_compression_roundtrip_and_rotation()
+    test_dictionaries_of_packed_payloads_kept()
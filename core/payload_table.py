@@ -0,0 +1,112 @@
+# This file is part of python-diffrevision
+# Copyright (C) 2011 Francois Savard 
+#
+# python-diffrevision is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-diffrevision is distributed in the hope that
+# it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-diffrevision (see license.txt)
+# If not, see <http://www.gnu.org/licenses/>.
+
+# Revision payloads (content, changelist...) kept as zlib-compressed BLOBs in
+# the 'payloads' table of db.sqlite3, next to the revisions table (see
+# payload_dictionary.py for the compression).
+#
+# Compared to one directory and one file per payload, this saves a mkdir and
+# an open() per payload, and Storage can fetch the revisions and their
+# payloads with a single SELECT (see Storage.get_revision_select_statement).
+#
+# Same interface as BlobStore, and same rule: nothing is committed here.
+
+import os, sys
+import sqlite3
+
+if __name__ == '__main__':
+    # otw when running tests we can't import other modules
+    this_files_path = os.path.split(os.path.abspath(__file__))[0]
+    sys.path.append(os.path.join(this_files_path,".."))
+
+PAYLOADS_TABLE_NAME = 'payloads'
+
+CREATE_PAYLOADS_TABLE_STATEMENT = \
+    "create table if not exists "+PAYLOADS_TABLE_NAME+"("+\
+                            "revision_id integer not null,"+\
+                            "filename varchar(64) not null,"+\
+                            "data blob not null,"+\
+                            "PRIMARY KEY (revision_id, filename))"
+
+class PayloadTable(object):
+    def __init__(self, storage):
+        self.storage = storage
+
+    def create_tables(self):
+        self.storage.db_cursor.execute(CREATE_PAYLOADS_TABLE_STATEMENT)
+
+    def contains(self, revision_id, filename):
+        self.storage.db_cursor.execute("SELECT 1"+\
+                                " FROM "+PAYLOADS_TABLE_NAME+\
+                                " WHERE revision_id=? AND filename=?;",
+                                (revision_id, filename))
+        return self.storage.db_cursor.fetchone() is not None
+
+    def read(self, revision_id, filename):
+        self.storage.db_cursor.execute("SELECT data"+\
+                                " FROM "+PAYLOADS_TABLE_NAME+\
+                                " WHERE revision_id=? AND filename=?;",
+                                (revision_id, filename))
+        row = self.storage.db_cursor.fetchone()
+        if row is None:
+            return None
+        return self.storage.payload_dictionaries.decompress(row[0])
+
+    def write(self, revision_id, filename, data):
+        self.storage.db_cursor.execute(\
+                'INSERT OR REPLACE INTO '+PAYLOADS_TABLE_NAME+\
+                ' (revision_id, filename, data) VALUES (?, ?, ?)',
+                    (revision_id, filename, sqlite3.Binary(\
+                        self.storage.payload_dictionaries.compress(data))))
+
+    def remove(self, revision_id, filename):
+        self.storage.db_cursor.execute(\
+                'DELETE FROM '+PAYLOADS_TABLE_NAME+\
+                ' WHERE revision_id=? AND filename=?',
+                    (revision_id, filename))
+
+###################
+# tests
+
+def test_payload_table_roundtrip():
+    from core.storage import setup_temp_db, teardown_temp_db
+
+    storage = setup_temp_db()
+    payloads = storage.payload_table
+
+    text = u"Some note\n\xe9t\xe9\n".encode("utf-8") * 50
+
+    payloads.write(1, "content.txt", text)
+    assert payloads.contains(1, "content.txt")
+    assert not payloads.contains(1, "changelist.txt")
+    assert payloads.read(1, "content.txt") == text
+
+    storage.db_cursor.execute("SELECT length(data) FROM "+PAYLOADS_TABLE_NAME)
+    assert storage.db_cursor.fetchone()[0] < len(text)
+
+    payloads.write(1, "content.txt", "replaced")
+    assert payloads.read(1, "content.txt") == "replaced"
+
+    payloads.remove(1, "content.txt")
+    assert payloads.read(1, "content.txt") is None
+
+    teardown_temp_db(storage)
+
+if __name__ == '__main__':
+    test_payload_table_roundtrip()
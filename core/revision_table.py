@@ -0,0 +1,149 @@
+# This file is part of python-diffrevision
+# Copyright (C) 2011 Francois Savard 
+#
+# python-diffrevision is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-diffrevision is distributed in the hope that
+# it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-diffrevision (see license.txt)
+# If not, see <http://www.gnu.org/licenses/>.
+
+# Columnar view of the revisions metadata, for operations over the whole db
+# (forecasts, rescheduling, statistics).
+#
+# Instead of one Revision object (with its datetime and date objects) per
+# row, each column is a compact array, and dates are stored as a number of
+# days since 1970-01-01 ("epoch days"). Document paths are stored once each,
+# rows refer to them by index (doc_ids).
+#
+# Fill one with Storage.load_revision_table().
+
+import os, sys
+import datetime
+from array import array
+
+if __name__ == '__main__':
+    # otw when running tests we can't import other modules
+    this_files_path = os.path.split(os.path.abspath(__file__))[0]
+    sys.path.append(os.path.join(this_files_path,".."))
+
+EPOCH = datetime.date(1970, 1, 1)
+
+# difference between SQLite's julianday() and epoch days
+JULIAN_DAY_OF_EPOCH = 2440587.5
+
+def date_to_epoch_day(date):
+    return (date - EPOCH).days
+
+def epoch_day_to_date(day):
+    return EPOCH + datetime.timedelta(days=day)
+
+class RevisionTable(object):
+    def __init__(self):
+        self.ids = array('l')
+        self.doc_ids = array('l')
+        self.scheduled_days = array('l')
+        self.num_revisions_done = array('l')
+        self.hidden = array('b')
+
+        self.document_paths = []
+        self.doc_id_by_path = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_doc_id(self, document_relative_path):
+        doc_id = self.doc_id_by_path.get(document_relative_path)
+        if doc_id is None:
+            doc_id = len(self.document_paths)
+            self.document_paths.append(document_relative_path)
+            self.doc_id_by_path[document_relative_path] = doc_id
+        return doc_id
+
+    def append(self, id, document_relative_path, scheduled_day,
+                    num_revisions_done, hidden):
+        self.ids.append(id)
+        self.doc_ids.append(self.get_doc_id(document_relative_path))
+        self.scheduled_days.append(scheduled_day)
+        self.num_revisions_done.append(num_revisions_done)
+        self.hidden.append(1 if hidden else 0)
+
+    def get_document_path(self, row_index):
+        return self.document_paths[self.doc_ids[row_index]]
+
+    # Number of non-hidden revisions due on each of the num_days days
+    # starting at from_day. Revisions already overdue count for from_day.
+    def count_due_by_day(self, from_day, num_days):
+        counts = [0] * num_days
+        last_day = from_day + num_days - 1
+        hidden = self.hidden
+        for i, day in enumerate(self.scheduled_days):
+            if hidden[i] or day > last_day:
+                continue
+            counts[max(day - from_day, 0)] += 1
+        return counts
+
+    # Number of revisions for each number of reviews done, as a list
+    # indexed by num_revisions_done.
+    def count_by_num_revisions_done(self):
+        counts = []
+        for n in self.num_revisions_done:
+            if n >= len(counts):
+                counts.extend([0] * (n - len(counts) + 1))
+            counts[n] += 1
+        return counts
+
+###################
+# tests
+
+def test_revision_table_from_storage():
+    from core.storage import setup_temp_db, teardown_temp_db, \
+                                insert_test_revision
+    from scheduling.fixed_scheduler import FixedScheduler
+
+    storage = setup_temp_db()
+
+    today = datetime.date.today()
+    start = datetime.datetime.now() - datetime.timedelta(days=2)
+    r1 = insert_test_revision(storage, "a.txt", start, u"a")
+    r2 = insert_test_revision(storage, "b.txt", start, u"b")
+    r3 = insert_test_revision(storage, "a.txt",
+                                start + datetime.timedelta(minutes=1), u"aa")
+
+    r2.num_revisions_done = 3
+    r2.update_scheduled_date(today + datetime.timedelta(days=2),
+                             update_num_revisions=True)
+    r3.set_hidden_state(True)
+
+    table = storage.load_revision_table()
+
+    assert list(table.ids) == [r1.id, r2.id, r3.id]
+    assert table.get_document_path(0) == table.get_document_path(2) == "a.txt"
+    assert list(table.doc_ids) == [0, 1, 0]
+    assert epoch_day_to_date(table.scheduled_days[1]) == \
+                today + datetime.timedelta(days=2)
+    assert list(table.num_revisions_done) == [0, 3, 0]
+    assert list(table.hidden) == [0, 0, 1]
+
+    today_day = date_to_epoch_day(today)
+    assert table.count_due_by_day(today_day, 3) == [1, 0, 1]
+    assert table.count_by_num_revisions_done() == [2, 0, 0, 1]
+
+    # schedulers work on the columns directly
+    next_days = FixedScheduler(intervals=[2,6,14,30])\
+                    .get_next_days(table.num_revisions_done, today_day)
+    assert list(next_days) == [today_day+2, today_day+30, today_day+2]
+
+    teardown_temp_db(storage)
+
+if __name__ == '__main__':
+    test_revision_table_from_storage()
@@ -0,0 +1,256 @@
+# This file is part of python-diffrevision
+# Copyright (C) 2011 Francois Savard 
+#
+# python-diffrevision is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-diffrevision is distributed in the hope that
+# it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-diffrevision (see license.txt)
+# If not, see <http://www.gnu.org/licenses/>.
+
+# Instrumentation of the SQL statements run on the store.
+#
+# The connections opened by core.db_connections are InstrumentedConnections,
+# whose cursors run every statement through InstrumentedCursor.execute,
+# whichever module built it (Storage, the payload stores, compaction...).
+# There:
+#  - with STATS enabled (the --sql-stats option of diffrevision.py), the
+#    number of times each statement is run, and the time spent running it
+#    and fetching its rows, are added up, see SqlStats.print_report
+#  - in tests, within checking_query_plans(), each statement is first run
+#    through EXPLAIN QUERY PLAN, and FullScanError is raised if it would
+#    scan the whole revisions table: the queries run on every diff, every
+#    'today', every review must go through an index.
+# Otherwise statements run as they would on a plain sqlite3 cursor.
+
+import os, sys
+import re
+import time
+import threading
+import contextlib
+import sqlite3
+
+if __name__ == '__main__':
+    # otw when running tests we can't import other modules
+    this_files_path = os.path.split(os.path.abspath(__file__))[0]
+    sys.path.append(os.path.join(this_files_path,".."))
+
+# tables checked by checking_query_plans() by default
+DEFAULT_CHECKED_TABLES = ('revisions',)
+
+# statements EXPLAIN QUERY PLAN says something about
+PLANNED_STATEMENT_REGEX = re.compile(\
+            r"^\s*(SELECT|UPDATE|DELETE|INSERT|REPLACE)\b", re.IGNORECASE)
+
+# "SCAN revisions" (or "SCAN TABLE revisions" for older SQLite), possibly
+# "USING [COVERING] INDEX ...": every row is visited either way
+FULL_SCAN_REGEX = re.compile(r"^SCAN (TABLE )?(\w+)")
+
+# statements are shown that long at most in the report
+REPORT_STATEMENT_LENGTH = 100
+
+def normalize_statement(statement):
+    return " ".join(statement.split())
+
+class SqlStats(object):
+    def __init__(self):
+        self.enabled = False
+
+        # normalized statement -> [times run, seconds spent]
+        self.by_statement = {}
+        self.lock = threading.Lock()
+
+    def record(self, statement, seconds, count=1):
+        statement = normalize_statement(statement)
+        with self.lock:
+            stats = self.by_statement.get(statement)
+            if stats is None:
+                stats = self.by_statement[statement] = [0, 0.0]
+            stats[0] += count
+            stats[1] += seconds
+
+    # [(statement, times run, seconds spent)], the slowest first
+    def get_stats(self):
+        with self.lock:
+            stats = [(statement, count, seconds) for statement, \
+                        (count, seconds) in self.by_statement.iteritems()]
+        stats.sort(key=lambda s: (-s[2], s[0]))
+        return stats
+
+    def clear(self):
+        with self.lock:
+            self.by_statement.clear()
+
+    def print_report(self):
+        stats = self.get_stats()
+
+        print "SQL statements (%d different, run %d times, %.1f ms):" \
+                    % (len(stats), sum([s[1] for s in stats]),
+                       sum([s[2] for s in stats]) * 1000)
+        print "%8s %10s %8s  %s" % ("count", "total ms", "mean ms",
+                                     "statement")
+        for statement, count, seconds in stats:
+            if len(statement) > REPORT_STATEMENT_LENGTH:
+                statement = statement[:REPORT_STATEMENT_LENGTH-3] + "..."
+            # rows of statements run before the stats were enabled may be
+            # fetched after
+            print "%8d %10.1f %8.3f  %s" % (count, seconds * 1000,
+                                seconds * 1000 / max(count, 1), statement)
+
+# the statistics of the process, see the --sql-stats option
+STATS = SqlStats()
+
+class FullScanError(AssertionError):
+    pass
+
+# tables checked by the calling thread, see checking_query_plans
+_plan_checks = threading.local()
+
+# Within it, statements run by the calling thread fail with FullScanError if
+# they'd scan one of tables. For tests.
+@contextlib.contextmanager
+def checking_query_plans(tables=DEFAULT_CHECKED_TABLES):
+    previous_tables = getattr(_plan_checks, 'tables', None)
+    _plan_checks.tables = tables
+    try:
+        yield
+    finally:
+        _plan_checks.tables = previous_tables
+
+# the details of a query plan scanning one of tables
+def get_full_scans(plan_details, tables):
+    scans = []
+    for detail in plan_details:
+        match = FULL_SCAN_REGEX.match(detail)
+        if match and match.group(2) in tables:
+            scans.append(detail)
+    return scans
+
+def check_query_plan(connection, statement, parameters, tables):
+    # a plain cursor, not to check (or count) the EXPLAIN itself
+    cursor = sqlite3.Cursor(connection)
+    try:
+        cursor.execute("EXPLAIN QUERY PLAN "+statement, parameters)
+        plan_details = [str(row[-1]) for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+    scans = get_full_scans(plan_details, tables)
+    if scans:
+        raise FullScanError("%s in the plan of: %s" % (", ".join(scans),
+                                            normalize_statement(statement)))
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, statement, parameters=()):
+        tables = getattr(_plan_checks, 'tables', None)
+        if tables and PLANNED_STATEMENT_REGEX.match(statement):
+            check_query_plan(self.connection, statement, parameters, tables)
+
+        # rows fetched later count for this statement
+        self.statement = statement
+
+        if not STATS.enabled:
+            return sqlite3.Cursor.execute(self, statement, parameters)
+
+        start = time.time()
+        try:
+            return sqlite3.Cursor.execute(self, statement, parameters)
+        finally:
+            STATS.record(statement, time.time() - start)
+
+    def executemany(self, statement, seq_of_parameters):
+        self.statement = statement
+
+        if not STATS.enabled:
+            return sqlite3.Cursor.executemany(self, statement,
+                                              seq_of_parameters)
+
+        start = time.time()
+        try:
+            return sqlite3.Cursor.executemany(self, statement,
+                                              seq_of_parameters)
+        finally:
+            STATS.record(statement, time.time() - start)
+
+    def timed_fetch(self, fetch, *args):
+        if not STATS.enabled or getattr(self, 'statement', None) is None:
+            return fetch(self, *args)
+
+        start = time.time()
+        try:
+            return fetch(self, *args)
+        finally:
+            STATS.record(self.statement, time.time() - start, count=0)
+
+    def fetchone(self):
+        return self.timed_fetch(sqlite3.Cursor.fetchone)
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        return self.timed_fetch(sqlite3.Cursor.fetchmany, size)
+
+    def fetchall(self):
+        return self.timed_fetch(sqlite3.Cursor.fetchall)
+
+# pass as the factory of sqlite3.connect
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+###################
+# tests
+
+def test_statements_counted_and_full_scans_caught():
+    connection = sqlite3.connect(":memory:", factory=InstrumentedConnection)
+    cursor = connection.cursor()
+    cursor.execute("CREATE TABLE revisions (id INTEGER PRIMARY KEY,"+\
+                    " scheduled_date date)")
+    cursor.execute("CREATE INDEX due ON revisions (scheduled_date)")
+
+    STATS.enabled = True
+    try:
+        cursor.executemany("INSERT INTO revisions (scheduled_date)"+\
+                            " VALUES (?)", [(str(i),) for i in range(10)])
+        for i in range(3):
+            cursor.execute("SELECT id FROM revisions\n"+\
+                            "    WHERE scheduled_date <= ?", (str(i),))
+            assert len(cursor.fetchall()) == i+1
+
+        stats = dict([(s[0], s[1:]) for s in STATS.get_stats()])
+        assert stats["SELECT id FROM revisions WHERE scheduled_date <= ?"]\
+                    [0] == 3
+        assert stats["INSERT INTO revisions (scheduled_date) VALUES (?)"]\
+                    [0] == 1
+    finally:
+        STATS.enabled = False
+        STATS.clear()
+
+    with checking_query_plans():
+        cursor.execute("SELECT id FROM revisions WHERE scheduled_date <= ?",
+                        ("5",))
+        cursor.execute("SELECT scheduled_date FROM revisions WHERE id = ?",
+                        (5,))
+        try:
+            cursor.execute("SELECT id FROM revisions WHERE id + 1 = ?",
+                            (5,))
+            assert False
+        except FullScanError:
+            pass
+
+    # only checked within checking_query_plans
+    cursor.execute("SELECT id FROM revisions WHERE id + 1 = ?", (5,))
+
+    connection.close()
+
+if __name__ == '__main__':
+    test_statements_counted_and_full_scans_caught()
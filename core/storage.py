@@ -17,22 +17,71 @@
 # along with python-diffrevision (see license.txt)
 # If not, see <http://www.gnu.org/licenses/>.
 
-import os,sys,copy,operator,time
+import os,sys,copy,operator,time,shutil
 import datetime
 import sqlite3
 import codecs
+from collections import namedtuple
+
+if __name__ == '__main__':
+    # otw when running tests we can't import other modules
+    this_files_path = os.path.split(os.path.abspath(__file__))[0]
+    sys.path.append(os.path.join(this_files_path,".."))
+
+from generation.wikidpad_formatter import StringOps
+from core.db_connections import ConnectionManager, DEFAULT_BUSY_TIMEOUT
+from core.blob_store import BlobStore, hash_data
+from diffing.changelist import Changelist
+from core.revision_table import RevisionTable, JULIAN_DAY_OF_EPOCH
+from core.payload_table import PayloadTable, PAYLOADS_TABLE_NAME
+from core.payload_dictionary import PayloadDictionaries
+from core.pack_store import PackStore
+from core.atomic_files import AtomicFiles
+from core.store_lock import StoreLock, LOCK_FILENAME, DEFAULT_LOCK_TIMEOUT
+from core.storage_backend import StorageBackend
 
 DB_FILENAME = 'db.sqlite3'
 IGNORED_LIST = 'ignored_entries.dat'
 REVISIONS_CONTENT_DIRNAME = 'revisions'
+# older versions kept the ignored list there, see
+# migrate_move_watched_and_ignored_lists_to_tables
 IGNORED_LIST_FILENAME = 'ignored.txt'
 
 REVISION_CONTENT_FILENAME = 'content.txt'
+# changelists used to be written as text, they're now written in the binary
+# format of diffing.changelist, but both are read
 CHANGELIST_FILENAME = 'changelist.txt'
+CHANGELIST_BINARY_FILENAME = 'changelist.bin'
+# revisions between two keyframes are stored as a binary delta against an
+# earlier revision, see Revision.save_content
+REVISION_DELTA_FILENAME = 'content.delta'
+
+# every payload a revision may have
+PAYLOAD_FILENAMES = [REVISION_CONTENT_FILENAME, REVISION_DELTA_FILENAME,
+                     CHANGELIST_FILENAME, CHANGELIST_BINARY_FILENAME]
+
+# deltas are computed on bytes (see StringOps.getBinCompactForDiff), so the
+# text is encoded with this codec first, whatever the notes codec is
+DELTA_ENCODING = 'utf-8'
 
 TIMESTAMP_FORMAT = "%Y-%m-%d-%H-%M-%S"
 DATE_FORMAT = "%Y-%m-%d"
 
+# values for the 'payload_storage' config option: where revision payloads
+# (content, changelist) are written
+PAYLOAD_STORAGE_DIRECTORIES = 'directories'
+PAYLOAD_STORAGE_BLOBS = 'blobs'
+PAYLOAD_STORAGE_SQLITE = 'sqlite'
+
+# values for the 'revision_directory_layout' config option: revision
+# directories are either revisions/<document>/<timestamp> ('flat'), or
+# revisions/ab/cd/<document>/<timestamp> ('sharded'), abcd... being the
+# hash of the document's path, so no directory gets too large
+REVISION_DIRECTORY_LAYOUT_FLAT = 'flat'
+REVISION_DIRECTORY_LAYOUT_SHARDED = 'sharded'
+REVISION_DIRECTORY_LAYOUTS = [REVISION_DIRECTORY_LAYOUT_FLAT,
+                              REVISION_DIRECTORY_LAYOUT_SHARDED]
+
 REVISIONS_TABLE_NAME = 'revisions'
 CREATE_TABLE_STATEMENT = "create table "+REVISIONS_TABLE_NAME+"("+\
                             "id INTEGER PRIMARY KEY,"+\
@@ -44,6 +93,162 @@ CREATE_TABLE_STATEMENT = "create table "+REVISIONS_TABLE_NAME+"("+\
 ALL_COL_NAMES = "id, document_relative_path, datetime_diffed_on,"+\
                     " scheduled_date, num_revisions_done, hidden"
 
+# number of rows fetched at a time by the iter_* queries
+ITER_CHUNK_SIZE = 256
+
+# indexes for the queries run for every document on every diff, and for
+# every 'today'
+REVISIONS_BY_DOCUMENT_INDEX_NAME = 'revisions_by_document'
+DUE_REVISIONS_INDEX_NAME = 'due_revisions'
+
+# One row per document, pointing to its latest revision (its "head"), so the
+# diff scan doesn't have to go through the revisions of every document.
+# head_content_hash is hash_data() of the head's content encoded with the
+# notes codec; it's NULL for heads older than the table.
+DOCUMENTS_TABLE_NAME = 'documents'
+CREATE_DOCUMENTS_TABLE_STATEMENT = \
+    "create table if not exists "+DOCUMENTS_TABLE_NAME+"("+\
+                            "document_relative_path varchar(256)"+\
+                                " PRIMARY KEY,"+\
+                            "head_revision_id integer,"+\
+                            "head_datetime_diffed_on timestamp,"+\
+                            "head_content_hash varchar(40))"
+
+# documents never to be added to the watched list (they used to be listed in
+# ignored.txt); watched documents are the rows of the documents table
+IGNORED_DOCUMENTS_TABLE_NAME = 'ignored_documents'
+CREATE_IGNORED_DOCUMENTS_TABLE_STATEMENT = \
+    "create table if not exists "+IGNORED_DOCUMENTS_TABLE_NAME+"("+\
+                            "document_relative_path varchar(256)"+\
+                                " PRIMARY KEY)"
+
+# Base of the revisions stored as a delta against another revision than the
+# one preceding them (see Revision.save_content). Deltas without a row here
+# are against the preceding revision, as all deltas were before the table.
+DELTA_BASES_TABLE_NAME = 'delta_bases'
+DELTA_BASES_BY_BASE_INDEX_NAME = 'delta_bases_by_base'
+CREATE_DELTA_BASES_TABLE_STATEMENT = \
+    "create table if not exists "+DELTA_BASES_TABLE_NAME+"("+\
+                            "revision_id INTEGER PRIMARY KEY,"+\
+                            "base_revision_id integer not null)"
+
+DocumentHead = namedtuple('DocumentHead',
+                    ['revision_id', 'datetime_diffed_on', 'content_hash'])
+
+##############
+# Schema migrations
+#
+# SCHEMA_MIGRATIONS[i] brings a db from schema version i to version i+1. The
+# version of a db is kept in its 'user_version' pragma, and
+# Storage.connect_to_db_or_create applies the missing migrations, so older
+# dbs are upgraded automatically. Only ever append to that list.
+
+def migrate_create_revisions_table(storage):
+    cursor = storage.db_cursor
+
+    cursor.execute("SELECT name FROM sqlite_master"+\
+                        " WHERE type='table' AND name=?;",
+                        (REVISIONS_TABLE_NAME,))
+    if cursor.fetchone() is None:
+        cursor.execute(CREATE_TABLE_STATEMENT)
+        return
+
+    # dbs created before 2012-12-19 don't have the 'hidden' column
+    cursor.execute("PRAGMA table_info("+REVISIONS_TABLE_NAME+");")
+    column_names = [row[1] for row in cursor.fetchall()]
+    if 'hidden' not in column_names:
+        cursor.execute("ALTER TABLE "+REVISIONS_TABLE_NAME+\
+                        " ADD hidden INTEGER NOT NULL DEFAULT 0")
+
+def migrate_create_payload_tables(storage):
+    for payload_store in storage.db_payload_stores:
+        payload_store.create_tables()
+
+def migrate_create_revisions_indexes(storage):
+    storage.db_cursor.execute("CREATE INDEX IF NOT EXISTS "+\
+                    REVISIONS_BY_DOCUMENT_INDEX_NAME+\
+                    " ON "+REVISIONS_TABLE_NAME+\
+                    " (document_relative_path, datetime_diffed_on)")
+    storage.db_cursor.execute("CREATE INDEX IF NOT EXISTS "+\
+                    DUE_REVISIONS_INDEX_NAME+\
+                    " ON "+REVISIONS_TABLE_NAME+" (scheduled_date)"+\
+                    " WHERE hidden = 0")
+
+def migrate_create_documents_table(storage):
+    storage.db_cursor.execute(CREATE_DOCUMENTS_TABLE_STATEMENT)
+
+    # the latest revision of each document, found with revisions_by_document
+    storage.db_cursor.execute(\
+            "INSERT OR IGNORE INTO "+DOCUMENTS_TABLE_NAME+\
+            " (document_relative_path, head_revision_id,"+\
+            " head_datetime_diffed_on)"+\
+            " SELECT r.document_relative_path, r.id, r.datetime_diffed_on"+\
+            " FROM "+REVISIONS_TABLE_NAME+" r"+\
+            " WHERE r.id = (SELECT r2.id FROM "+REVISIONS_TABLE_NAME+" r2"+\
+                " WHERE r2.document_relative_path = r.document_relative_path"+\
+                " ORDER BY r2.datetime_diffed_on DESC, r2.id DESC LIMIT 1)")
+
+# The watched list used to be the directories of the revisions directory, and
+# the ignored list the lines of ignored.txt. Both are imported, then left
+# untouched.
+def migrate_move_watched_and_ignored_lists_to_tables(storage):
+    storage.db_cursor.execute(CREATE_IGNORED_DOCUMENTS_TABLE_STATEMENT)
+
+    watched = [p for p in os.listdir(storage.revisions_content_abspath) \
+                if os.path.isdir(os.path.join(storage.revisions_content_abspath,
+                                              p))]
+    storage.db_cursor.executemany(\
+            "INSERT OR IGNORE INTO "+DOCUMENTS_TABLE_NAME+\
+            " (document_relative_path) VALUES (?)",
+            [(p,) for p in watched])
+
+    if os.path.exists(storage.ignored_list_file_abspath):
+        f = open(storage.ignored_list_file_abspath, "r")
+        ignored = [l.rstrip() for l in f.readlines() if l.strip()]
+        f.close()
+
+        storage.db_cursor.executemany(\
+                "INSERT OR IGNORE INTO "+IGNORED_DOCUMENTS_TABLE_NAME+\
+                " (document_relative_path) VALUES (?)",
+                [(p,) for p in ignored])
+
+def migrate_create_payload_dictionaries_table(storage):
+    storage.payload_dictionaries.create_tables()
+
+def migrate_create_pack_entries_table(storage):
+    storage.pack_store.create_tables()
+
+def migrate_create_delta_bases_table(storage):
+    storage.db_cursor.execute(CREATE_DELTA_BASES_TABLE_STATEMENT)
+    # to find the revisions depending on one, see compaction
+    storage.db_cursor.execute("CREATE INDEX IF NOT EXISTS "+\
+                    DELTA_BASES_BY_BASE_INDEX_NAME+\
+                    " ON "+DELTA_BASES_TABLE_NAME+" (base_revision_id)")
+
+def migrate_create_payload_dictionary_trainings_table(storage):
+    storage.payload_dictionaries.create_trainings_table()
+
+SCHEMA_MIGRATIONS = [
+    migrate_create_revisions_table,
+    migrate_create_payload_tables,
+    migrate_create_revisions_indexes,
+    migrate_create_documents_table,
+    migrate_move_watched_and_ignored_lists_to_tables,
+    migrate_create_payload_dictionaries_table,
+    migrate_create_pack_entries_table,
+    migrate_create_delta_bases_table,
+    migrate_create_payload_dictionary_trainings_table,
+]
+
+def get_document_shard(doc_relative_path):
+    if isinstance(doc_relative_path, unicode):
+        doc_relative_path = doc_relative_path.encode('utf-8')
+    h = hash_data(doc_relative_path)
+    return (h[:2], h[2:4])
+
+def is_shard_directory_name(name):
+    return len(name) == 2 and all([c in '0123456789abcdef' for c in name])
+
 def get_formatted_date(date):
     as_datetime = datetime.datetime(year=date.year,
                                 month=date.month,
@@ -53,9 +258,20 @@ def get_formatted_date(date):
 def get_formatted_datetime(dt):
     return dt.strftime(TIMESTAMP_FORMAT)
 
-class Storage(object):
+# Skip-deltas: the revision offset revisions after a keyframe is stored as a
+# delta against the one at offset with its lowest set bit cleared, e.g. 7
+# against 6, 6 against 4, 4 against the keyframe. Each revision on the way
+# back to the keyframe has one bit less, so rebuilding any revision applies
+# at most log2(delta_keyframe_interval) deltas, instead of up to
+# delta_keyframe_interval - 1 with each delta against the revision preceding
+# it.
+def get_skip_delta_base_offset(offset):
+    return offset & (offset - 1)
+
+# The SQLite + filesystem backend, see core.storage_backend
+class Storage(StorageBackend):
     def __init__(self, config):
-        self.config = config
+        StorageBackend.__init__(self, config)
 
         self.revisions_content_abspath = \
             os.path.join(self.config.diffrevision_base_directory,
@@ -67,8 +283,33 @@ class Storage(object):
 
         self.create_basic_files_if_necessary()
 
-        self.db_connection = None
-        self.db_cursor = None
+        # see StorageBackend.lock
+        self.store_lock = StoreLock(\
+                os.path.join(self.config.diffrevision_base_directory,
+                             LOCK_FILENAME),
+                timeout=getattr(self.config, 'lock_timeout',
+                                DEFAULT_LOCK_TIMEOUT))
+
+        # see db_connection and db_cursor
+        self.connections = None
+
+        # see iter_rows
+        self.iter_chunk_size = ITER_CHUNK_SIZE
+
+        # payload files are written through it, see write_payload_file
+        self.atomic_files = AtomicFiles(\
+                durable=getattr(self.config, 'durable_writes', True))
+
+        self.blob_store = BlobStore(self)
+        self.payload_table = PayloadTable(self)
+        self.payload_dictionaries = PayloadDictionaries(self)
+        self.pack_store = PackStore(self)
+
+        # payload stores indexed in the db, by opposition to the revision
+        # directories (the pack store only gets payloads moved there by
+        # core.tiering, never new ones)
+        self.db_payload_stores = [self.payload_table, self.blob_store,
+                                  self.pack_store]
 
         self.connect_to_db_or_create()
 
@@ -76,45 +317,167 @@ class Storage(object):
         if not os.path.exists(self.revisions_content_abspath):
             os.mkdir(self.revisions_content_abspath)
 
-        if not os.path.exists(self.ignored_list_file_abspath):
-            # TODO: codec
-            f = open(self.ignored_list_file_abspath,"w")
-            f.write("")
-            f.close()
-
         assert os.path.isdir(self.revisions_content_abspath)
 
-    def create_tables(self):
-        self.db_cursor.execute(CREATE_TABLE_STATEMENT)
+    def get_schema_version(self):
+        self.db_cursor.execute("PRAGMA user_version;")
+        return self.db_cursor.fetchone()[0]
+
+    # creates the tables for new dbs, upgrades older ones
+    def migrate_schema(self):
+        for version in range(self.get_schema_version(),
+                             len(SCHEMA_MIGRATIONS)):
+            SCHEMA_MIGRATIONS[version](self)
+
+            self.db_cursor.execute("PRAGMA user_version = %d;" % (version+1,))
+            self.db_connection.commit()
         
     def connect_to_db_or_create(self):
         db_path = os.path.join(self.config.diffrevision_base_directory,
                                 DB_FILENAME)
 
-        didnt_exist = False
-        if not os.path.exists(db_path):
-            didnt_exist = True
-
-        # the detect_types option makes sure timestamp and date columns
-        # are converted correclty in the Python layer
-        self.db_connection = sqlite3.connect(db_path,
-                detect_types=sqlite3.PARSE_DECLTYPES)
-        self.db_cursor = self.db_connection.cursor()
-
-        if didnt_exist:
-            self.create_tables()
+        self.connections = ConnectionManager(db_path,
+                busy_timeout=getattr(self.config, 'db_busy_timeout',
+                                     DEFAULT_BUSY_TIMEOUT))
+
+        self.migrate_schema()
+
+    # The connection and cursor are those of the calling thread, so the
+    # same Storage can be used from several threads (e.g. by the local
+    # server), see ConnectionManager.
+    @property
+    def db_connection(self):
+        return self.connections.get_connection()
+
+    @property
+    def db_cursor(self):
+        return self.connections.get_cursor()
+
+    # per thread as well
+    @property
+    def transaction_depth(self):
+        return self.connections.get_transaction_depth()
+
+    @transaction_depth.setter
+    def transaction_depth(self, depth):
+        self.connections.set_transaction_depth(depth)
+
+    # See StorageBackend.transaction; SQLite begins transactions implicitly.
+    # The payload files written during the transaction are put in place
+    # before the db refers to them, and the ones they replace or removed are
+    # only deleted once it doesn't refer to them anymore, see
+    # core.atomic_files.
+    def commit(self):
+        self.atomic_files.flush()
+        try:
+            self.db_connection.commit()
+        except:
+            # nothing of the transaction is kept: the files written are
+            # removed, the ones they replaced put back, the ones removed
+            # stay
+            self.rollback()
+            self.payload_cache.clear()
+            raise
+        self.atomic_files.apply_removals()
+
+    def rollback(self):
+        self.db_connection.rollback()
+        self.atomic_files.discard()
+
+    # see StorageBackend.lock
+    def acquire_lock(self, exclusive, timeout, on_wait):
+        self.store_lock.acquire(exclusive, timeout, on_wait)
+
+    def release_lock(self):
+        self.store_lock.release()
+
+    # Payload files (revision directories, blobs, packs) are written
+    # atomically, and inside a transaction, only put in place when it
+    # commits (see core.atomic_files).
+    def write_payload_file(self, path, data):
+        self.atomic_files.write(path, data, staged=self.transaction_depth > 0)
+
+    # returns the offset the data was written at
+    def append_payload_file(self, path, data):
+        return self.atomic_files.append(path, data,
+                                        staged=self.transaction_depth > 0)
+
+    def remove_payload_file(self, path):
+        self.atomic_files.remove(path, staged=self.transaction_depth > 0)
+
+    def read_payload_file(self, path):
+        return self.atomic_files.read(path)
+
+    def payload_file_exists(self, path):
+        return self.atomic_files.exists(path)
+
+    def get_payload_storage(self):
+        return getattr(self.config, 'payload_storage',
+                            PAYLOAD_STORAGE_DIRECTORIES)
+
+    # the db payload store new payloads go to, or None for the directories
+    def get_current_db_payload_store(self):
+        payload_storage = self.get_payload_storage()
+        if payload_storage == PAYLOAD_STORAGE_BLOBS:
+            return self.blob_store
+        elif payload_storage == PAYLOAD_STORAGE_SQLITE:
+            return self.payload_table
+        return None
+
+    # Start of the SELECT statement for revision records.
+    # When the payloads are stored in the db and are to be loaded anyway,
+    # they're joined here, so one query returns the revisions along with their
+    # content and changelist (see Revision.create_from_record).
+    # The statement is to be completed with WHERE/ORDER BY clauses.
+    def get_revision_select_statement(self, load_diff_content=False):
+        if not load_diff_content or \
+                self.get_payload_storage() != PAYLOAD_STORAGE_SQLITE:
+            return "SELECT "+ALL_COL_NAMES+" FROM "+REVISIONS_TABLE_NAME
+
+        return "SELECT "+ALL_COL_NAMES+\
+                ", content_payload.data, changelist_payload.data"+\
+                " FROM "+REVISIONS_TABLE_NAME+\
+                " LEFT JOIN "+PAYLOADS_TABLE_NAME+" AS content_payload"+\
+                " ON content_payload.revision_id = "+REVISIONS_TABLE_NAME+".id"+\
+                " AND content_payload.filename = '"+\
+                            REVISION_CONTENT_FILENAME+"'"+\
+                " LEFT JOIN "+PAYLOADS_TABLE_NAME+" AS changelist_payload"+\
+                " ON changelist_payload.revision_id = "+REVISIONS_TABLE_NAME+".id"+\
+                " AND changelist_payload.filename = '"+\
+                            CHANGELIST_BINARY_FILENAME+"'"
 
     def close_connection(self):
-        self.db_connection.close()
-
-    def get_revisions_for_document_path_sorted(self, doc_relative_path,
-                                               load_diff_content=True):
+        self.connections.close()
+        self.pack_store.close()
+
+    # Yields the rows of a SELECT, fetching them a chunk at a time, so the
+    # first rows are available right away and the whole result set is never
+    # held in memory.
+    # The rows come from a cursor of their own, so other queries (e.g. to
+    # load payloads) can be run while iterating. Don't commit while
+    # iterating, though (sqlite3 resets open cursors on commit), do the
+    # writes in a transaction() instead.
+    def iter_rows(self, statement, parameters=()):
+        cursor = self.db_connection.cursor()
+        try:
+            cursor.execute(statement, parameters)
+            while True:
+                rows = cursor.fetchmany(self.iter_chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
+
+    def iter_revisions_for_document_path_sorted(self, doc_relative_path,
+                                                load_diff_content=True):
         # we could also get the revisions from looking at the directory
         # containing them, but then we'd have to fetch them in the db
         # afeterwards anyway
 
-        self.db_cursor.execute("SELECT "+ALL_COL_NAMES+\
-                                    " FROM "+REVISIONS_TABLE_NAME+\
+        rows = self.iter_rows(\
+                self.get_revision_select_statement(load_diff_content)+\
                                     " WHERE document_relative_path=? "+\
                                     " ORDER BY datetime_diffed_on ASC;",
                                     (doc_relative_path,))
@@ -122,42 +485,470 @@ class Storage(object):
         # it's quite possible that there is no result, by the way, as when
         # checking if an entry has any revision at all when it's just been 
         # added
+        for row in rows:
+            yield Revision.create_from_record(self, row,\
+                                    load_diff_content=load_diff_content)
+
+    def get_revision_from_id(self, id, load_diff_content=False):
+        self.db_cursor.execute(\
+                self.get_revision_select_statement(load_diff_content)+\
+                                    " WHERE id=?;",
+                                    (id,))
+
         results = []
         rows = self.db_cursor.fetchall()
         for row in rows:
-            results.append(\
-                Revision.create_from_record(self, row,\
+            results.append(Revision.create_from_record(self, row,
                                     load_diff_content=load_diff_content))
-        return results
+
+        assert len(results) <= 1
+
+        if results:
+            return results[0]
+        else:
+            return None
+
+    def iter_all_revisions(self, load_diff_content=False):
+        rows = self.iter_rows(\
+                self.get_revision_select_statement(load_diff_content)+";")
+
+        for row in rows:
+            yield Revision.create_from_record(self, row,
+                                    load_diff_content=load_diff_content)
+
+    # Pages are found with the index on scheduled_date (whose entries are
+    # sorted by id for a given date, id being the rowid) rather than by
+    # skipping rows with OFFSET, so a page costs the same however far it is.
+    def iter_revisions_scheduled_before(self, date, include_hidden=False,
+                                        load_diff_content=False,
+                                        limit=None, after=None):
+        # hidden revisions are filtered here rather than by the caller, so
+        # the partial index on scheduled_date can be used
+        hidden_clause = "" if include_hidden else " AND hidden = 0"
+        parameters = [date]
+
+        # the first condition gives where to start in the index, the second
+        # skips the revisions of that date already seen
+        after_clause = ""
+        if after is not None:
+            after_clause = " AND scheduled_date >= ?"+\
+                            " AND (scheduled_date > ? OR id > ?)"
+            parameters.extend([after[0], after[0], after[1]])
+
+        limit_clause = ""
+        if limit is not None:
+            limit_clause = " LIMIT ?"
+            parameters.append(limit)
+
+        rows = self.iter_rows(\
+                self.get_revision_select_statement(load_diff_content)+\
+                                    " WHERE scheduled_date <= ?"+\
+                                    hidden_clause+after_clause+\
+                                    " ORDER BY scheduled_date, id"+\
+                                    limit_clause+";",
+                                    parameters)
+
+        for row in rows:
+            yield Revision.create_from_record(self, row,
+                                    load_diff_content=load_diff_content)
+
+    def count_revisions_scheduled_before(self, date, include_hidden=False):
+        hidden_clause = "" if include_hidden else " AND hidden = 0"
+
+        self.db_cursor.execute("SELECT COUNT(*) FROM "+REVISIONS_TABLE_NAME+\
+                                    " WHERE scheduled_date <= ?"+\
+                                    hidden_clause+";",
+                                    (date,))
+        return self.db_cursor.fetchone()[0]
+
+    def get_previous_revision(self, rev, distance=1):
+        self.db_cursor.execute("SELECT "+ALL_COL_NAMES+\
+                                    " FROM "+REVISIONS_TABLE_NAME+\
+                                    " WHERE document_relative_path=? "+\
+                                    " AND datetime_diffed_on < ?"+\
+                                    " ORDER BY datetime_diffed_on DESC"+\
+                                    " LIMIT 1 OFFSET ?;",
+                                    (rev.document_relative_path,
+                                     rev.datetime_diffed_on, distance - 1))
+
+        row = self.db_cursor.fetchone()
+        if row is None:
+            return None
+        return Revision.create_from_record(self, row, load_diff_content=False)
+
+    def get_next_revision(self, rev):
+        self.db_cursor.execute("SELECT "+ALL_COL_NAMES+\
+                                    " FROM "+REVISIONS_TABLE_NAME+\
+                                    " WHERE document_relative_path=? "+\
+                                    " AND datetime_diffed_on > ?"+\
+                                    " ORDER BY datetime_diffed_on ASC"+\
+                                    " LIMIT 1;",
+                                    (rev.document_relative_path,
+                                     rev.datetime_diffed_on))
+
+        row = self.db_cursor.fetchone()
+        if row is None:
+            return None
+        return Revision.create_from_record(self, row, load_diff_content=False)
+
+    def count_previous_revisions(self, rev):
+        self.db_cursor.execute("SELECT COUNT(*)"+\
+                                    " FROM "+REVISIONS_TABLE_NAME+\
+                                    " WHERE document_relative_path=? "+\
+                                    " AND datetime_diffed_on < ?;",
+                                    (rev.document_relative_path,
+                                     rev.datetime_diffed_on))
+        return self.db_cursor.fetchone()[0]
+
+    def get_revision_as_of(self, doc_relative_path, dt):
+        self.db_cursor.execute("SELECT "+ALL_COL_NAMES+\
+                                    " FROM "+REVISIONS_TABLE_NAME+\
+                                    " WHERE document_relative_path=? "+\
+                                    " AND datetime_diffed_on <= ?"+\
+                                    " ORDER BY datetime_diffed_on DESC"+\
+                                    " LIMIT 1;",
+                                    (doc_relative_path, dt))
+
+        row = self.db_cursor.fetchone()
+        if row is None:
+            return None
+        return Revision.create_from_record(self, row, load_diff_content=False)
+
+    def get_delta_base_id(self, rev):
+        self.db_cursor.execute("SELECT base_revision_id"+\
+                                    " FROM "+DELTA_BASES_TABLE_NAME+\
+                                    " WHERE revision_id=?;", (rev.id,))
+        row = self.db_cursor.fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def set_delta_base(self, rev, base_revision_id):
+        if base_revision_id is None:
+            self.db_cursor.execute('DELETE FROM '+DELTA_BASES_TABLE_NAME+\
+                                   ' WHERE revision_id=?', (rev.id,))
+        else:
+            self.db_cursor.execute(\
+                'INSERT OR REPLACE INTO '+DELTA_BASES_TABLE_NAME+\
+                ' (revision_id, base_revision_id) VALUES (?, ?)',
+                    (rev.id, base_revision_id))
+
+    def get_delta_dependent_ids(self, rev):
+        self.db_cursor.execute("SELECT revision_id"+\
+                                    " FROM "+DELTA_BASES_TABLE_NAME+\
+                                    " WHERE base_revision_id=?"+\
+                                    " ORDER BY revision_id;", (rev.id,))
+        return [row[0] for row in self.db_cursor.fetchall()]
+
+    def insert_revision(self, rev):
+        self.db_cursor.execute(\
+            'INSERT INTO '+REVISIONS_TABLE_NAME\
+                 +' (' + ALL_COL_NAMES + ') '\
+                 +'VALUES (?, ?, ?, ?, ?, ?)',
+                    # a null id is autoassigned
+                    (rev.id,\
+                     rev.document_relative_path,\
+                     rev.datetime_diffed_on,\
+                     rev.scheduled_date,\
+                     rev.num_revisions_done,\
+                     bool(rev.hidden))) # None (False) for new revisions
+
+        # id from autoassigned value
+        # rowid is the same as primary key for sqlite
+        # http://www.sqlite.org/c3ref/last_insert_rowid.html
+        return self.db_cursor.lastrowid
+
+    def update_revision_schedule(self, revision_id, scheduled_date,
+                                    num_revisions_done=None):
+        if num_revisions_done is not None:
+            self.db_cursor.execute(\
+                'UPDATE '+REVISIONS_TABLE_NAME+\
+                ' SET scheduled_date=?, num_revisions_done=?'+\
+                ' WHERE id=?',
+                    (scheduled_date, num_revisions_done, revision_id))
+        else:
+            self.db_cursor.execute(\
+                'UPDATE '+REVISIONS_TABLE_NAME+' SET scheduled_date=? WHERE id=?',
+                    (scheduled_date, revision_id))
+
+    def update_revision_hidden(self, revision_id, hidden):
+        self.db_cursor.execute(\
+                'UPDATE '+REVISIONS_TABLE_NAME+' SET hidden=? WHERE id=?',
+                    ((1 if hidden else 0), revision_id))
+
+    # With remove_directory=False, the revision directory is left to the
+    # caller, e.g. to remove it only once the deletion is committed.
+    def delete_revision(self, rev, remove_directory=True):
+        for filename in PAYLOAD_FILENAMES:
+            for payload_store in self.db_payload_stores:
+                payload_store.remove(rev.id, filename)
+
+        self.db_cursor.execute(\
+                'DELETE FROM '+DELTA_BASES_TABLE_NAME+' WHERE revision_id=?',
+                    (rev.id,))
+        self.db_cursor.execute(\
+                'DELETE FROM '+REVISIONS_TABLE_NAME+' WHERE id=?', (rev.id,))
+
+        if remove_directory:
+            for layout in REVISION_DIRECTORY_LAYOUTS:
+                dir_path = self.get_revision_directory_path(rev, layout)
+                if os.path.isdir(dir_path):
+                    shutil.rmtree(dir_path)
+
+    ##############
+    # Revision directories
+
+    def get_revision_directory_layout(self):
+        return getattr(self.config, 'revision_directory_layout',
+                            REVISION_DIRECTORY_LAYOUT_FLAT)
+
+    # paths are computed, never looked up with a directory listing
+    def get_document_directory_path(self, doc_relative_path, layout=None):
+        if layout is None:
+            layout = self.get_revision_directory_layout()
+
+        if layout == REVISION_DIRECTORY_LAYOUT_SHARDED:
+            return os.path.join(self.revisions_content_abspath,
+                                *(get_document_shard(doc_relative_path) + \
+                                    (doc_relative_path,)))
+
+        return os.path.join(self.revisions_content_abspath, doc_relative_path)
+
+    def get_revision_directory_path(self, rev, layout=None):
+        return os.path.join(\
+                self.get_document_directory_path(rev.document_relative_path,
+                                                 layout),
+                rev.datetime_diffed_on.strftime(TIMESTAMP_FORMAT))
+
+    # Directory holding the revision's payloads, in the current layout or, if
+    # it wasn't moved yet (see move_revision_directory), in the other one.
+    # None if there's none.
+    def find_revision_directory(self, rev):
+        current_layout = self.get_revision_directory_layout()
+        for layout in [current_layout] + \
+                [l for l in REVISION_DIRECTORY_LAYOUTS if l != current_layout]:
+            dir_path = self.get_revision_directory_path(rev, layout)
+            if os.path.isdir(dir_path):
+                return dir_path
+        return None
+
+    # Moves the directory of a revision to the current layout, if it's in
+    # another one. Each move is a rename, so this can run while the store is
+    # in use, and be interrupted. Returns True if the directory was moved.
+    def move_revision_directory(self, rev):
+        new_path = self.get_revision_directory_path(rev)
+        old_path = self.find_revision_directory(rev)
+        if old_path is None or old_path == new_path:
+            return False
+
+        if not os.path.isdir(new_path):
+            # also removes the old parent directories left empty
+            os.renames(old_path, new_path)
+            return True
+
+        # both exist (e.g. a payload was rewritten since): keep the newest
+        # files
+        for filename in os.listdir(old_path):
+            old_file_path = os.path.join(old_path, filename)
+            if os.path.exists(os.path.join(new_path, filename)):
+                os.remove(old_file_path)
+            else:
+                os.rename(old_file_path, os.path.join(new_path, filename))
+        self.remove_empty_directories(old_path)
+        return True
+
+    # Document directories in all layouts, as (document path, directory)
+    # pairs. Only used for maintenance (see core.compaction).
+    def iter_document_directories(self):
+        root = self.revisions_content_abspath
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if not os.path.isdir(path):
+                continue
+            if not is_shard_directory_name(name):
+                yield name, path
+                continue
+            for name2 in os.listdir(path):
+                path2 = os.path.join(path, name2)
+                if not is_shard_directory_name(name2) or \
+                        not os.path.isdir(path2):
+                    continue
+                for doc_relative_path in os.listdir(path2):
+                    yield doc_relative_path, \
+                            os.path.join(path2, doc_relative_path)
+
+    # removes dir_path if it's empty, then its parents up to (excluding) the
+    # revisions directory, as long as they're empty too
+    def remove_empty_directories(self, dir_path):
+        while dir_path != self.revisions_content_abspath and \
+                dir_path.startswith(self.revisions_content_abspath) and \
+                os.path.isdir(dir_path) and not os.listdir(dir_path):
+            os.rmdir(dir_path)
+            dir_path = os.path.dirname(dir_path)
+
+    ##############
+    # Payloads
+
+    # Payloads are looked up in the db payload stores first, then in the
+    # revision directory, whatever the current 'payload_storage' and
+    # 'revision_directory_layout' options, so stores with revisions written
+    # with different options stay readable (e.g. before running the
+    # 'convert_storage' or 'relayout' commands).
+    def has_payload(self, rev, filename):
+        for payload_store in self.db_payload_stores:
+            if payload_store.contains(rev.id, filename):
+                return True
+        dir_path = self.find_revision_directory(rev)
+        return dir_path is not None and \
+                self.payload_file_exists(os.path.join(dir_path, filename))
+
+    def get_payload_hash(self, rev, filename):
+        return self.blob_store.get_hash(rev.id, filename)
+
+    def read_payload(self, rev, filename):
+        for payload_store in self.db_payload_stores:
+            data = payload_store.read(rev.id, filename)
+            if data is not None:
+                return data
+
+        dir_path = self.find_revision_directory(rev)
+        if dir_path is None:
+            raise IOError("No directory for revision %s" \
+                            % (rev.get_relative_path_plus_timestamp(),))
+
+        return self.read_payload_file(os.path.join(dir_path, filename))
+
+    def write_payload(self, rev, filename, data):
+        target_store = self.get_current_db_payload_store()
+
+        # only one copy of a payload is kept
+        for payload_store in self.db_payload_stores:
+            if payload_store is not target_store:
+                payload_store.remove(rev.id, filename)
+
+        current_layout = self.get_revision_directory_layout()
+
+        # only one copy of a payload is kept, so a revision directory in
+        # another layout is emptied as its payloads are rewritten
+        for layout in REVISION_DIRECTORY_LAYOUTS:
+            if target_store is not None or layout != current_layout:
+                self.remove_directory_payload(rev, filename, layout)
+
+        if target_store is not None:
+            target_store.write(rev.id, filename, data)
+            return
+
+        self.write_payload_file(\
+                os.path.join(self.get_revision_directory_path(rev), filename),
+                data)
+
+    def remove_payload(self, rev, filename):
+        for payload_store in self.db_payload_stores:
+            payload_store.remove(rev.id, filename)
+        for layout in REVISION_DIRECTORY_LAYOUTS:
+            self.remove_directory_payload(rev, filename, layout)
+
+    def remove_directory_payload(self, rev, filename, layout=None):
+        dir_path = self.get_revision_directory_path(rev, layout)
+        file_path = os.path.join(dir_path, filename)
+
+        # also removes the revision directory if it's left empty
+        self.remove_payload_file(file_path)
+
+    # Latest revision of each document, as a dict of DocumentHead by
+    # document path, in a single query (see DiffRunner.scan_files_for_changes)
+    def get_document_heads(self):
+        heads = {}
+        for row in self.iter_rows("SELECT document_relative_path,"+\
+                    " head_revision_id, head_datetime_diffed_on,"+\
+                    " head_content_hash"+\
+                    " FROM "+DOCUMENTS_TABLE_NAME+\
+                    " WHERE head_revision_id IS NOT NULL;"):
+            heads[row[0]] = DocumentHead(*row[1:])
+        return heads
+
+    # DocumentHead of a single document, or None if it has no revision yet
+    def get_document_head(self, doc_relative_path):
+        self.db_cursor.execute("SELECT head_revision_id,"+\
+                    " head_datetime_diffed_on, head_content_hash"+\
+                    " FROM "+DOCUMENTS_TABLE_NAME+\
+                    " WHERE document_relative_path=?"+\
+                    " AND head_revision_id IS NOT NULL;",
+                    (doc_relative_path,))
+        row = self.db_cursor.fetchone()
+        if row is None:
+            return None
+        return DocumentHead(*row)
+
+    def update_document_head(self, doc_relative_path, revision_id,
+                                datetime_diffed_on, content_hash):
+        self.db_cursor.execute(\
+                "INSERT OR IGNORE INTO "+DOCUMENTS_TABLE_NAME+\
+                " (document_relative_path) VALUES (?)",
+                (doc_relative_path,))
+        self.db_cursor.execute(\
+                "UPDATE "+DOCUMENTS_TABLE_NAME+\
+                " SET head_revision_id=?, head_datetime_diffed_on=?,"+\
+                " head_content_hash=?"+\
+                " WHERE document_relative_path=?"+\
+                " AND (head_datetime_diffed_on IS NULL"+\
+                    " OR head_datetime_diffed_on <= ?)",
+                (revision_id, datetime_diffed_on, content_hash,
+                 doc_relative_path, datetime_diffed_on))
+
+    # Metadata of all revisions as a RevisionTable (compact columns rather
+    # than Revision objects), for operations over the whole db.
+    def load_revision_table(self):
+        table = RevisionTable()
+
+        # scheduled_date is converted to epoch days by SQLite, so no date
+        # object is ever created
+        rows = self.iter_rows("SELECT id, document_relative_path,"+\
+                    " CAST(julianday(scheduled_date) - %s AS INTEGER),"\
+                                % (JULIAN_DAY_OF_EPOCH,)+\
+                    " num_revisions_done, hidden"+\
+                    " FROM "+REVISIONS_TABLE_NAME+" ORDER BY id;")
+
+        for row in rows:
+            table.append(*row)
+
+        return table
 
     def get_all_watched_document_paths(self):
-        # watched documents are simply the ones which have a directory
-        return os.listdir(self.revisions_content_abspath)
+        # watched documents are the ones with a row in the documents table,
+        # whether they have a revision yet or not
+        return [row[0] for row in self.iter_rows(\
+                    "SELECT document_relative_path FROM "+DOCUMENTS_TABLE_NAME+\
+                    " ORDER BY document_relative_path;")]
 
     def get_ignored_document_relative_paths(self):
-        f = open(self.ignored_list_file_abspath, "r")
-        entries = f.readlines()
-        entries = [l.rstrip() for l in entries]
-        f.close()
-
-        return entries
+        return [row[0] for row in self.iter_rows(\
+                    "SELECT document_relative_path"+\
+                    " FROM "+IGNORED_DOCUMENTS_TABLE_NAME+\
+                    " ORDER BY document_relative_path;")]
 
     def add_docs_to_watched_list(self, docs_relative_paths):
-        # TODO: make this be able to handle subdirectories
-        for rel_path in docs_relative_paths:
-            complete_path = os.path.join(\
-                                self.revisions_content_abspath, rel_path)
+        self.db_cursor.executemany(\
+                "INSERT OR IGNORE INTO "+DOCUMENTS_TABLE_NAME+\
+                " (document_relative_path) VALUES (?)",
+                [(p,) for p in docs_relative_paths])
 
-            # TODO: handle errors, at least "dir already exists"
-            os.mkdir(complete_path)
+        self.commit_unless_in_transaction()
 
     def add_docs_to_ignored_list(self, docs_relative_paths):
-        f = open(self.ignored_list_file_abspath, "a")
-        for rel_path in docs_relative_paths:
-            print >>f, rel_path
-        f.close()
+        self.db_cursor.executemany(\
+                "INSERT OR IGNORE INTO "+IGNORED_DOCUMENTS_TABLE_NAME+\
+                " (document_relative_path) VALUES (?)",
+                [(p,) for p in docs_relative_paths])
+
+        self.commit_unless_in_transaction()
 
 class Revision(object):
+    # a db can hold hundreds of thousands of revisions, no __dict__ for them
+    __slots__ = ('storage', 'id', 'document_relative_path',
+                 'datetime_diffed_on', 'scheduled_date', 'num_revisions_done',
+                 'hidden', '_content', '_changelist')
+
     def __init__(self, storage):
         self.storage = storage
 
@@ -168,8 +959,35 @@ class Revision(object):
         self.num_revisions_done = None
         self.hidden = None
 
-        self.content = None
-        self.changelist = None
+        # see the content and changelist properties
+        self._content = None
+        self._changelist = None
+
+    # For revisions already stored, the content and changelist are only read
+    # on first access, so the revisions can be listed, counted, filtered...
+    # without touching their payloads.
+    @property
+    def content(self):
+        if self._content is None and self.id is not None:
+            self.load_content()
+        return self._content
+
+    @content.setter
+    def content(self, content):
+        self._content = content
+
+    @property
+    def changelist(self):
+        if self._changelist is None and self.id is not None:
+            self.load_changelist()
+        return self._changelist
+
+    # may be set to a Changelist or to a changelist in the old text format
+    @changelist.setter
+    def changelist(self, changelist):
+        if isinstance(changelist, basestring):
+            changelist = Changelist.from_text(changelist)
+        self._changelist = changelist
 
     def __str__(self):
         return ("{Revision object, "+\
@@ -187,61 +1005,56 @@ class Revision(object):
                     self.scheduled_date,
                     self.num_revisions_done,
                     self.hidden,
-                    None if self.content is None else len(self.content),
-                    None if self.changelist is None else len(self.changelist))
+                    None if self._content is None else len(self._content),
+                    None if self._changelist is None \
+                            else len(self._changelist))
 
-    def perform_insert(self, no_content=False):
-        self.storage.db_cursor.execute(\
-            'INSERT INTO '+REVISIONS_TABLE_NAME\
-                 +' (' + ALL_COL_NAMES + ') '\
-                 +'VALUES (null, ?, ?, ?, ?, ?)', # null is for ID
-                    (self.document_relative_path,\
-                     self.datetime_diffed_on,\
-                     self.scheduled_date,\
-                     self.num_revisions_done,\
-                     False)) # hidden = False, at first
-
-        # set id from autoassigned value
-        # rowid is the same as primary key for sqlite
-        # http://www.sqlite.org/c3ref/last_insert_rowid.html
-        self.id = self.storage.db_cursor.lastrowid
+    def perform_insert(self, no_content=False, previous_revision=None):
+        self.id = self.storage.insert_revision(self)
 
+        content_hash = None
         if not no_content:
-            self.create_revision_directory()
-
-            self.save_content()
+            self.save_content(previous_revision=previous_revision)
             self.save_changelist()
+            content_hash = hash_data(\
+                    self.content.encode(self.storage.config.notes_codec))
 
-        self.storage.db_connection.commit()
+        self.storage.update_document_head(self.document_relative_path,
+                            self.id, self.datetime_diffed_on, content_hash)
+
+        self.storage.commit_unless_in_transaction()
+
+    # Deletes the revision and its payloads. With remove_directory=False, the
+    # revision directory is left to the caller, e.g. to remove it only once
+    # the deletion is committed.
+    # Revisions whose content is a delta against this one must be made
+    # keyframes first (see core.compaction).
+    def perform_delete(self, remove_directory=True):
+        assert self.id is not None
+
+        for filename in PAYLOAD_FILENAMES:
+            self.storage.payload_cache.invalidate(self.id, filename)
+
+        self.storage.delete_revision(self, remove_directory=remove_directory)
+
+        self.storage.commit_unless_in_transaction()
 
     def update_scheduled_date(self, scheduled_for, update_num_revisions=False):
         assert self.storage is not None
         assert self.id is not None
 
-        if update_num_revisions:
-            self.storage.db_cursor.execute(\
-                'UPDATE '+REVISIONS_TABLE_NAME+\
-                ' SET scheduled_date=?, num_revisions_done=?'+\
-                ' WHERE id=?',
-                    (scheduled_for,self.num_revisions_done,self.id))
-        else:
-            self.storage.db_cursor.execute(\
-                'UPDATE '+REVISIONS_TABLE_NAME+' SET scheduled_date=? WHERE id=?',
-                    (scheduled_for,self.id))
+        self.storage.update_revision_schedule(self.id, scheduled_for,
+                self.num_revisions_done if update_num_revisions else None)
 
-        self.storage.db_connection.commit()
+        self.storage.commit_unless_in_transaction()
 
     def set_hidden_state(self, hidden=True):
         assert self.storage is not None
         assert self.id is not None
 
-        hidden_value = (1 if hidden else 0)
-
-        self.storage.db_cursor.execute(\
-                'UPDATE '+REVISIONS_TABLE_NAME+' SET hidden=? WHERE id=?',
-                    (hidden_value,self.id))
+        self.storage.update_revision_hidden(self.id, hidden)
 
-        self.storage.db_connection.commit()
+        self.storage.commit_unless_in_transaction()
 
     @staticmethod
     def create_from_record(storage, record, load_diff_content=True):
@@ -254,6 +1067,17 @@ class Revision(object):
         r.num_revisions_done = record[4]
         r.hidden = (record[5] != 0)
 
+        # payloads joined by Storage.get_revision_select_statement (NULL if
+        # the revision's payloads are stored elsewhere, or as a delta)
+        if len(record) > 6:
+            codec = storage.config.notes_codec
+            dictionaries = storage.payload_dictionaries
+            if record[6] is not None:
+                r.content = dictionaries.decompress(record[6]).decode(codec)
+            if record[7] is not None:
+                r.changelist = Changelist.from_bytes(\
+                                    dictionaries.decompress(record[7]))
+
         if load_diff_content:
             r.load_diff_content()
 
@@ -265,54 +1089,84 @@ class Revision(object):
         self.load_changelist()
 
     @staticmethod
-    def get_revision_from_id(storage, id):
-        storage.db_cursor.execute("SELECT "+ALL_COL_NAMES+\
-                                    " FROM "+REVISIONS_TABLE_NAME+\
-                                    " WHERE id=?;",
-                                    (id,))
+    def get_revision_from_id(storage, id, load_diff_content=False):
+        return storage.get_revision_from_id(id,
+                                    load_diff_content=load_diff_content)
 
-        results = []
-        rows = storage.db_cursor.fetchall()
-        for row in rows:
-            results.append(Revision.create_from_record(storage, row))
-
-        assert len(results) <= 1
-
-        if results:
-            return results[0]
-        else:
-            return None
+    @staticmethod
+    def iter_all_revisions(storage, load_diff_content=False):
+        return storage.iter_all_revisions(load_diff_content=load_diff_content)
 
     # a "print" rather than a "get", to print as we fetch... which might take
     # a long time with thousands of reviews
     # more for debugging purposes
     @staticmethod
     def print_all_revisions(storage):
-        storage.db_cursor.execute("SELECT "+ALL_COL_NAMES+\
-                                  " FROM "+REVISIONS_TABLE_NAME+";")
-
-        results = []
-        rows = storage.db_cursor.fetchall()
-        for row in rows:
-            print Revision.create_from_record(storage, row)
-        return results
+        for rev in Revision.iter_all_revisions(storage):
+            print rev
 
+    # see StorageBackend.iter_revisions_scheduled_before for limit and after
     @staticmethod
-    def get_all_revisions_scheduled_before(storage, date=None):
+    def iter_all_revisions_scheduled_before(storage, date=None,
+                                            include_hidden=False,
+                                            load_diff_content=False,
+                                            limit=None, after=None):
         if date is None:
             date = datetime.date.today()
 
-        storage.db_cursor.execute("SELECT "+ALL_COL_NAMES+\
-                                    " FROM "+REVISIONS_TABLE_NAME+\
-                                    " WHERE scheduled_date <= ?;",
-                                    (date,))
+        return storage.iter_revisions_scheduled_before(date,
+                                    include_hidden=include_hidden,
+                                    load_diff_content=load_diff_content,
+                                    limit=limit, after=after)
 
-        results = []
-        rows = storage.db_cursor.fetchall()
-        for row in rows:
-            results.append(Revision.create_from_record(storage, row,
-                                                       load_diff_content=True))
-        return results
+    @staticmethod
+    def get_all_revisions_scheduled_before(storage, date=None,
+                                           include_hidden=False,
+                                           load_diff_content=False,
+                                           limit=None, after=None):
+        return list(Revision.iter_all_revisions_scheduled_before(storage,
+                                    date=date,
+                                    include_hidden=include_hidden,
+                                    load_diff_content=load_diff_content,
+                                    limit=limit, after=after))
+
+    # where the revision is in the order of the due revisions, see
+    # StorageBackend.iter_revisions_scheduled_before
+    def get_due_order_key(self):
+        return (self.scheduled_date, self.id)
+
+    # the revision diffed just before this one for the same document (or
+    # distance revisions before), or None
+    def get_previous_revision(self, distance=1):
+        return self.storage.get_previous_revision(self, distance)
+
+    # the revision diffed just after this one for the same document, or None
+    def get_next_revision(self):
+        return self.storage.get_next_revision(self)
+
+    # position of this revision in its document's history (0 for the first)
+    def count_previous_revisions(self):
+        return self.storage.count_previous_revisions(self)
+
+    # the revision this one's delta applies to, see save_content
+    def get_delta_base(self):
+        base_id = self.storage.get_delta_base_id(self)
+        if base_id is None:
+            return self.get_previous_revision()
+        return self.storage.get_revision_from_id(base_id)
+
+    # the revisions stored as a delta against this one
+    def get_delta_dependents(self):
+        dependents = [self.storage.get_revision_from_id(id) for id in \
+                            self.storage.get_delta_dependent_ids(self)]
+
+        next_rev = self.get_next_revision()
+        if next_rev is not None and \
+                self.storage.get_delta_base_id(next_rev) is None:
+            dependents.append(next_rev)
+
+        return [rev for rev in dependents \
+                    if rev.has_file(REVISION_DELTA_FILENAME)]
 
     def get_relative_path_plus_timestamp(self):
         if self.document_relative_path is None or self.datetime_diffed_on is None:
@@ -322,51 +1176,121 @@ class Revision(object):
 
         return os.path.join(self.document_relative_path, ts)
 
+    # in the current layout, see Storage.get_revision_directory_path
     def get_full_directory_path(self):
-        return os.path.join(self.storage.revisions_content_abspath,
-                                self.get_relative_path_plus_timestamp())
+        return self.storage.get_revision_directory_path(self)
 
-    def create_revision_directory(self):
-        # first create the document directory
-        doc_dir = os.path.join(self.storage.revisions_content_abspath,
-                                self.document_relative_path)
-        if not os.path.exists(doc_dir):
-            # TODO: handle mkdir errors
-            os.mkdir(doc_dir)
+    # Payload primitives, see the payload methods of StorageBackend.
+    # Payloads read are kept in the storage's payload cache.
+    def has_file(self, filename):
+        if self.storage.payload_cache.contains(self.id, filename):
+            return True
+        return self.storage.has_payload(self, filename)
 
-        os.mkdir(self.get_full_directory_path())
+    # hash of the payload, if it's known without reading it, otw None
+    def get_file_hash(self, filename):
+        return self.storage.get_payload_hash(self, filename)
 
-    def get_file_content(self, filename):
-        file_path = os.path.join(self.get_full_directory_path(), filename)
+    def get_file_bytes(self, filename):
+        data = self.storage.payload_cache.get(self.id, filename)
+        if data is not None:
+            return data
 
-        f = codecs.open(file_path, "r", self.storage.config.notes_codec)
-        content = f.read()
-        f.close()
+        data = self.storage.read_payload(self, filename)
+        self.storage.payload_cache.put(self.id, filename, data)
+        return data
 
-        return content
+    def set_file_bytes(self, filename, data):
+        self.storage.payload_cache.invalidate(self.id, filename)
+        self.storage.write_payload(self, filename, data)
 
-    def set_file_content(self, filename, content):
-        file_path = os.path.join(self.get_full_directory_path(), filename)
+    def remove_file(self, filename):
+        self.storage.payload_cache.invalidate(self.id, filename)
+        self.storage.remove_payload(self, filename)
 
-        f = codecs.open(file_path, "w", self.storage.config.notes_codec)
-        f.write(content)
-        f.close()
+    def get_file_content(self, filename):
+        return self.get_file_bytes(filename).decode(\
+                                        self.storage.config.notes_codec)
 
-    def load_content(self, force=False):
-        if self.content is None or force:
-            self.content = self.get_file_content(REVISION_CONTENT_FILENAME)
+    def set_file_content(self, filename, content):
+        self.set_file_bytes(filename,
+                            content.encode(self.storage.config.notes_codec))
 
-    def save_content(self):
+    def load_content(self, force=False):
+        if self._content is None or force:
+            if self.has_file(REVISION_DELTA_FILENAME):
+                self._content = self.rebuild_content_from_deltas()
+            else:
+                self._content = \
+                        self.get_file_content(REVISION_CONTENT_FILENAME)
+
+    # walk back from base to base to a keyframe, then replay the deltas
+    # forward
+    def rebuild_content_from_deltas(self):
+        deltas = []
+        rev = self
+        while rev.has_file(REVISION_DELTA_FILENAME):
+            deltas.append(rev.get_file_bytes(REVISION_DELTA_FILENAME))
+            rev = rev.get_delta_base()
+            if rev is None:
+                raise RuntimeError("Delta chain of %s is missing its keyframe"\
+                                        % (self.get_relative_path_plus_timestamp(),))
+
+        data = rev.get_file_content(REVISION_CONTENT_FILENAME)\
+                                        .encode(DELTA_ENCODING)
+        for delta in reversed(deltas):
+            data = StringOps.applyBinCompact(data, delta)
+
+        return data.decode(DELTA_ENCODING)
+
+    # With delta_keyframe_interval = N (> 0) in the config, only one revision
+    # out of N of a document (a "keyframe") gets its complete text stored,
+    # the others only store a delta against an earlier revision, chosen by
+    # get_skip_delta_base_offset.
+    # previous_revision may be passed if the caller already has it loaded.
+    def save_content(self, previous_revision=None):
         assert self.content is not None
-        self.set_file_content(REVISION_CONTENT_FILENAME, self.content)
+
+        interval = getattr(self.storage.config, 'delta_keyframe_interval', 0)
+        offset = 0
+        if interval > 0:
+            offset = self.count_previous_revisions() % interval
+
+        if offset != 0:
+            distance = offset - get_skip_delta_base_offset(offset)
+            if distance == 1 and previous_revision is not None:
+                base = previous_revision
+            else:
+                base = self.get_previous_revision(distance)
+            base.load_content()
+
+            delta = StringOps.getBinCompactForDiff(\
+                            base.content.encode(DELTA_ENCODING),
+                            self.content.encode(DELTA_ENCODING))
+
+            self.set_file_bytes(REVISION_DELTA_FILENAME, delta)
+            self.remove_file(REVISION_CONTENT_FILENAME)
+            self.storage.set_delta_base(self,
+                                        None if distance == 1 else base.id)
+        else:
+            self.set_file_content(REVISION_CONTENT_FILENAME, self.content)
+            self.remove_file(REVISION_DELTA_FILENAME)
+            self.storage.set_delta_base(self, None)
 
     def load_changelist(self, force=False):
-        if self.changelist is None or force:
-            self.changelist = self.get_file_content(CHANGELIST_FILENAME)
+        if self._changelist is None or force:
+            if self.has_file(CHANGELIST_BINARY_FILENAME):
+                self._changelist = Changelist.from_bytes(\
+                            self.get_file_bytes(CHANGELIST_BINARY_FILENAME))
+            else:
+                self._changelist = Changelist.from_text(\
+                            self.get_file_content(CHANGELIST_FILENAME))
 
     def save_changelist(self):
         assert self.changelist is not None
-        self.set_file_content(CHANGELIST_FILENAME, self.changelist)
+        self.set_file_bytes(CHANGELIST_BINARY_FILENAME,
+                            self.changelist.to_bytes())
+        self.remove_file(CHANGELIST_FILENAME)
 
 ##############
 # tests
@@ -405,6 +1329,22 @@ def teardown_temp_db(storage):
     storage.close_connection()
     shutil.rmtree(storage.config.diffrevision_base_directory)
 
+def insert_test_revision(storage, doc_relative_path, datetime_diffed_on,
+                         content, changelist=u"0"):
+    r = Revision(storage)
+
+    r.document_relative_path = doc_relative_path
+    r.datetime_diffed_on = datetime_diffed_on
+    r.scheduled_date = datetime.date.today()
+    r.num_revisions_done = 0
+
+    r.content = content
+    r.changelist = changelist
+
+    r.perform_insert()
+
+    return r
+
 def setup_temp_wiki_and_corresponding_rev_for_test_ignored_watched_new():
     import tempfile, shutil
     notes_dir = tempfile.mkdtemp()
@@ -438,6 +1378,12 @@ def test_ignored_watched_new():
 
     assert set(watched) == set(['notes_watched.txt','notes_watched2.txt'])
     assert set(ignored) == set(['notes_ignored.txt','notes_ignored2.txt'])
+
+    # adding again is harmless
+    store.add_docs_to_watched_list(["notes_watched.txt"])
+    store.add_docs_to_ignored_list(["notes_ignored.txt"])
+    assert len(store.get_all_watched_document_paths()) == 2
+    assert len(store.get_ignored_document_relative_paths()) == 2
     
     shutil.rmtree(notes_dir)
     teardown_temp_db(store)
@@ -573,17 +1519,685 @@ def test_update_scheduled_date_and_update_num_revisions():
     teardown_temp_db(storage)
     
 
-if __name__ == '__main__':
+def test_delta_storage_keyframes():
+    storage = setup_temp_db()
+    storage.config.delta_keyframe_interval = 3
 
-    # otw when running tests we can't import other modules
-    this_files_path = os.path.split(os.path.abspath(__file__))[0]
-    sys.path.append(os.path.join(this_files_path,".."))
+    start = datetime.datetime.now() - datetime.timedelta(days=2)
+    texts = [u"\n".join([u"line %d \xe9" % j for j in range(i+1)])
+                for i in range(5)]
+    for i, text in enumerate(texts):
+        insert_test_revision(storage, "mynotes.txt",
+                             start + datetime.timedelta(minutes=i), text)
+
+    storage.close_connection()
+    storage2 = Storage(storage.config)
+
+    revs = storage2.get_revisions_for_document_path_sorted("mynotes.txt")
+
+    assert [r.content for r in revs] == texts
+
+    # keyframes are the 1st and 4th revisions, the others are deltas
+    keyframes = [r.has_file(REVISION_CONTENT_FILENAME) for r in revs]
+    deltas = [r.has_file(REVISION_DELTA_FILENAME) for r in revs]
+    assert keyframes == [True, False, False, True, False]
+    assert deltas == [not k for k in keyframes]
+
+    teardown_temp_db(storage2)
+
+def test_convert_document_content_storage():
+    storage = setup_temp_db()
+    storage.config.delta_keyframe_interval = 2
+
+    start = datetime.datetime.now() - datetime.timedelta(days=2)
+    texts = [u"a\nb", u"a\nb\nc", u"a\nc", u"a\nc\nd"]
+    for i, text in enumerate(texts):
+        insert_test_revision(storage, "mynotes.txt",
+                             start + datetime.timedelta(minutes=i), text)
+
+    # back to complete text for every revision
+    storage.config.delta_keyframe_interval = 0
+    assert storage.convert_document_content_storage("mynotes.txt") == 4
+
+    revs = storage.get_revisions_for_document_path_sorted("mynotes.txt")
+
+    assert [r.content for r in revs] == texts
+    for r in revs:
+        assert r.has_file(REVISION_CONTENT_FILENAME)
+        assert not r.has_file(REVISION_DELTA_FILENAME)
+
+    teardown_temp_db(storage)
+
+def test_skip_deltas_and_text_at_any_time():
+    storage = setup_temp_db()
+    storage.config.delta_keyframe_interval = 16
+
+    start = datetime.datetime(2012, 1, 1, 10)
+    texts = [u"\n".join([u"line %d \xe9" % j for j in range(i+1)])
+                for i in range(20)]
+    for i, text in enumerate(texts):
+        insert_test_revision(storage, "mynotes.txt",
+                             start + datetime.timedelta(minutes=i), text)
+
+    def get_chain_length(rev):
+        length = 0
+        while rev.has_file(REVISION_DELTA_FILENAME):
+            rev = rev.get_delta_base()
+            length += 1
+        return length
+
+    storage.close_connection()
+    storage = Storage(storage.config)
+    revs = storage.get_revisions_for_document_path_sorted("mynotes.txt",
+                                                    load_diff_content=False)
+
+    # 15 against 14, 14 against 12, 12 against 8, 8 against the keyframe
+    assert [revs[i].get_delta_base().id for i in (15, 14, 12, 8)] == \
+                [revs[i].id for i in (14, 12, 8, 0)]
+    assert revs[16].has_file(REVISION_CONTENT_FILENAME)
+    assert max([get_chain_length(r) for r in revs]) == 4
+
+    for i, text in enumerate(texts):
+        dt = start + datetime.timedelta(minutes=i)
+        assert storage.get_document_text_at("mynotes.txt", dt) == text
+        assert storage.get_document_text_at("mynotes.txt",
+                            dt + datetime.timedelta(seconds=30)) == text
+    assert storage.get_document_text_at("mynotes.txt",
+                            start - datetime.timedelta(seconds=1)) is None
+    assert storage.get_document_text_at("othernotes.txt", start) is None
+
+    # and back and forth from complete text
+    storage.config.delta_keyframe_interval = 0
+    storage.convert_document_content_storage("mynotes.txt")
+    assert list(storage.iter_rows("SELECT COUNT(*) FROM "+\
+                                DELTA_BASES_TABLE_NAME)) == [(0,)]
+    storage.config.delta_keyframe_interval = 8
+    storage.convert_document_content_storage("mynotes.txt")
+    revs = storage.get_revisions_for_document_path_sorted("mynotes.txt")
+    assert [r.content for r in revs] == texts
+    assert max([get_chain_length(r) for r in revs]) == 3
+
+    teardown_temp_db(storage)
+
+def test_blob_payload_storage_dedup():
+    storage = setup_temp_db()
+    storage.config.payload_storage = PAYLOAD_STORAGE_BLOBS
+
+    start = datetime.datetime.now() - datetime.timedelta(days=2)
+    r1 = insert_test_revision(storage, "mynotes.txt", start, u"same\ntext")
+    r2 = insert_test_revision(storage, "mynotes.txt",
+                    start + datetime.timedelta(minutes=1), u"changed\ntext")
+    # reverted, then the same text in another note
+    r3 = insert_test_revision(storage, "mynotes.txt",
+                    start + datetime.timedelta(minutes=2), u"same\ntext")
+    r4 = insert_test_revision(storage, "othernotes.txt", start, u"same\ntext")
+
+    h = r1.get_file_hash(REVISION_CONTENT_FILENAME)
+    assert h == hash_data(u"same\ntext".encode("utf-8"))
+    assert r3.get_file_hash(REVISION_CONTENT_FILENAME) == h
+    assert storage.blob_store.get_refcount(h) == 3
+    assert not os.path.exists(r1.get_full_directory_path())
+
+    rev = Revision.get_revision_from_id(storage, r3.id)
+    assert rev.content == u"same\ntext"
+    assert rev.changelist == Changelist([(0, 1)])
+
+    # converting back to directories releases the blobs
+    storage.config.payload_storage = PAYLOAD_STORAGE_DIRECTORIES
+    storage.convert_document_content_storage("mynotes.txt")
+    storage.convert_document_content_storage("othernotes.txt")
+
+    assert storage.blob_store.get_refcount(h) == 0
+    assert r1.get_file_hash(REVISION_CONTENT_FILENAME) is None
+    assert r1.has_file(REVISION_CONTENT_FILENAME)
+
+    rev = Revision.get_revision_from_id(storage, r4.id)
+    assert rev.content == u"same\ntext"
+
+    teardown_temp_db(storage)
+
+def test_sqlite_payload_storage_single_select():
+    storage = setup_temp_db()
+    storage.config.payload_storage = PAYLOAD_STORAGE_SQLITE
+
+    start = datetime.datetime.now() - datetime.timedelta(days=2)
+    r1 = insert_test_revision(storage, "mynotes.txt", start,
+                                        u"blah\n\xe9t\xe9", u"0\n1")
+    r2 = insert_test_revision(storage, "mynotes.txt",
+                    start + datetime.timedelta(minutes=1), u"blah\n\xe9t\xe9\nb",
+                    u"2")
+
+    assert not os.path.exists(r1.get_full_directory_path())
+    assert r1.has_file(REVISION_CONTENT_FILENAME)
+
+    # payloads come with the revision records, no separate read
+    def fail_reading(self, filename):
+        raise AssertionError("payload read separately")
+    get_file_bytes = Revision.get_file_bytes
+    Revision.get_file_bytes = fail_reading
+    try:
+        revs = Revision.get_all_revisions_scheduled_before(storage,
+                                                    load_diff_content=True)
+    finally:
+        Revision.get_file_bytes = get_file_bytes
+
+    assert [r.content for r in revs] == [r1.content, r2.content]
+    assert [r.changelist for r in revs] == \
+                [Changelist([(0, 2)]), Changelist([(2, 3)])]
+
+    # and back to the directory layout
+    storage.config.payload_storage = PAYLOAD_STORAGE_DIRECTORIES
+    storage.convert_document_content_storage("mynotes.txt")
+
+    assert not storage.payload_table.contains(r1.id, REVISION_CONTENT_FILENAME)
+    assert os.path.exists(os.path.join(r1.get_full_directory_path(),
+                                       REVISION_CONTENT_FILENAME))
+    rev = Revision.get_revision_from_id(storage, r2.id)
+    assert rev.content == r2.content
+
+    teardown_temp_db(storage)
+
+def test_schema_migration_of_old_db():
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+
+    # db as created before 2012-12-19, without 'hidden' nor user_version
+    db_connection = sqlite3.connect(os.path.join(tmpdir, DB_FILENAME))
+    db_connection.execute("create table "+REVISIONS_TABLE_NAME+"("+\
+                            "id INTEGER PRIMARY KEY,"+\
+                            "document_relative_path varchar(256),"+\
+                            "datetime_diffed_on timestamp,"+\
+                            "scheduled_date date,"+\
+                            "num_revisions_done integer)")
+    db_connection.execute("INSERT INTO "+REVISIONS_TABLE_NAME+\
+                            " VALUES (null, 'old.txt', '2012-01-01 10:00:00',"+\
+                            " '2012-01-03', 0)")
+    db_connection.execute("INSERT INTO "+REVISIONS_TABLE_NAME+\
+                            " VALUES (null, 'old.txt', '2011-12-01 10:00:00',"+\
+                            " '2011-12-03', 0)")
+    db_connection.commit()
+    db_connection.close()
+
+    rev_dir = os.path.join(tmpdir, REVISIONS_CONTENT_DIRNAME,
+                           "old.txt", "2012-01-01-10-00-00")
+    os.makedirs(rev_dir)
+    write_test_file(os.path.join(rev_dir, REVISION_CONTENT_FILENAME), "old")
+    write_test_file(os.path.join(rev_dir, CHANGELIST_FILENAME), "0")
+
+    # watched without revisions yet, and ignored, the old way
+    os.mkdir(os.path.join(tmpdir, REVISIONS_CONTENT_DIRNAME, "watched.txt"))
+    write_test_file(os.path.join(tmpdir, IGNORED_LIST_FILENAME),
+                    "ignored.txt\nignored2.txt\n")
+
+    storage = Storage(mock_config(tmpdir))
+
+    assert storage.get_schema_version() == len(SCHEMA_MIGRATIONS)
+
+    revs = Revision.get_all_revisions_scheduled_before(storage)
+    assert len(revs) == 2
+    assert revs[1].document_relative_path == "old.txt"
+    assert revs[1].hidden == False
+
+    # the documents table points to the latest revision
+    head = storage.get_document_head("old.txt")
+    assert head.revision_id == 1
+    assert head.datetime_diffed_on == datetime.datetime(2012, 1, 1, 10)
+    assert head.content_hash is None
+
+    assert storage.get_all_watched_document_paths() == \
+                ["old.txt", "watched.txt"]
+    assert storage.get_document_head("watched.txt") is None
+    assert storage.get_ignored_document_relative_paths() == \
+                ["ignored.txt", "ignored2.txt"]
+
+    # the hot queries use the indexes
+    storage.db_cursor.execute("EXPLAIN QUERY PLAN SELECT "+ALL_COL_NAMES+\
+                        " FROM "+REVISIONS_TABLE_NAME+\
+                        " WHERE document_relative_path=?"+\
+                        " ORDER BY datetime_diffed_on ASC;", ("old.txt",))
+    plan = " ".join([str(row[-1]) for row in storage.db_cursor.fetchall()])
+    assert REVISIONS_BY_DOCUMENT_INDEX_NAME in plan
+
+    storage.db_cursor.execute("EXPLAIN QUERY PLAN SELECT "+ALL_COL_NAMES+\
+                        " FROM "+REVISIONS_TABLE_NAME+\
+                        " WHERE scheduled_date <= ? AND hidden = 0;",
+                        (datetime.date.today(),))
+    plan = " ".join([str(row[-1]) for row in storage.db_cursor.fetchall()])
+    assert DUE_REVISIONS_INDEX_NAME in plan
+
+    # reconnecting doesn't migrate anything again
+    storage.close_connection()
+    storage = Storage(storage.config)
+    assert storage.get_schema_version() == len(SCHEMA_MIGRATIONS)
+
+    teardown_temp_db(storage)
+
+def test_document_heads_follow_inserts():
+    storage = setup_temp_db()
+
+    start = datetime.datetime.now() - datetime.timedelta(days=2)
+    r2 = insert_test_revision(storage, "mynotes.txt",
+                                start + datetime.timedelta(minutes=1), u"ab")
+    # an older revision (e.g. imported) doesn't become the head
+    insert_test_revision(storage, "mynotes.txt", start, u"a")
+    r3 = insert_test_revision(storage, "othernotes.txt", start, u"b")
+
+    heads = storage.get_document_heads()
+    assert sorted(heads.keys()) == ["mynotes.txt", "othernotes.txt"]
+    assert heads["mynotes.txt"] == DocumentHead(r2.id, r2.datetime_diffed_on,
+                                                hash_data("ab"))
+    assert storage.get_document_head("othernotes.txt").revision_id == r3.id
+    assert storage.get_document_head("new.txt") is None
+
+    teardown_temp_db(storage)
+
+def test_sharded_layout_and_relayout():
+    storage = setup_temp_db()
+
+    start = datetime.datetime.now() - datetime.timedelta(days=2)
+    r1 = insert_test_revision(storage, "mynotes.txt", start, u"a")
+    flat_path = r1.get_full_directory_path()
+
+    storage.config.revision_directory_layout = \
+                    REVISION_DIRECTORY_LAYOUT_SHARDED
+    sharded_path = r1.get_full_directory_path()
+    shard = get_document_shard("mynotes.txt")
+    assert sharded_path == os.path.join(storage.revisions_content_abspath,
+                shard[0], shard[1], "mynotes.txt",
+                start.strftime(TIMESTAMP_FORMAT))
+
+    # not moved yet, still readable
+    r1 = Revision.get_revision_from_id(storage, r1.id)
+    assert r1.content == u"a"
+
+    r2 = insert_test_revision(storage, "mynotes.txt",
+                            start + datetime.timedelta(minutes=1), u"b")
+    assert os.path.isdir(r2.get_full_directory_path())
+
+    assert storage.move_revision_directory(r1)
+    assert not storage.move_revision_directory(r2)
+    assert os.path.isdir(sharded_path)
+    # the flat document directory was left empty, so it's gone
+    assert not os.path.exists(os.path.dirname(flat_path))
+
+    storage.payload_cache.clear()
+    assert Revision.get_revision_from_id(storage, r1.id).content == u"a"
+    assert [d for d in storage.iter_document_directories()] == \
+                [("mynotes.txt", os.path.dirname(sharded_path))]
+
+    teardown_temp_db(storage)
+
+def test_transaction_commits_once():
+    storage = setup_temp_db()
+
+    db_path = os.path.join(storage.config.diffrevision_base_directory,
+                           DB_FILENAME)
+    other_connection = sqlite3.connect(db_path)
+
+    def count_visible_revisions():
+        return other_connection.execute(\
+                    "SELECT COUNT(*) FROM "+REVISIONS_TABLE_NAME).fetchone()[0]
+
+    start = datetime.datetime.now() - datetime.timedelta(days=2)
+    with storage.transaction():
+        r1 = insert_test_revision(storage, "mynotes.txt", start, u"a")
+        with storage.transaction():
+            r2 = insert_test_revision(storage, "mynotes.txt",
+                        start + datetime.timedelta(minutes=1), u"a\nb")
+        r1.set_hidden_state(True)
 
+        # nothing committed until the outermost transaction ends
+        assert count_visible_revisions() == 0
+
+    assert count_visible_revisions() == 2
+
+    # rolled back on errors
+    try:
+        with storage.transaction():
+            r2.set_hidden_state(True)
+            raise ValueError()
+    except ValueError:
+        pass
+
+    assert not Revision.get_revision_from_id(storage, r2.id).hidden
+    assert Revision.get_revision_from_id(storage, r1.id).hidden
+
+    other_connection.close()
+    teardown_temp_db(storage)
+
+def test_payload_files_put_in_place_on_commit():
+    storage = setup_temp_db()
+    storage.config.delta_keyframe_interval = 2
+
+    start = datetime.datetime.now() - datetime.timedelta(days=2)
+    with storage.transaction():
+        r1 = insert_test_revision(storage, "mynotes.txt", start, u"a")
+        r2 = insert_test_revision(storage, "mynotes.txt",
+                        start + datetime.timedelta(minutes=1), u"a\nb")
+
+        content_path = os.path.join(r1.get_full_directory_path(),
+                                    REVISION_CONTENT_FILENAME)
+        # only the temporary file exists until the commit, but the
+        # transaction sees the revision's content (r2's delta needs it)
+        assert not os.path.exists(content_path)
+        assert Revision.get_revision_from_id(storage, r1.id).content == u"a"
+
+    assert os.path.exists(content_path)
+    assert sorted(os.listdir(r2.get_full_directory_path())) == \
+            sorted([REVISION_DELTA_FILENAME, CHANGELIST_BINARY_FILENAME])
+
+    # a rolled back rewrite leaves the old files as they were
+    try:
+        with storage.transaction():
+            r1.set_file_content(REVISION_CONTENT_FILENAME, u"rewritten")
+            raise ValueError()
+    except ValueError:
+        pass
+
+    storage.payload_cache.clear()
+    assert Revision.get_revision_from_id(storage, r1.id).content == u"a"
+    assert sorted(os.listdir(r1.get_full_directory_path())) == \
+            sorted([REVISION_CONTENT_FILENAME, CHANGELIST_BINARY_FILENAME])
+
+    teardown_temp_db(storage)
+
+# runs fn in a transaction whose db commit fails
+def assert_commit_fails(storage, fn):
+    class FailingConnection(object):
+        def __init__(self, connection):
+            self.connection = connection
+        def commit(self):
+            raise sqlite3.OperationalError("database is locked")
+        def __getattr__(self, name):
+            return getattr(self.connection, name)
+
+    connections = storage.connections
+    get_connection = connections.get_connection
+    connections.get_connection = \
+                    lambda: FailingConnection(get_connection())
+    try:
+        with storage.transaction():
+            fn()
+        assert False
+    except sqlite3.OperationalError:
+        pass
+    finally:
+        connections.get_connection = get_connection
+
+def test_blobs_removed_after_the_commit_only():
+    storage = setup_temp_db()
+    storage.config.payload_storage = PAYLOAD_STORAGE_BLOBS
+
+    start = datetime.datetime.now() - datetime.timedelta(days=2)
+    rev = insert_test_revision(storage, "mynotes.txt", start, u"only here")
+    blob_path = storage.blob_store.get_blob_path(\
+                            rev.get_file_hash(REVISION_CONTENT_FILENAME))
+    assert os.path.exists(blob_path)
+
+    def delete():
+        rev.perform_delete()
+    assert_commit_fails(storage, delete)
+
+    # the db still refers to it
+    assert Revision.get_revision_from_id(storage, rev.id) is not None
+    assert os.path.exists(blob_path)
+    assert rev.content == u"only here"
+
+    with storage.transaction():
+        rev.perform_delete()
+    assert not os.path.exists(blob_path)
+
+    teardown_temp_db(storage)
+
+def test_payloads_rewritten_in_a_failed_commit_kept():
+    storage = setup_temp_db()
+    storage.config.delta_keyframe_interval = 2
+
+    start = datetime.datetime.now() - datetime.timedelta(days=2)
+    texts = [u"a\nb", u"a\nb\nc", u"a\nc", u"a\nc\nd"]
+    revs = [insert_test_revision(storage, "mynotes.txt",
+                    start + datetime.timedelta(minutes=i), text) \
+                for i, text in enumerate(texts)]
+
+    def rewrite():
+        # revs[2], a keyframe, becomes a delta against revs[0]
+        storage.config.delta_keyframe_interval = 4
+        storage.convert_document_content_storage("mynotes.txt")
+        # and revs[3]'s delta is rewritten in place
+        revs[3].content = texts[3]
+        storage.set_delta_base(revs[3], revs[0].id)
+        revs[3].set_file_bytes(REVISION_DELTA_FILENAME,
+                    StringOps.getBinCompactForDiff(\
+                            texts[0].encode(DELTA_ENCODING),
+                            texts[3].encode(DELTA_ENCODING)))
+    assert_commit_fails(storage, rewrite)
+
+    fresh = storage.get_revisions_for_document_path_sorted("mynotes.txt")
+    assert [r.content for r in fresh] == texts
+    assert [r.has_file(REVISION_DELTA_FILENAME) for r in fresh] == \
+                [False, True, False, True]
+    # no backup left behind
+    assert sorted(os.listdir(revs[3].get_full_directory_path())) == \
+            sorted([REVISION_DELTA_FILENAME, CHANGELIST_BINARY_FILENAME])
+
+    # committed this time
+    with storage.transaction():
+        storage.convert_document_content_storage("mynotes.txt")
+    fresh = storage.get_revisions_for_document_path_sorted("mynotes.txt")
+    assert [r.content for r in fresh] == texts
+    assert fresh[2].get_delta_base().id == revs[0].id
+    assert sorted(os.listdir(revs[2].get_full_directory_path())) == \
+            sorted([REVISION_DELTA_FILENAME, CHANGELIST_BINARY_FILENAME])
+
+    teardown_temp_db(storage)
+
+def test_payloads_loaded_on_first_access():
+    storage = setup_temp_db()
+
+    start = datetime.datetime.now() - datetime.timedelta(days=2)
+    r1 = insert_test_revision(storage, "mynotes.txt", start, u"a", u"0")
+    r2 = insert_test_revision(storage, "othernotes.txt", start, u"b", u"0")
+
+    # the payloads of r1 are gone, but listing and counting don't need them
+    shutil.rmtree(r1.get_full_directory_path())
+
+    revs = Revision.get_all_revisions_scheduled_before(storage)
+    assert len(revs) == 2
+    assert "content len=None" in str(revs[0])
+    Revision.print_all_revisions(storage)
+
+    assert Revision.get_revision_from_id(storage, r1.id).hidden == False
+
+    rev2 = Revision.get_revision_from_id(storage, r2.id)
+    assert rev2._content is None
+    assert rev2.content == u"b"
+    assert rev2.changelist == Changelist([(0, 1)])
+
+    teardown_temp_db(storage)
+
+def test_payload_cache_hits_and_invalidation():
+    storage = setup_temp_db()
+
+    start = datetime.datetime.now() - datetime.timedelta(days=2)
+    r1 = insert_test_revision(storage, "mynotes.txt", start, u"a")
+
+    assert Revision.get_revision_from_id(storage, r1.id).content == u"a"
+    misses = storage.payload_cache.misses
+
+    # the second load doesn't touch the revision directory
+    shutil.move(r1.get_full_directory_path(),
+                r1.get_full_directory_path() + ".moved")
+    rev = Revision.get_revision_from_id(storage, r1.id)
+    assert rev.content == u"a"
+    assert storage.payload_cache.hits == 1
+    assert storage.payload_cache.misses == misses
+    shutil.move(r1.get_full_directory_path() + ".moved",
+                r1.get_full_directory_path())
+
+    # writes invalidate the cached payload
+    rev.content = u"b"
+    rev.save_content()
+    assert Revision.get_revision_from_id(storage, r1.id).content == u"b"
+
+    stats = storage.payload_cache.get_stats()
+    assert stats['entries'] == 1 and stats['bytes'] == len("b")
+
+    teardown_temp_db(storage)
+
+def test_iter_revisions_in_chunks():
+    storage = setup_temp_db()
+    storage.iter_chunk_size = 2
+
+    start = datetime.datetime.now() - datetime.timedelta(days=2)
+    for i in range(5):
+        insert_test_revision(storage, "mynotes.txt",
+                    start + datetime.timedelta(minutes=i), u"text %d" % i)
+
+    # payloads are loaded (other queries) in the middle of the iteration
+    contents = [r.content for r in \
+            storage.iter_revisions_for_document_path_sorted("mynotes.txt",
+                                                    load_diff_content=False)]
+    assert contents == [u"text %d" % i for i in range(5)]
+
+    due = Revision.iter_all_revisions_scheduled_before(storage)
+    first = next(due)
+    assert first.content == u"text 0"
+    assert len(list(due)) == 4
+
+    assert len(list(Revision.iter_all_revisions(storage))) == 5
+
+    teardown_temp_db(storage)
+
+def test_due_revisions_by_page():
+    storage = setup_temp_db()
+
+    today = datetime.date.today()
+    start = datetime.datetime.now() - datetime.timedelta(days=2)
+    revs = [insert_test_revision(storage, "mynotes.txt",
+                    start + datetime.timedelta(minutes=i), u"text %d" % i) \
+                for i in range(7)]
+    # most overdue first, then by id
+    revs[5].update_scheduled_date(today - datetime.timedelta(days=3))
+    revs[2].update_scheduled_date(today - datetime.timedelta(days=1))
+    revs[4].update_scheduled_date(today - datetime.timedelta(days=1))
+    revs[3].set_hidden_state(True)
+    revs[6].update_scheduled_date(today + datetime.timedelta(days=1))
+    expected = [revs[i].id for i in (5, 2, 4, 0, 1)]
+
+    assert storage.count_revisions_scheduled_before(today) == 5
+
+    ids = []
+    after = None
+    while True:
+        page = Revision.get_all_revisions_scheduled_before(storage,
+                                                    limit=2, after=after)
+        if not page:
+            break
+        assert len(page) <= 2
+        ids.extend([r.id for r in page])
+        after = page[-1].get_due_order_key()
+    assert ids == expected
+
+    # straight from the index, without sorting
+    storage.db_cursor.execute("EXPLAIN QUERY PLAN SELECT "+ALL_COL_NAMES+\
+                        " FROM "+REVISIONS_TABLE_NAME+\
+                        " WHERE scheduled_date <= ? AND hidden = 0"+\
+                        " AND scheduled_date >= ?"+\
+                        " AND (scheduled_date > ? OR id > ?)"+\
+                        " ORDER BY scheduled_date, id LIMIT ?;",
+                        (today, today, today, 1, 2))
+    plan = " ".join([str(row[-1]) for row in storage.db_cursor.fetchall()])
+    assert DUE_REVISIONS_INDEX_NAME in plan
+    assert "TEMP B-TREE" not in plan
+
+    teardown_temp_db(storage)
+
+def test_hot_queries_use_indexes():
+    from core.sql_stats import checking_query_plans, FullScanError
+
+    storage = setup_temp_db()
+
+    today = datetime.date.today()
+    start = datetime.datetime.now() - datetime.timedelta(days=2)
+    for path in ["mynotes.txt", "othernotes.txt"]:
+        for i in range(3):
+            insert_test_revision(storage, path,
+                    start + datetime.timedelta(minutes=i), u"text %d" % i)
+
+    # what 'diff', 'today' and 'finished' run, see core.sql_stats
+    with checking_query_plans():
+        heads = storage.get_document_heads()
+        rev = Revision.get_revision_from_id(storage,
+                                        heads["mynotes.txt"].revision_id,
+                                        load_diff_content=True)
+        assert rev.content == u"text 2"
+        assert rev.get_previous_revision().content == u"text 1"
+        assert rev.get_next_revision() is None
+        assert rev.count_previous_revisions() == 2
+        assert storage.get_document_text_at("mynotes.txt",
+                    start + datetime.timedelta(minutes=1)) == u"text 1"
+        insert_test_revision(storage, "mynotes.txt",
+                    start + datetime.timedelta(minutes=3), u"text 3")
+
+        page = Revision.get_all_revisions_scheduled_before(storage, today,
+                                                           limit=2)
+        page = Revision.get_all_revisions_scheduled_before(storage, today,
+                            limit=2, after=page[-1].get_due_order_key())
+        assert storage.count_revisions_scheduled_before(today) == 7
+
+        with storage.transaction():
+            for rev in page:
+                rev.update_scheduled_date(today, update_num_revisions=True)
+        page[0].set_hidden_state(True)
+
+        # listing every revision is fine elsewhere, not there
+        try:
+            list(storage.iter_all_revisions())
+            assert False
+        except FullScanError:
+            pass
+
+    teardown_temp_db(storage)
+
+def test_text_changelist_still_read():
+    storage = setup_temp_db()
+
+    r = insert_test_revision(storage, "mynotes.txt", datetime.datetime.now(),
+                             u"a\nb\nc", Changelist([(1, 3)]))
+
+    assert r.has_file(CHANGELIST_BINARY_FILENAME)
+
+    # as written before binary changelists
+    r.remove_file(CHANGELIST_BINARY_FILENAME)
+    r.set_file_content(CHANGELIST_FILENAME, u"1\n2")
+
+    rev = Revision.get_revision_from_id(storage, r.id)
+    assert rev.changelist == Changelist([(1, 3)])
+
+    teardown_temp_db(storage)
+
+if __name__ == '__main__':
     import tempfile, shutil
     test_db_creation()
     test_base_insert_select()
     test_base_update_scheduled_date()
     test_ignored_watched_new()
     test_update_scheduled_date_and_update_num_revisions()
-
-
+    test_delta_storage_keyframes()
+    test_convert_document_content_storage()
+    test_skip_deltas_and_text_at_any_time()
+    test_blob_payload_storage_dedup()
+    test_sqlite_payload_storage_single_select()
+    test_schema_migration_of_old_db()
+    test_document_heads_follow_inserts()
+    test_sharded_layout_and_relayout()
+    test_transaction_commits_once()
+    test_payload_files_put_in_place_on_commit()
+    test_blobs_removed_after_the_commit_only()
+    test_payloads_rewritten_in_a_failed_commit_kept()
+    test_payloads_loaded_on_first_access()
+    test_payload_cache_hits_and_invalidation()
+    test_iter_revisions_in_chunks()
+    test_due_revisions_by_page()
+    test_hot_queries_use_indexes()
+    test_text_changelist_still_read()
@@ -0,0 +1,285 @@
+# This file is part of python-diffrevision
+# Copyright (C) 2011 Francois Savard 
+#
+# python-diffrevision is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-diffrevision is distributed in the hope that
+# it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-diffrevision (see license.txt)
+# If not, see <http://www.gnu.org/licenses/>.
+
+# Interface of the storage backends: what Revision, DiffRunner,
+# StaticHtmlGenerator, the local server... need from a store.
+#
+# Backends:
+#  - core.storage.Storage: the revisions table in db.sqlite3, payloads in the
+#    revision directories or in the db (see the 'payload_storage' option).
+#    Maintenance (migrations, 'compact', 'convert_storage' options,
+#    load_revision_table...) is only available there.
+#  - core.memory_storage.MemoryStorage: everything in dicts, for tests and
+#    benchmarks which shouldn't touch the disk.
+#
+# Revisions are passed as Revision objects, payloads are the raw bytes of a
+# revision's content, changelist... (see core.storage.PAYLOAD_FILENAMES).
+# Writes aren't committed by the backend methods themselves: callers call
+# commit_unless_in_transaction(), or group writes in a transaction().
+
+import os, sys
+import contextlib
+
+if __name__ == '__main__':
+    # otw when running tests we can't import other modules
+    this_files_path = os.path.split(os.path.abspath(__file__))[0]
+    sys.path.append(os.path.join(this_files_path,".."))
+
+from core.payload_cache import PayloadCache, DEFAULT_MAX_BYTES
+
+class StorageBackend(object):
+    def __init__(self, config):
+        self.config = config
+
+        # payloads read recently, see Revision.get_file_bytes
+        self.payload_cache = PayloadCache(\
+                getattr(self.config, 'payload_cache_bytes', DEFAULT_MAX_BYTES))
+
+    ##############
+    # Transactions
+
+    # Unit of work: while a transaction is open, Revision methods don't
+    # commit, and the outermost transaction commits once at the end (or rolls
+    # back if an exception goes through it), e.g.
+    #     with storage.transaction():
+    #         for rev in revs:
+    #             rev.update_scheduled_date(...)
+    # Transactions may be nested, only the outermost one counts.
+    @contextlib.contextmanager
+    def transaction(self):
+        if self.transaction_depth == 0:
+            self.begin()
+        self.transaction_depth += 1
+        succeeded = False
+        try:
+            yield self
+            succeeded = True
+        finally:
+            self.transaction_depth -= 1
+            if self.transaction_depth == 0:
+                if succeeded:
+                    self.commit()
+                else:
+                    self.rollback()
+                    # payloads read during the transaction may not exist
+                    # anymore
+                    self.payload_cache.clear()
+
+    def commit_unless_in_transaction(self):
+        if self.transaction_depth == 0:
+            self.commit()
+
+    # Lock coordinating the processes using the same store, held around a
+    # whole command (see core.store_lock): exclusive for commands writing to
+    # the store, shared for those only reading it, e.g.
+    #     with storage.lock():
+    #         ...
+    # Waits up to timeout seconds for the other commands to be done with
+    # the store, calling on_wait if it has to wait.
+    @contextlib.contextmanager
+    def lock(self, exclusive=True, timeout=None, on_wait=None):
+        self.acquire_lock(exclusive, timeout, on_wait)
+        try:
+            yield self
+        finally:
+            self.release_lock()
+
+    # backends provide a transaction_depth attribute (or property), and:
+    def begin(self):
+        pass
+
+    def commit(self):
+        raise NotImplementedError()
+
+    def rollback(self):
+        raise NotImplementedError()
+
+    # a store no other process can see needs no lock
+    def acquire_lock(self, exclusive, timeout, on_wait):
+        pass
+
+    def release_lock(self):
+        pass
+
+    def close_connection(self):
+        pass
+
+    ##############
+    # Revisions
+
+    # Stores a new revision's metadata, returns its id. New revisions have no
+    # id yet and get the next one; an id already set is kept (see
+    # core.store_export).
+    def insert_revision(self, rev):
+        raise NotImplementedError()
+
+    # num_revisions_done is left unchanged if None
+    def update_revision_schedule(self, revision_id, scheduled_date,
+                                    num_revisions_done=None):
+        raise NotImplementedError()
+
+    def update_revision_hidden(self, revision_id, hidden):
+        raise NotImplementedError()
+
+    # deletes the revision and its payloads (see Revision.perform_delete)
+    def delete_revision(self, rev, remove_directory=True):
+        raise NotImplementedError()
+
+    def get_revision_from_id(self, id, load_diff_content=False):
+        raise NotImplementedError()
+
+    def iter_all_revisions(self, load_diff_content=False):
+        raise NotImplementedError()
+
+    # Revisions due by date, by increasing (scheduled_date, id), so the most
+    # overdue come first. With limit, only a page of them: the next page
+    # is the one after the last revision of this one, passing its
+    # get_due_order_key() as after.
+    def iter_revisions_scheduled_before(self, date, include_hidden=False,
+                                        load_diff_content=False,
+                                        limit=None, after=None):
+        raise NotImplementedError()
+
+    def count_revisions_scheduled_before(self, date, include_hidden=False):
+        raise NotImplementedError()
+
+    def iter_revisions_for_document_path_sorted(self, doc_relative_path,
+                                                load_diff_content=True):
+        raise NotImplementedError()
+
+    def get_revisions_for_document_path_sorted(self, doc_relative_path,
+                                               load_diff_content=True):
+        return list(self.iter_revisions_for_document_path_sorted(\
+                                    doc_relative_path,
+                                    load_diff_content=load_diff_content))
+
+    # the revisions diffed just before (or distance revisions before) and
+    # just after rev for the same document, or None
+    def get_previous_revision(self, rev, distance=1):
+        raise NotImplementedError()
+
+    def get_next_revision(self, rev):
+        raise NotImplementedError()
+
+    # position of rev in its document's history (0 for the first)
+    def count_previous_revisions(self, rev):
+        raise NotImplementedError()
+
+    # the latest revision of a document diffed on or before dt, or None
+    def get_revision_as_of(self, doc_relative_path, dt):
+        raise NotImplementedError()
+
+    # The text of a document as it was at dt (a datetime), i.e. the content
+    # of its latest revision by then, or None if it had none yet. Any
+    # revision is rebuilt in a few deltas, see Revision.save_content.
+    def get_document_text_at(self, doc_relative_path, dt):
+        rev = self.get_revision_as_of(doc_relative_path, dt)
+        if rev is None:
+            return None
+        return rev.content
+
+    # Revisions stored as a delta against another revision than the one
+    # preceding them (see core.storage.get_skip_delta_base_offset) have the
+    # id of that revision (their "delta base") recorded; for the others,
+    # get_delta_base_id returns None. set_delta_base(rev, None) forgets it.
+    def get_delta_base_id(self, rev):
+        raise NotImplementedError()
+
+    def set_delta_base(self, rev, base_revision_id):
+        raise NotImplementedError()
+
+    # ids of the revisions whose delta base is rev
+    def get_delta_dependent_ids(self, rev):
+        raise NotImplementedError()
+
+    ##############
+    # Payloads
+
+    def has_payload(self, rev, filename):
+        raise NotImplementedError()
+
+    # hash of the payload (see core.blob_store.hash_data), if it's known
+    # without reading the payload, otw None
+    def get_payload_hash(self, rev, filename):
+        return None
+
+    def read_payload(self, rev, filename):
+        raise NotImplementedError()
+
+    def write_payload(self, rev, filename, data):
+        raise NotImplementedError()
+
+    # removing a payload which doesn't exist is a no-op
+    def remove_payload(self, rev, filename):
+        raise NotImplementedError()
+
+    ##############
+    # Documents: the watched list, with the latest revision of each watched
+    # document (its "head", a core.storage.DocumentHead), and the ignored
+    # list
+
+    def get_document_heads(self):
+        raise NotImplementedError()
+
+    def get_document_head(self, doc_relative_path):
+        raise NotImplementedError()
+
+    # called for each revision inserted; a revision older than the current
+    # head doesn't replace it
+    def update_document_head(self, doc_relative_path, revision_id,
+                                datetime_diffed_on, content_hash):
+        raise NotImplementedError()
+
+    def get_all_watched_document_paths(self):
+        raise NotImplementedError()
+
+    def get_ignored_document_relative_paths(self):
+        raise NotImplementedError()
+
+    # paths already in the list are skipped
+    def add_docs_to_watched_list(self, docs_relative_paths):
+        raise NotImplementedError()
+
+    def add_docs_to_ignored_list(self, docs_relative_paths):
+        raise NotImplementedError()
+
+    ##############
+
+    # Rewrites the payloads of all revisions of a document according to the
+    # current configuration (keyframes + deltas or complete text only,
+    # directories or blob store).
+    # Used to convert existing stores after changing delta_keyframe_interval
+    # or payload_storage. Returns the number of revisions rewritten.
+    def convert_document_content_storage(self, doc_relative_path):
+        revs = self.get_revisions_for_document_path_sorted(doc_relative_path,
+                                                load_diff_content=False)
+
+        # revisions are rewritten in chronological order: a revision's delta
+        # chain only goes back in time, so it's always readable, whether the
+        # revisions before it were already converted or not
+        previous = None
+        for rev in revs:
+            rev.load_diff_content()
+            rev.save_content(previous_revision=previous)
+            rev.save_changelist()
+            previous = rev
+
+        self.commit_unless_in_transaction()
+
+        return len(revs)
@@ -0,0 +1,292 @@
+# This file is part of python-diffrevision
+# Copyright (C) 2011 Francois Savard 
+#
+# python-diffrevision is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-diffrevision is distributed in the hope that
+# it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-diffrevision (see license.txt)
+# If not, see <http://www.gnu.org/licenses/>.
+
+# Export of the whole store to a single file, and import from it, for the
+# 'export' and 'import' commands (backups, moving to another machine...),
+# instead of copying db.sqlite3 and thousands of revision directories.
+#
+# The file is gzipped, one JSON object per line:
+#     {"format": "diffrevision-export", "version": 2}
+#     {"type": "ignored", "path": ...}                        (ignored list)
+#     {"type": "document", "path": ..., "head_revision_id": ...,
+#      "head_datetime_diffed_on": ..., "head_content_hash": ...}
+#                                                             (watched list)
+#     {"type": "revision", "id": ..., "document_relative_path": ...,
+#      ..., "delta_base_revision_id": ...,
+#      "payloads": {"content.txt": <base64>, ...}}
+#     {"type": "end", "num_revisions": ...}
+#
+# Both sides stream it a line at a time, so memory use doesn't depend on the
+# size of the store. Payloads are copied as they are stored (deltas stay
+# deltas, against the same base), and are written according to the
+# 'payload_storage' option of the store importing them. Revisions keep their
+# ids.
+#
+# Revisions are imported in batches, each committed on its own. An
+# interrupted import can be run again on the same store: revisions already
+# imported are skipped.
+
+import os, sys
+import gzip
+import json
+import base64
+import datetime
+
+if __name__ == '__main__':
+    # otw when running tests we can't import other modules
+    this_files_path = os.path.split(os.path.abspath(__file__))[0]
+    sys.path.append(os.path.join(this_files_path,".."))
+
+from core.storage import Revision, PAYLOAD_FILENAMES, DATE_FORMAT
+
+EXPORT_FORMAT = 'diffrevision-export'
+# version 2 added delta_base_revision_id, which older versions would ignore
+EXPORT_VERSION = 2
+
+DEFAULT_BATCH_SIZE = 500
+
+# how sqlite3 converts timestamp columns, microseconds being optional
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def format_datetime(dt):
+    if dt is None:
+        return None
+    return str(dt)
+
+def parse_datetime(text):
+    if text is None:
+        return None
+    if '.' in text:
+        return datetime.datetime.strptime(text, DATETIME_FORMAT + ".%f")
+    return datetime.datetime.strptime(text, DATETIME_FORMAT)
+
+def parse_date(text):
+    return datetime.datetime.strptime(text, DATE_FORMAT).date()
+
+def write_record(f, record):
+    f.write(json.dumps(record))
+    f.write("\n")
+
+# Payloads are read without going through the payload cache, an export
+# would only evict the entries useful to the other commands.
+def get_revision_record(rev):
+    payloads = {}
+    for filename in PAYLOAD_FILENAMES:
+        if rev.storage.has_payload(rev, filename):
+            payloads[filename] = base64.b64encode(\
+                                    rev.storage.read_payload(rev, filename))
+
+    return {'type': 'revision',
+            'id': rev.id,
+            'document_relative_path': rev.document_relative_path,
+            'datetime_diffed_on': format_datetime(rev.datetime_diffed_on),
+            'scheduled_date': rev.scheduled_date.strftime(DATE_FORMAT),
+            'num_revisions_done': rev.num_revisions_done,
+            'hidden': rev.hidden,
+            'delta_base_revision_id': rev.storage.get_delta_base_id(rev),
+            'payloads': payloads}
+
+# The archive is written to a temporary file first, so an interrupted export
+# doesn't leave an incomplete file that looks like a good one.
+# Returns the number of revisions exported.
+def export_store(storage, archive_path):
+    tmp_path = archive_path + ".part"
+    f = gzip.open(tmp_path, "wb")
+    try:
+        write_record(f, {'format': EXPORT_FORMAT, 'version': EXPORT_VERSION})
+
+        for path in storage.get_ignored_document_relative_paths():
+            write_record(f, {'type': 'ignored', 'path': path})
+
+        heads = storage.get_document_heads()
+        for path in storage.get_all_watched_document_paths():
+            head = heads.get(path)
+            write_record(f, {'type': 'document',
+                    'path': path,
+                    'head_revision_id': head.revision_id if head else None,
+                    'head_datetime_diffed_on': \
+                        format_datetime(head.datetime_diffed_on) \
+                                if head else None,
+                    'head_content_hash': head.content_hash if head else None})
+
+        num_revisions = 0
+        for rev in storage.iter_all_revisions():
+            write_record(f, get_revision_record(rev))
+            num_revisions += 1
+
+        write_record(f, {'type': 'end', 'num_revisions': num_revisions})
+    finally:
+        f.close()
+
+    os.rename(tmp_path, archive_path)
+
+    return num_revisions
+
+# Returns False if the revision was already imported (by an earlier,
+# interrupted import). A different revision with the same id means the
+# store wasn't empty to begin with.
+def import_revision(storage, record):
+    rev = Revision(storage)
+    rev.id = record['id']
+    rev.document_relative_path = record['document_relative_path']
+    rev.datetime_diffed_on = parse_datetime(record['datetime_diffed_on'])
+    rev.scheduled_date = parse_date(record['scheduled_date'])
+    rev.num_revisions_done = record['num_revisions_done']
+    rev.hidden = record['hidden']
+
+    existing = storage.get_revision_from_id(rev.id)
+    if existing is not None:
+        if existing.document_relative_path != rev.document_relative_path or \
+                existing.datetime_diffed_on != rev.datetime_diffed_on:
+            raise RuntimeError("Revision %s already exists in this store"\
+                                " for %s, can't import %s" % (rev.id,
+                                existing.get_relative_path_plus_timestamp(),
+                                rev.get_relative_path_plus_timestamp()))
+        return False
+
+    storage.insert_revision(rev)
+    for filename, data in record['payloads'].iteritems():
+        storage.write_payload(rev, str(filename), base64.b64decode(data))
+    storage.set_delta_base(rev, record.get('delta_base_revision_id'))
+
+    return True
+
+# Returns (number of revisions imported, number already there, whether it
+# stopped before the end). stop_requested is checked between batches.
+def import_store(storage, archive_path, batch_size=DEFAULT_BATCH_SIZE,
+                    stop_requested=lambda: False):
+    f = gzip.open(archive_path, "rb")
+    try:
+        header = json.loads(f.readline() or "{}")
+        if header.get('format') != EXPORT_FORMAT:
+            raise RuntimeError("%s isn't a diffrevision export" \
+                                    % (archive_path,))
+        if header['version'] > EXPORT_VERSION:
+            raise RuntimeError("%s was exported by a newer diffrevision"\
+                                    % (archive_path,))
+
+        num_imported = 0
+        num_skipped = 0
+        record = {'type': 'eof'}
+
+        # the lists are small, one batch for them, then batches of revisions
+        with storage.transaction():
+            records = iter(f)
+            for line in records:
+                record = json.loads(line)
+                if record['type'] == 'ignored':
+                    storage.add_docs_to_ignored_list([record['path']])
+                elif record['type'] == 'document':
+                    storage.add_docs_to_watched_list([record['path']])
+                    if record['head_revision_id'] is not None:
+                        storage.update_document_head(record['path'],
+                            record['head_revision_id'],
+                            parse_datetime(record['head_datetime_diffed_on']),
+                            record['head_content_hash'])
+                else:
+                    break
+
+        while record['type'] == 'revision':
+            if stop_requested():
+                return num_imported, num_skipped, True
+
+            with storage.transaction():
+                for i in range(batch_size):
+                    if import_revision(storage, record):
+                        num_imported += 1
+                    else:
+                        num_skipped += 1
+
+                    record = json.loads(next(records, '{"type": "eof"}'))
+                    if record['type'] != 'revision':
+                        break
+
+        if record['type'] != 'end':
+            raise RuntimeError("%s is incomplete" % (archive_path,))
+    finally:
+        f.close()
+
+    return num_imported, num_skipped, False
+
+###################
+# tests
+
+def test_export_then_interrupted_import():
+    from core.storage import setup_temp_db, teardown_temp_db, \
+                insert_test_revision, REVISION_DELTA_FILENAME, \
+                PAYLOAD_STORAGE_BLOBS, PAYLOAD_STORAGE_SQLITE
+
+    source = setup_temp_db()
+    source.config.delta_keyframe_interval = 4
+
+    start = datetime.datetime(2012, 1, 1, 10, 0, 0, 1234)
+    revs = [insert_test_revision(source, "mynotes.txt",
+                    start + datetime.timedelta(minutes=i),
+                    u"line \xe9\n" * (i+1)) for i in range(3)]
+    source.config.payload_storage = PAYLOAD_STORAGE_BLOBS
+    revs.append(insert_test_revision(source, "othernotes.txt",
+                    datetime.datetime(2012, 1, 2), u"other", u"0\n1"))
+    revs[0].set_hidden_state(True)
+    source.add_docs_to_watched_list(["mynotes.txt", "othernotes.txt",
+                                     "new.txt"])
+    source.add_docs_to_ignored_list(["ignored.txt"])
+
+    archive_path = os.path.join(source.config.diffrevision_base_directory,
+                                "export.gz")
+    assert export_store(source, archive_path) == 4
+
+    target = setup_temp_db()
+    target.config.payload_storage = PAYLOAD_STORAGE_SQLITE
+
+    batches = []
+    def stop_after_one_batch():
+        batches.append(1)
+        return len(batches) > 1
+
+    assert import_store(target, archive_path, batch_size=2,
+                stop_requested=stop_after_one_batch) == (2, 0, True)
+    # continues where it stopped
+    assert import_store(target, archive_path, batch_size=2) == (2, 2, False)
+
+    imported = list(Revision.iter_all_revisions(target,
+                                                load_diff_content=True))
+    assert [r.id for r in imported] == [r.id for r in revs]
+    for rev, imported_rev in zip(revs, imported):
+        assert imported_rev.content == rev.content
+        assert imported_rev.changelist == rev.changelist
+        assert imported_rev.datetime_diffed_on == rev.datetime_diffed_on
+    assert imported[0].hidden and not imported[1].hidden
+    assert imported[1].has_file(REVISION_DELTA_FILENAME)
+    # revs[2] is a delta against revs[0]
+    assert target.get_delta_base_id(imported[2]) == revs[0].id
+
+    assert target.get_all_watched_document_paths() == \
+                source.get_all_watched_document_paths()
+    assert target.get_ignored_document_relative_paths() == ["ignored.txt"]
+    assert target.get_document_heads() == source.get_document_heads()
+
+    # new revisions don't reuse imported ids
+    new_rev = insert_test_revision(target, "new.txt", start, u"new")
+    assert new_rev.id == revs[-1].id + 1
+
+    teardown_temp_db(source)
+    teardown_temp_db(target)
+
+if __name__ == '__main__':
+    test_export_then_interrupted_import()
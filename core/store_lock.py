@@ -0,0 +1,230 @@
+# This file is part of python-diffrevision
+# Copyright (C) 2011 Francois Savard 
+#
+# python-diffrevision is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-diffrevision is distributed in the hope that
+# it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-diffrevision (see license.txt)
+# If not, see <http://www.gnu.org/licenses/>.
+
+# Advisory lock coordinating the processes using a store: 'diff' run from
+# cron, 'finished' run from the shell, the local server hiding a review...
+#
+# SQLite already serializes writes to the db, but a command is made of
+# several transactions, and of files written next to them (revision
+# directories, blobs, packs): a 'diff' scanning while 'compact' removes
+# directories, or two 'diff's creating the same revision, would leave the
+# store in a state neither expected. So commands writing to the store take
+# the lock exclusively for their whole run, and commands only reading it
+# (export, fsck, generating pages) take it shared. A command finding it
+# taken waits for it (up to lock_timeout seconds) instead of failing, so
+# concurrent commands run one after the other.
+#
+# The lock is an flock() on the store.lock file in the base directory. Like
+# transactions, it's held per thread, and may be taken again by the thread
+# holding it (from another Storage too): only the outermost release
+# unlocks. A thread holding it shared can't take it exclusively, the other
+# way around is fine.
+#
+# Without fcntl (Windows), commands aren't coordinated.
+
+import os, sys
+import time
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+if __name__ == '__main__':
+    # otw when running tests we can't import other modules
+    this_files_path = os.path.split(os.path.abspath(__file__))[0]
+    sys.path.append(os.path.join(this_files_path,".."))
+
+LOCK_FILENAME = 'store.lock'
+
+DEFAULT_LOCK_TIMEOUT = 300 # seconds
+
+# how often a waiting command tries to take the lock again
+POLL_INTERVAL = 0.05 # seconds
+
+class StoreLockTimeout(RuntimeError):
+    pass
+
+# for commands run from the shell, see StoreLock.acquire
+def print_waiting_for_lock():
+    print "Waiting for another diffrevision command using the store" \
+            " to finish..."
+
+# locks held by the calling thread, by lock file path: [file, depth,
+# exclusive]
+_held_locks = threading.local()
+
+def get_held_locks():
+    held = getattr(_held_locks, 'by_path', None)
+    if held is None:
+        held = _held_locks.by_path = {}
+    return held
+
+class StoreLock(object):
+    def __init__(self, lock_path, timeout=DEFAULT_LOCK_TIMEOUT):
+        self.lock_path = lock_path
+        self.timeout = timeout
+
+    # whether the calling thread holds the lock, exclusively if exclusive
+    def is_held(self, exclusive=False):
+        held = get_held_locks().get(self.lock_path)
+        return held is not None and (held[2] or not exclusive)
+
+    # Waits at most timeout seconds (self.timeout if None) for the lock,
+    # calling on_wait once if it has to wait at all.
+    def acquire(self, exclusive=True, timeout=None, on_wait=None):
+        held_locks = get_held_locks()
+        held = held_locks.get(self.lock_path)
+        if held is not None:
+            if exclusive and not held[2]:
+                raise RuntimeError("The store lock is held shared by this"\
+                                    " thread, it can't be taken exclusively")
+            held[1] += 1
+            return
+
+        if timeout is None:
+            timeout = self.timeout
+
+        f = open(self.lock_path, "a")
+        try:
+            self.wait_for_flock(f, exclusive, timeout, on_wait)
+        except:
+            f.close()
+            raise
+
+        held_locks[self.lock_path] = [f, 1, exclusive]
+
+    def wait_for_flock(self, f, exclusive, timeout, on_wait):
+        if fcntl is None:
+            return
+
+        operation = (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | \
+                        fcntl.LOCK_NB
+        deadline = time.time() + timeout
+        waited = False
+
+        while True:
+            try:
+                fcntl.flock(f.fileno(), operation)
+                return
+            except IOError:
+                pass
+
+            if time.time() >= deadline:
+                raise StoreLockTimeout("Another command has been using the"\
+                        " store for more than %s seconds (see %s)" \
+                            % (timeout, self.lock_path))
+
+            if not waited and on_wait is not None:
+                on_wait()
+            waited = True
+
+            time.sleep(POLL_INTERVAL)
+
+    def release(self):
+        held_locks = get_held_locks()
+        held = held_locks[self.lock_path]
+        held[1] -= 1
+        if held[1] > 0:
+            return
+
+        del held_locks[self.lock_path]
+        f = held[0]
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        f.close()
+
+###################
+# tests
+
+def test_commands_queue_on_the_lock():
+    import tempfile, shutil
+
+    tmpdir = tempfile.mkdtemp()
+    lock_path = os.path.join(tmpdir, LOCK_FILENAME)
+
+    # each thread opens the lock file on its own, so threads exclude each
+    # other the way processes do
+    def in_thread(fn):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(fn()))
+        thread.start()
+        thread.join()
+        return result[0]
+
+    def try_acquire(exclusive):
+        lock = StoreLock(lock_path)
+        try:
+            lock.acquire(exclusive, timeout=0.1)
+        except StoreLockTimeout:
+            return False
+        lock.release()
+        return True
+
+    try:
+        lock = StoreLock(lock_path)
+
+        # readers share it, writers wait for them
+        lock.acquire(exclusive=False)
+        assert in_thread(lambda: try_acquire(False))
+        assert not in_thread(lambda: try_acquire(True))
+
+        try:
+            lock.acquire(exclusive=True)
+            assert False
+        except RuntimeError:
+            pass
+        lock.release()
+
+        # reentrant, released by the outermost release only
+        lock.acquire(exclusive=True)
+        StoreLock(lock_path).acquire(exclusive=True)
+        lock.acquire(exclusive=False)
+        assert lock.is_held(exclusive=True)
+        lock.release()
+        lock.release()
+        assert not in_thread(lambda: try_acquire(False))
+        lock.release()
+        assert not lock.is_held()
+        assert in_thread(lambda: try_acquire(True))
+
+        # a second writer waits for the first one instead of failing
+        lock.acquire(exclusive=True)
+        waits = []
+        order = []
+        def second_writer():
+            other = StoreLock(lock_path)
+            other.acquire(exclusive=True, timeout=10,
+                          on_wait=lambda: waits.append(1))
+            order.append("second")
+            other.release()
+        thread = threading.Thread(target=second_writer)
+        thread.start()
+        time.sleep(0.2)
+        order.append("first")
+        lock.release()
+        thread.join()
+        assert order == ["first", "second"]
+        assert waits == [1]
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    test_commands_queue_on_the_lock()
@@ -0,0 +1,225 @@
+# This file is part of python-diffrevision
+# Copyright (C) 2011 Francois Savard 
+#
+# python-diffrevision is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-diffrevision is distributed in the hope that
+# it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-diffrevision (see license.txt)
+# If not, see <http://www.gnu.org/licenses/>.
+
+# Hot/cold tiering of revision payloads, for the 'tier' command.
+#
+# Reviews read the revisions due soon. Revisions reviewed many times are
+# scheduled months or years ahead, and hidden ones aren't reviewed at all:
+# they're rarely read, but each still costs a directory and a few files (or
+# rows). Those "cold" revisions (hidden, or scheduled after
+# tier_cold_after_days from today) get their payloads moved to the pack
+# files of core.pack_store, where Storage.read_payload finds them like any
+# other payload. The latest revision of a document stays where it is, since
+# the next diff is taken against it.
+#
+# Like compaction, revisions are processed in batches committed on their
+# own, and revision directories are only removed once their batch is
+# committed.
+
+import os, sys
+import datetime
+
+if __name__ == '__main__':
+    # otw when running tests we can't import other modules
+    this_files_path = os.path.split(os.path.abspath(__file__))[0]
+    sys.path.append(os.path.join(this_files_path,".."))
+
+from core.storage import Revision, REVISIONS_TABLE_NAME, ALL_COL_NAMES, \
+                DOCUMENTS_TABLE_NAME, PAYLOAD_FILENAMES, \
+                REVISION_DIRECTORY_LAYOUTS
+from core.pack_store import PACK_ENTRIES_TABLE_NAME
+
+DEFAULT_COLD_AFTER_DAYS = 365
+DEFAULT_BATCH_SIZE = 500
+
+# packs with less than that proportion of their bytes still used are
+# rewritten by repack_sparse_packs
+DEFAULT_MIN_LIVE_RATIO = 0.5
+
+# hidden revisions, or scheduled after horizon_date, except the head of each
+# document and revisions already packed, by increasing id after after_id
+def get_cold_revisions(storage, horizon_date, after_id, limit):
+    storage.db_cursor.execute("SELECT "+ALL_COL_NAMES+\
+                " FROM "+REVISIONS_TABLE_NAME+\
+                " WHERE id > ?"+\
+                " AND (hidden = 1 OR scheduled_date > ?)"+\
+                " AND id NOT IN (SELECT head_revision_id"+\
+                    " FROM "+DOCUMENTS_TABLE_NAME+\
+                    " WHERE head_revision_id IS NOT NULL)"+\
+                " AND id NOT IN (SELECT revision_id"+\
+                    " FROM "+PACK_ENTRIES_TABLE_NAME+")"+\
+                " ORDER BY id LIMIT ?;",
+                (after_id, horizon_date, limit))
+
+    return [Revision.create_from_record(storage, row, load_diff_content=False)\
+                for row in storage.db_cursor.fetchall()]
+
+# Moves a revision's payloads to the pack store. Returns the filenames
+# moved, whose copies in the revision directories are left to the caller.
+def pack_revision(rev):
+    storage = rev.storage
+
+    filenames = []
+    for filename in PAYLOAD_FILENAMES:
+        if not storage.has_payload(rev, filename):
+            continue
+
+        data = storage.read_payload(rev, filename)
+        storage.pack_store.write(rev.id, filename, data)
+        for payload_store in storage.db_payload_stores:
+            if payload_store is not storage.pack_store:
+                payload_store.remove(rev.id, filename)
+        filenames.append(filename)
+
+    return filenames
+
+# Returns (number of revisions packed, whether it stopped before the end).
+# stop_requested is checked between batches.
+def pack_cold_revisions(storage, horizon_date,
+                        batch_size=DEFAULT_BATCH_SIZE,
+                        stop_requested=lambda: False):
+    num_packed = 0
+    last_id = 0
+
+    while True:
+        if stop_requested():
+            return num_packed, True
+
+        revs = get_cold_revisions(storage, horizon_date, last_id, batch_size)
+        if not revs:
+            return num_packed, False
+
+        moved = []
+        with storage.transaction():
+            for rev in revs:
+                moved.append((rev, pack_revision(rev)))
+
+        for rev, filenames in moved:
+            for filename in filenames:
+                storage.payload_cache.invalidate(rev.id, filename)
+                for layout in REVISION_DIRECTORY_LAYOUTS:
+                    storage.remove_directory_payload(rev, filename, layout)
+
+        num_packed += len(revs)
+        last_id = revs[-1].id
+
+# Rewrites the packs mostly made of removed entries (see
+# PackStore.remove), copying the entries still used to a new pack.
+# Returns (number of packs removed, bytes reclaimed).
+def repack_sparse_packs(storage, min_live_ratio=DEFAULT_MIN_LIVE_RATIO):
+    pack_store = storage.pack_store
+
+    # entries copied never go to a pack being rewritten
+    pack_ids = pack_store.get_pack_ids()
+    pack_store.start_new_pack()
+
+    num_removed = 0
+    reclaimed = 0
+
+    for pack_id in pack_ids:
+        size = os.path.getsize(pack_store.get_pack_path(pack_id))
+        live_bytes = pack_store.get_live_bytes(pack_id)
+        if live_bytes >= size * min_live_ratio:
+            continue
+
+        storage.db_cursor.execute("SELECT revision_id, filename, offset,"+\
+                " length FROM "+PACK_ENTRIES_TABLE_NAME+" WHERE pack_id=?;",
+                (pack_id,))
+        entries = storage.db_cursor.fetchall()
+
+        with storage.transaction():
+            for revision_id, filename, offset, length in entries:
+                stored = pack_store.read_entry(pack_id, offset, length)
+                new_pack_id, new_offset = \
+                        pack_store.append_entry(revision_id, filename, stored)
+                pack_store.set_entry(revision_id, filename, new_pack_id,
+                                     new_offset, length)
+
+        pack_store.remove_pack_file(pack_id)
+        num_removed += 1
+        reclaimed += size - live_bytes
+
+    return num_removed, reclaimed
+
+###################
+# tests
+
+def test_pack_cold_revisions_then_repack():
+    from core.storage import setup_temp_db, teardown_temp_db, \
+                insert_test_revision, REVISION_CONTENT_FILENAME, \
+                REVISION_DELTA_FILENAME
+
+    storage = setup_temp_db()
+    storage.config.delta_keyframe_interval = 2
+
+    start = datetime.datetime(2012, 1, 1, 10)
+    revs = [insert_test_revision(storage, "mynotes.txt",
+                    start + datetime.timedelta(minutes=i),
+                    u"line \xe9\n" * (i+1)) for i in range(4)]
+    other = insert_test_revision(storage, "othernotes.txt", start, u"other")
+
+    horizon = datetime.date.today() + datetime.timedelta(days=365)
+    far = horizon + datetime.timedelta(days=1)
+    for rev in revs[:3]:
+        rev.update_scheduled_date(far)
+    # heads stay where they are
+    revs[3].update_scheduled_date(far)
+    other.set_hidden_state(True)
+
+    batches = []
+    def stop_after_one_batch():
+        batches.append(1)
+        return len(batches) > 1
+
+    assert pack_cold_revisions(storage, horizon, batch_size=2,
+                stop_requested=stop_after_one_batch) == (2, True)
+    assert pack_cold_revisions(storage, horizon) == (1, False)
+    assert pack_cold_revisions(storage, horizon) == (0, False)
+
+    for rev in revs[:3]:
+        assert not os.path.exists(rev.get_full_directory_path())
+        assert storage.pack_store.contains(rev.id, REVISION_CONTENT_FILENAME)\
+                or storage.pack_store.contains(rev.id, REVISION_DELTA_FILENAME)
+    assert os.path.exists(revs[3].get_full_directory_path())
+
+    # read back from the packs, delta chains included
+    fresh = storage.get_revisions_for_document_path_sorted("mynotes.txt")
+    assert [r.content for r in fresh] == \
+                [u"line \xe9\n" * (i+1) for i in range(4)]
+    assert fresh[0].changelist == revs[0].changelist
+
+    # most of the pack goes away with revs[0] and revs[1]
+    fresh[2].set_file_content(REVISION_CONTENT_FILENAME, fresh[2].content)
+    fresh[2].remove_file(REVISION_DELTA_FILENAME)
+    fresh[0].perform_delete()
+    fresh[1].perform_delete()
+
+    old_pack_path = storage.pack_store.get_pack_path(1)
+    assert repack_sparse_packs(storage)[0] == 1
+    assert not os.path.exists(old_pack_path)
+    assert storage.pack_store.get_pack_ids() == [2]
+
+    fresh = storage.get_revisions_for_document_path_sorted("mynotes.txt")
+    assert [r.content for r in fresh] == \
+                [u"line \xe9\n" * (i+1) for i in (2, 3)]
+
+    teardown_temp_db(storage)
+
+if __name__ == '__main__':
+    test_pack_cold_revisions_then_repack()
@@ -0,0 +1,214 @@
+# This file is part of python-diffrevision
+# Copyright (C) 2011 Francois Savard 
+#
+# python-diffrevision is free software:
+# you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# python-diffrevision is distributed in the hope that
+# it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with python-diffrevision (see license.txt)
+# If not, see <http://www.gnu.org/licenses/>.
+
+# Set of the line numbers (0-based) changed in a revision.
+#
+# Changed lines mostly come in runs (a paragraph added, the whole document
+# for a first revision), so the set is kept as sorted, non-overlapping
+# [start, end) intervals, and stored in a compact binary form (to_bytes):
+#
+#   'CL' + format version byte + varint(number of runs)
+#   + for each run: varint(gap since the end of the previous run)
+#                   + varint(run length)
+#
+# Membership tests are constant-time (a bitmap is built on first use), so
+# formatters can test every line of a page.
+#
+# Changelists used to be stored as text, one line number per line, see
+# from_text.
+
+from array import array
+
+BINARY_MAGIC = 'CL'
+BINARY_VERSION = 1
+
+def encode_varint(value, out):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def decode_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        value |= (b & 0x7f) << shift
+        if b < 0x80:
+            return value, pos
+        shift += 7
+
+class Changelist(object):
+    __slots__ = ('starts', 'ends', '_bitmap')
+
+    # ranges must be sorted [start, end) pairs, adjacent ones are merged
+    def __init__(self, ranges=()):
+        self.starts = array('l')
+        self.ends = array('l')
+        self._bitmap = None
+
+        for start, end in ranges:
+            self.add_range(start, end)
+
+    def add_range(self, start, end):
+        assert start < end
+        assert not self.ends or start >= self.ends[-1]
+
+        self._bitmap = None
+
+        if self.ends and start == self.ends[-1]:
+            self.ends[-1] = end
+        else:
+            self.starts.append(start)
+            self.ends.append(end)
+
+    @staticmethod
+    def from_line_numbers(line_numbers):
+        changelist = Changelist()
+        for lineno in sorted(set(line_numbers)):
+            changelist.add_range(lineno, lineno+1)
+        return changelist
+
+    # the old text format: one line number per line, possibly repeated
+    @staticmethod
+    def from_text(text):
+        return Changelist.from_line_numbers(\
+                        [int(l) for l in text.splitlines() if l.strip()])
+
+    def to_text(self):
+        return "\n".join([str(lineno) for lineno in self])
+
+    @staticmethod
+    def from_bytes(data):
+        if data[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+            raise ValueError("Not a binary changelist")
+
+        data = bytearray(data)
+        pos = len(BINARY_MAGIC)
+
+        version = data[pos]
+        pos += 1
+        if version != BINARY_VERSION:
+            raise ValueError("Unknown changelist format version %d" % version)
+
+        num_runs, pos = decode_varint(data, pos)
+
+        changelist = Changelist()
+        end = 0
+        for i in xrange(num_runs):
+            gap, pos = decode_varint(data, pos)
+            length, pos = decode_varint(data, pos)
+            start = end + gap
+            end = start + length
+            changelist.starts.append(start)
+            changelist.ends.append(end)
+
+        return changelist
+
+    def to_bytes(self):
+        out = bytearray(BINARY_MAGIC)
+        out.append(BINARY_VERSION)
+
+        encode_varint(len(self.starts), out)
+
+        previous_end = 0
+        for start, end in self.iter_ranges():
+            encode_varint(start - previous_end, out)
+            encode_varint(end - start, out)
+            previous_end = end
+
+        return str(out)
+
+    def iter_ranges(self):
+        for i in xrange(len(self.starts)):
+            yield self.starts[i], self.ends[i]
+
+    def __iter__(self):
+        for start, end in self.iter_ranges():
+            for lineno in xrange(start, end):
+                yield lineno
+
+    def __len__(self):
+        return sum([end - start for start, end in self.iter_ranges()])
+
+    def __nonzero__(self):
+        return len(self.starts) > 0
+
+    def __contains__(self, lineno):
+        if self._bitmap is None:
+            bitmap = bytearray(self.ends[-1] if self.ends else 0)
+            for start, end in self.iter_ranges():
+                bitmap[start:end] = '\x01' * (end - start)
+            self._bitmap = bitmap
+
+        return 0 <= lineno < len(self._bitmap) and self._bitmap[lineno] == 1
+
+    def __eq__(self, other):
+        if not isinstance(other, Changelist):
+            return NotImplemented
+        return self.starts == other.starts and self.ends == other.ends
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __repr__(self):
+        return "Changelist(%r)" % (list(self.iter_ranges()),)
+
+###################
+# tests
+
+def test_changelist_intervals():
+    # duplicates and unsorted numbers were possible in the text format
+    changelist = Changelist.from_text("5\n0\n1\n2\n2\n9\n6\n")
+
+    assert list(changelist.iter_ranges()) == [(0, 3), (5, 7), (9, 10)]
+    assert list(changelist) == [0, 1, 2, 5, 6, 9]
+    assert len(changelist) == 6
+    assert changelist.to_text() == "0\n1\n2\n5\n6\n9"
+
+    assert 0 in changelist and 6 in changelist and 9 in changelist
+    assert 3 not in changelist and 10 not in changelist
+    assert -1 not in changelist
+
+    assert not Changelist()
+    assert 0 not in Changelist()
+
+def test_changelist_binary_roundtrip():
+    for changelist in [Changelist(),
+                       Changelist([(0, 2000)]),
+                       Changelist.from_line_numbers([3, 4, 200, 70000])]:
+        data = changelist.to_bytes()
+        assert Changelist.from_bytes(data) == changelist
+
+    # a whole document is a single run
+    assert len(Changelist([(0, 2000)]).to_bytes()) == 7
+
+    try:
+        Changelist.from_bytes("0\n1")
+        assert False
+    except ValueError:
+        pass
+
+if __name__ == '__main__':
+    test_changelist_intervals()
+    test_changelist_binary_roundtrip()
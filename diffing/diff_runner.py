@@ -30,6 +30,8 @@ if __name__ == '__main__':
 import datetime
 from core import storage
 from core.storage import Revision
+from core.store_lock import print_waiting_for_lock
+from diffing.changelist import Changelist
 import plaintext_line_diff
 
 class DiffRunner(object):
@@ -44,7 +46,13 @@ class DiffRunner(object):
         self.get_changelist_fn = get_changelist_fn
         self.scheduler_getter = scheduler_getter
 
+    # Other commands writing to the store (another 'diff', 'finished'...)
+    # wait for the scan to be done, and the scan waits for them.
     def scan_files_for_changes(self):
+        with self.storage.lock(on_wait=print_waiting_for_lock):
+            self.scan_files_for_changes_while_locked()
+
+    def scan_files_for_changes_while_locked(self):
         watched = self.storage.get_all_watched_document_paths()
 
         if len(watched) == 0:
@@ -57,39 +65,67 @@ class DiffRunner(object):
         progress_increment = len(watched) // 10
         progress_counter = 0
 
-        for doc_idx, doc_relative_path in enumerate(watched):
-            if self.check_for_changes_and_store_if_there_are(doc_relative_path):
-                num_changes += 1
-            if progress_increment != 0 and (doc_idx+1) % progress_increment == 0:
-                progress_counter += 10
-                print progress_counter, "% done"
+        # the latest revision of every document, in one query
+        heads = self.storage.get_document_heads()
+
+        # all new revisions are committed at once, at the end of the scan
+        with self.storage.transaction():
+            for doc_idx, doc_relative_path in enumerate(watched):
+                if self.check_for_changes_and_store_if_there_are(\
+                                            doc_relative_path, heads=heads):
+                    num_changes += 1
+                if progress_increment != 0 and \
+                        (doc_idx+1) % progress_increment == 0:
+                    progress_counter += 10
+                    print progress_counter, "% done"
 
         if num_changes == 0:
             print "(No reviewable changes found. Note that lines _deleted_"\
                     +" don't count as 'reviewable' changes.)"
 
     # returns True if there was a change
-    def check_for_changes_and_store_if_there_are(self, doc_relative_path):
-        revs = self.storage.\
-                  get_revisions_for_document_path_sorted(\
-                                        doc_relative_path,
-                                        load_diff_content=False)
+    # heads is the result of Storage.get_document_heads(), if the caller
+    # already has it
+    def check_for_changes_and_store_if_there_are(self, doc_relative_path,
+                                                    heads=None):
+        if heads is None:
+            head = self.storage.get_document_head(doc_relative_path)
+        else:
+            head = heads.get(doc_relative_path)
 
         # two paths here: either we already have at least one revision,
         # (in that case we just create more revisions) or not (in that case
         # we must create the first revision)
 
-        if len(revs) > 0:
-            lastrev = revs[-1]
-            return self.check_for_changes_from_rev(lastrev)
+        if head is not None:
+            return self.check_for_changes_from_head(doc_relative_path, head)
         else:
             self.create_first_revision(doc_relative_path)
             return True
 
+    # Same as check_for_changes_from_rev, but the revision is only fetched
+    # if the document was modified since it was taken.
+    def check_for_changes_from_head(self, doc_relative_path, head):
+        if not self.is_modified_since(doc_relative_path,
+                                      head.datetime_diffed_on):
+            return False
+
+        rev_obj = Revision.get_revision_from_id(self.storage, head.revision_id)
+
+        return self.diff_and_store_if_changed(rev_obj,
+                                    last_hash=head.content_hash)
+
     # Should only be called if there's at least one revision stored already.
     def check_for_changes_from_rev(self, rev_obj):
+        if not self.is_modified_since(rev_obj.document_relative_path,
+                                      rev_obj.datetime_diffed_on):
+            return False
+
+        return self.diff_and_store_if_changed(rev_obj)
+
+    def is_modified_since(self, doc_relative_path, datetime_diffed_on):
         doc_absolute_path = os.path.join(self.config.notes_directory,
-                                         rev_obj.document_relative_path)
+                                         doc_relative_path)
 
         ###########
         # First check the doc still exists
@@ -98,7 +134,7 @@ class DiffRunner(object):
             print "The file '" + doc_absolute_path + \
                 "' was either deleted or moved, so changes cannot be "+\
                 "tracked anymore."
-            return
+            return False
 
         ###########
         # Then check the modification date and avoid loading doc if it's
@@ -110,15 +146,16 @@ class DiffRunner(object):
 
         epsilon = datetime.timedelta(seconds=2)
 
-        if rev_obj.datetime_diffed_on + epsilon >= date_last_modified:
-            return False
+        return datetime_diffed_on + epsilon < date_last_modified
+
+    # last_hash is the hash of rev_obj's content, if known
+    def diff_and_store_if_changed(self, rev_obj, last_hash=None):
+        doc_absolute_path = os.path.join(self.config.notes_directory,
+                                         rev_obj.document_relative_path)
 
         ###########
         # Doc seems to have been modified, check diff
 
-        # content was not loaded up to now
-        rev_obj.load_diff_content()
-
         f = None
         try:
             f = codecs.open(doc_absolute_path, "r", self.config.notes_codec)
@@ -129,6 +166,18 @@ class DiffRunner(object):
             print "IOError while reading file ", doc_absolute_path
             raise
 
+        # if the hash of the last revision's content is known (from the
+        # documents table or the blob store), an identical text is detected
+        # without reading it
+        if last_hash is None:
+            last_hash = rev_obj.get_file_hash(storage.REVISION_CONTENT_FILENAME)
+        if last_hash is not None and last_hash == storage.hash_data(\
+                    current_integral_text.encode(self.config.notes_codec)):
+            return False
+
+        # content was not loaded up to now
+        rev_obj.load_diff_content()
+
         last_text = rev_obj.content
 
         changelist = self.get_changelist_fn(last_text, current_integral_text)
@@ -138,7 +187,8 @@ class DiffRunner(object):
             return False
 
         self.create_new_revision(rev_obj.document_relative_path,
-                                current_integral_text, changelist)
+                                current_integral_text, changelist,
+                                previous_revision=rev_obj)
 
         print "Revision was added for modified entry %s" \
                     % (rev_obj.document_relative_path,)
@@ -172,12 +222,23 @@ class DiffRunner(object):
                     % (doc_relative_path,)
 
     def create_new_revision(self, document_relative_path,
-                                    new_content, changelist):
+                                    new_content, changelist,
+                                    previous_revision=None):
         r = Revision(self.storage)
 
         r.document_relative_path = document_relative_path
         r.datetime_diffed_on = datetime.datetime.now()
 
+        # revision directories are named after the second the revision was
+        # taken, so the revisions of a document must be taken on different
+        # seconds (a file saved with an mtime in the future, e.g. by a sync
+        # from another machine, may be diffed again within the same second)
+        if previous_revision is not None:
+            earliest = previous_revision.datetime_diffed_on.replace(\
+                            microsecond=0) + datetime.timedelta(seconds=1)
+            if r.datetime_diffed_on < earliest:
+                r.datetime_diffed_on = earliest
+
         # just get the default first value, by passing no object to the scheduler
         # (and default is to use today() as start date)
         r.scheduled_date = self.scheduler_getter(r.document_relative_path).get_next_date(None)
@@ -188,7 +249,7 @@ class DiffRunner(object):
         r.content = new_content
         r.changelist = changelist
         
-        r.perform_insert()
+        r.perform_insert(previous_revision=previous_revision)
 
 ##########################################
 # tests
@@ -219,15 +280,15 @@ def test_create_first_then_diff():
 
     assert len(rev_objs) == 1
     assert rev_objs[0].content == content_at_first
-    assert rev_objs[0].changelist == "0\n1"
+    assert rev_objs[0].changelist == Changelist([(0, 2)])
 
-    # wait a bit otw we get a problem with collision of two revisions having
-    # the same timestamp... if timestamp difference is less than 2 seconds, the
-    # diff is not taken
-    time.sleep(3)
-    
-    # then modify the file
-    write_test_file(os.path.join(notes_dir, "notes1.txt"), content_for_diff)
+    # then modify the file, in the same second: files modified less than 2
+    # seconds after the revision aren't diffed, unless their mtime says
+    # they're more recent than that
+    notes_path = os.path.join(notes_dir, "notes1.txt")
+    write_test_file(notes_path, content_for_diff)
+    future = time.time() + 60
+    os.utime(notes_path, (future, future))
 
     # create new revision
     diffrunner.scan_files_for_changes()
@@ -237,14 +298,110 @@ def test_create_first_then_diff():
 
     assert len(rev_objs) == 2
     assert rev_objs[0].content == content_at_first
-    assert rev_objs[0].changelist == "0\n1"
+    assert rev_objs[0].changelist == Changelist([(0, 2)])
     assert rev_objs[1].content == content_for_diff
-    assert rev_objs[1].changelist == "2"
+    assert rev_objs[1].changelist == Changelist([(2, 3)])
+    # each in its own directory
+    assert rev_objs[1].datetime_diffed_on > rev_objs[0].datetime_diffed_on
+    assert rev_objs[0].get_full_directory_path() != \
+                rev_objs[1].get_full_directory_path()
 
     shutil.rmtree(notes_dir)
     teardown_temp_db(store)
  
+def test_unchanged_text_in_blob_store_is_not_diffed():
+    import tempfile, shutil
+    from core.storage import setup_temp_db, write_test_file, teardown_temp_db
+    from scheduling.fixed_scheduler import FixedScheduler
+
+    notes_dir = tempfile.mkdtemp()
+    store = setup_temp_db()
+
+    store.config.notes_directory = notes_dir
+    store.config.payload_storage = storage.PAYLOAD_STORAGE_BLOBS
+
+    notes_path = os.path.join(notes_dir, "notes1.txt")
+    write_test_file(notes_path, "First\nsecond")
+
+    store.add_docs_to_watched_list(["notes1.txt"])
+
+    diffrunner = DiffRunner(store.config, scheduler_getter=lambda x: FixedScheduler(),
+                            store=store)
+    diffrunner.scan_files_for_changes()
+
+    # touched (e.g. by a sync) but not modified
+    future = time.time() + 60
+    os.utime(notes_path, (future, future))
+
+    # the content must not be needed to know nothing changed
+    def fail_loading(self):
+        raise AssertionError("content loaded")
+    rev_obj = store.get_revisions_for_document_path_sorted("notes1.txt",
+                                                load_diff_content=False)[0]
+    load_diff_content = Revision.load_diff_content
+    Revision.load_diff_content = fail_loading
+    try:
+        assert not diffrunner.check_for_changes_from_rev(rev_obj)
+    finally:
+        Revision.load_diff_content = load_diff_content
+
+    shutil.rmtree(notes_dir)
+    teardown_temp_db(store)
+
+def test_scan_uses_document_heads():
+    import tempfile, shutil
+    from core.storage import setup_temp_db, write_test_file, teardown_temp_db
+    from core.sql_stats import checking_query_plans
+    from scheduling.fixed_scheduler import FixedScheduler
+
+    notes_dir = tempfile.mkdtemp()
+    store = setup_temp_db()
+
+    store.config.notes_directory = notes_dir
+
+    notes_path = os.path.join(notes_dir, "notes1.txt")
+    write_test_file(notes_path, "First\nsecond")
+
+    store.add_docs_to_watched_list(["notes1.txt"])
+
+    diffrunner = DiffRunner(store.config, scheduler_getter=lambda x: FixedScheduler(),
+                            store=store)
+    diffrunner.scan_files_for_changes()
+
+    # touched but not modified: the hash in the documents table is enough,
+    # neither the history nor the content are read
+    future = time.time() + 60
+    os.utime(notes_path, (future, future))
+
+    def fail_loading(*args, **kwargs):
+        raise AssertionError("history or content loaded")
+    load_diff_content = Revision.load_diff_content
+    iter_revisions = store.iter_revisions_for_document_path_sorted
+    Revision.load_diff_content = fail_loading
+    store.iter_revisions_for_document_path_sorted = fail_loading
+    try:
+        diffrunner.scan_files_for_changes()
+    finally:
+        Revision.load_diff_content = load_diff_content
+        store.iter_revisions_for_document_path_sorted = iter_revisions
+
+    # a real change still goes through, without scanning the revisions
+    # table
+    write_test_file(notes_path, "First\nsecond\nthird")
+    os.utime(notes_path, (future, future))
+    with checking_query_plans():
+        diffrunner.scan_files_for_changes()
+
+    rev_objs = store.get_revisions_for_document_path_sorted("notes1.txt")
+    assert len(rev_objs) == 2
+    assert store.get_document_head("notes1.txt").revision_id == rev_objs[1].id
+    assert rev_objs[1].changelist == Changelist([(2, 3)])
+
+    shutil.rmtree(notes_dir)
+    teardown_temp_db(store)
+
 if __name__ == '__main__':
     import tempfile, shutil
     test_create_first_then_diff()
-
+    test_unchanged_text_in_blob_store_is_not_diffed()
+    test_scan_uses_document_heads()
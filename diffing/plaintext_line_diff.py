@@ -17,9 +17,17 @@
 # along with python-diffrevision (see license.txt)
 # If not, see <http://www.gnu.org/licenses/>.
 
+import os, sys
 from difflib import Differ
 import cgi
 
+if __name__ == '__main__':
+    # otw when running tests we can't import other modules
+    this_files_path = os.path.split(os.path.abspath(__file__))[0]
+    sys.path.append(os.path.join(this_files_path,".."))
+
+from diffing.changelist import Changelist
+
 def get_changelist(old_text, new_text):
     # copy and make sure we don't register changes simply
     # because the endline characters changed (which happens
@@ -52,7 +60,7 @@ def get_changelist(old_text, new_text):
             lc += 1
         # there might also be the '?' case, but this doesn't affect the linecount
     
-    return "\n".join([str(l) for l in lines_with_changes])
+    return Changelist.from_line_numbers(lines_with_changes)
 
 ###################
 # tests
@@ -61,16 +69,16 @@ def test__get_changelist__basic():
     text1 = "This is some\r\nMulti-line DOS-breaklined\r\ntext.\r\n"
     text2 = "This is some\r\nMulti-line DOS-breaklined\r\ntext. With additions\r\nto these lines"
 
-    assert get_changelist(text1, text2) == '2\n3';
+    assert list(get_changelist(text1, text2)) == [2, 3];
     # deleted one line 
-    assert get_changelist(text2, text1) == '2';
+    assert list(get_changelist(text2, text1)) == [2];
 
 def test__get_changelist__no_change_for_eolchange():
     text1 = "This is some\r\nMulti-line DOS-breaklined"
     text2 = "This is some\r\nMulti-line DOS-breaklined\r\n"
 
-    assert get_changelist(text1, text2) == '';
-    assert get_changelist(text2, text1) == '';
+    assert list(get_changelist(text1, text2)) == [];
+    assert list(get_changelist(text2, text1)) == [];
 
 if __name__ == '__main__':
     test__get_changelist__basic()
@@ -18,6 +18,7 @@
 # If not, see <http://www.gnu.org/licenses/>.
 
 import os, sys, copy, operator, time
+import atexit
 
 # ease imports for imported modules
 # (they need to access other modules in their parent directory)
@@ -25,6 +26,7 @@ this_files_path = os.path.split(os.path.abspath(__file__))[0]
 sys.path.append(this_files_path)
 
 from core import core_routines
+from core import sql_stats
 from core import configuration as config
 
 def usage():
@@ -66,6 +68,10 @@ Commands are:
 
         The temporary directory must be deleted manually for the moment.
 
+        With --limit N (or the 'today_limit' option), only the N most overdue
+        reviews are generated; the next ones come once those are finished.
+        e.g. diffrevision.py t 2 --limit 200
+
     diffrevision.py d (or diff)
         Will check for changes in pages under tracking, and will add changes
         as reviews in the database. For file newly added to tracking, the
@@ -78,12 +84,71 @@ Commands are:
         e.g. diffrevision.py f 2983 3829 3892
         This would reschedule those 3 reviews, taking into account the number
         of time they've been reviewed to determine next date.
+
+    diffrevision.py forecast [number of days]
+        Will print the number of revisions due on each of the next days
+        (14 by default).
+
+    diffrevision.py convert_storage
+        Will rewrite the stored content of all revisions according to the
+        storage options of the configuration (e.g. after changing
+        delta_keyframe_interval).
+
+    diffrevision.py train_dictionary
+        Will build a new compression dictionary from a sample of the notes,
+        for payload_compression = 'dictionary' in the configuration (with
+        payload_storage = 'sqlite'), and keep it if it compresses them
+        better than the current one.
+
+    diffrevision.py relayout
+        Will move the revision directories to the layout set by
+        revision_directory_layout in the configuration. Can be stopped and
+        run again later to continue.
+
+    diffrevision.py tier
+        Will move the content of hidden revisions, and of revisions not due
+        for a long time (see tier_cold_after_days in the configuration), to
+        a few large pack files. Can be stopped with Ctrl-C and run again
+        later to continue.
+
+    diffrevision.py compact
+        Will delete (or archive, see compact_policy in the configuration)
+        hidden revisions and revisions which will never be due again, then
+        free the space they used. Can be stopped with Ctrl-C and run again
+        later to continue.
+
+    diffrevision.py fsck [number of workers]
+        Will check that the content and changelist of every revision can be
+        read and decoded, and report missing payloads and orphaned files.
+        Nothing is modified. Exits with status 1 if problems were found.
+
+    diffrevision.py export [archive file]
+        Will write the whole store (revisions, watched and ignored lists) to
+        a single compressed file, e.g. for backups.
+
+    diffrevision.py import [archive file]
+        Will restore a store written by 'export' into the store of the
+        configuration, which should be empty. Can be stopped with Ctrl-C and
+        run again later to continue.
+
+Options, for every command:
+
+    --sql-stats
+        Will print, once the command is done, how many times each SQL
+        statement was run and the time spent in it, the slowest first.
+        e.g. diffrevision.py diff --sql-stats
     
 """
 
 def parse_command():
     args = sys.argv[1:]
 
+    if '--sql-stats' in args:
+        args.remove('--sql-stats')
+        sql_stats.STATS.enabled = True
+        # also printed when the command exits early (e.g. fsck)
+        atexit.register(sql_stats.STATS.print_report)
+
     if len(args) == 0 or args[0] in ('h','help','--help'):
         usage()
         return
@@ -107,6 +172,25 @@ def parse_command():
                             scheduler_getter=config.get_scheduler)
     elif command in ('f','finished'):
         core_routines.reviews_finished(args[1:], config=config)
+    elif command == 'forecast':
+        core_routines.print_forecast(args[1:], config=config)
+    elif command == 'convert_storage':
+        core_routines.convert_content_storage(config=config)
+    elif command == 'train_dictionary':
+        core_routines.train_payload_dictionary(config=config)
+    elif command == 'relayout':
+        core_routines.relayout(config=config)
+    elif command == 'tier':
+        core_routines.tier(config=config)
+    elif command == 'compact':
+        core_routines.compact(config=config)
+    elif command == 'fsck':
+        if core_routines.fsck(args[1:], config=config) > 0:
+            sys.exit(1)
+    elif command == 'export':
+        core_routines.export_store(args[1:], config=config)
+    elif command == 'import':
+        core_routines.import_store(args[1:], config=config)
 
     # debug and author-specific stuff
     elif command == 'list_all_revisions':
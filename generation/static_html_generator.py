@@ -96,8 +96,8 @@ class BasicLineBasedHtmlFormatter():
     def format(self, rev_obj):
         orig_lines = rev_obj.content.splitlines()
 
-        str_line_nos = rev_obj.changelist.splitlines()
-        line_nos_with_changes = [int(lineno) for lineno in str_line_nos]
+        # a diffing.changelist.Changelist, constant-time membership tests
+        line_nos_with_changes = rev_obj.changelist
 
         new_lines = []
         for lineno, line in enumerate(orig_lines):
@@ -130,14 +130,17 @@ class StaticHtmlGenerator(object):
         li_list = []
         id_list = []
 
-        total_count = len([x for x in revision_objects if not x.hidden])
-
-        print "Total revisions:", total_count
+        # revision_objects may be an iterator (see
+        # Revision.iter_all_revisions_scheduled_before), so it's only
+        # traversed once, and revisions are counted along the way
+        total_count = 0
 
         for rev_obj in revision_objects:
             if rev_obj.hidden:
                 continue
 
+            total_count += 1
+
             lines = rev_obj.content.splitlines()
             spans_per_line = [[] for l in lines]
 
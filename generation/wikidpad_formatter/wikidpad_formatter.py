@@ -112,8 +112,8 @@ class WikidpadFormatter():
         return content
 
     def format(self, rev_obj):
-        str_line_nos = rev_obj.changelist.splitlines()
-        line_nos_with_changes = [int(lineno) for lineno in str_line_nos]
+        # a diffing.changelist.Changelist, constant-time membership tests
+        line_nos_with_changes = rev_obj.changelist
 
         orig_lines = rev_obj.content.splitlines()
         try:
@@ -162,6 +162,11 @@ on two lines
     """
 
 def test_format_basic():
+    import os, sys
+    this_files_path = os.path.split(os.path.abspath(__file__))[0]
+    sys.path.append(os.path.join(this_files_path, "..", ".."))
+    from diffing.changelist import Changelist
+
     class FakeConfig(object):
         def __init__(self):
             self.image_base_dir = '/foo/bar'
@@ -172,7 +177,7 @@ def test_format_basic():
             if changelist:
                 self.changelist = changelist
             else:
-                self.changelist = "\n".join([str(i) for i in range(len(self.content))])
+                self.changelist = Changelist([(0, len(self.content))])
 
     formatter = WikidpadFormatter(config=FakeConfig())
     
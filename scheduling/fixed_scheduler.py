@@ -18,6 +18,7 @@
 # If not, see <http://www.gnu.org/licenses/>.
 
 from datetime import date, datetime, timedelta
+from array import array
 import random
 
 DEFAULT_INTERVALS = [2,6,14,30,45,90,120,180,360,720,99999]
@@ -64,3 +65,24 @@ class FixedScheduler(object):
 
         return next_date
 
+    # Same as get_next_date, for many revisions at once (see
+    # core.revision_table.RevisionTable): takes a sequence of
+    # num_revisions_done and a date as a number of days since 1970-01-01,
+    # returns the next dates as an array of such day numbers.
+    def get_next_days(self, num_revisions_done, from_day):
+        assert len(self.random_plusminus) == len(self.intervals)
+
+        last_interval_idx = len(self.intervals)-1
+
+        next_days = array('l')
+        for num_revisions in num_revisions_done:
+            if num_revisions > last_interval_idx:
+                num_revisions = last_interval_idx
+
+            plusminus = random.randint(-self.random_plusminus[num_revisions],
+                            self.random_plusminus[num_revisions])
+
+            next_days.append(from_day + self.intervals[num_revisions] + \
+                                plusminus)
+
+        return next_days
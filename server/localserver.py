@@ -6,24 +6,65 @@
 # http://blog.doughellmann.com/2007/12/pymotw-basehttpserver.html
 
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
 import urlparse
 import json
+import datetime
 
 if __name__ == '__main__':
     # otw when running tests we can't import other modules
     this_files_path = os.path.split(os.path.abspath(__file__))[0]
     sys.path.append(os.path.join(this_files_path,".."))
 
-from core.storage import Storage, Revision
+from core.storage import Storage, Revision, get_formatted_date, \
+                get_formatted_datetime, DATE_FORMAT
+from core.store_lock import StoreLockTimeout
+from core import sql_stats
 
 SERVER_PORT = 3546
 
+# how long (in seconds) hiding a review waits for a command writing to the
+# store (e.g. 'diff' run from cron) before answering that the store is busy;
+# the page can just try again
+HIDE_REVIEW_LOCK_TIMEOUT = 10
+
+# reviews listed by /duereviews at a time, at most
+DUE_REVIEWS_PAGE_SIZE = 50
+MAX_DUE_REVIEWS_PAGE_SIZE = 500
+
+# Returns (days in advance, page size, 'after' due order key or None) from
+# the query of /duereviews (see LocalReviewServer.do_duereviews), or None if
+# it's invalid.
+def parse_due_reviews_query(query_string_dict):
+    try:
+        days_in_advance = int(query_string_dict.get('days', ['0'])[0])
+        limit = int(query_string_dict.get('limit',
+                                    [str(DUE_REVIEWS_PAGE_SIZE)])[0])
+        after = None
+        if 'after' in query_string_dict:
+            after_date, after_id = query_string_dict['after'][0].split(',')
+            after = (datetime.datetime.strptime(after_date,
+                                                DATE_FORMAT).date(),
+                     int(after_id))
+    except ValueError:
+        return None
+
+    if limit <= 0:
+        return None
+
+    return days_in_advance, min(limit, MAX_DUE_REVIEWS_PAGE_SIZE), after
+
 # see set_global_storage... this is an ugly hack but I couldn't figure out a
 # better way with BaseHTTPRequestHandler and HTTPServer
 # (well, I gave up after searching for half an hour, so if you've got time take
 # a shot)
 _GLOBAL_STORAGE = None
 
+# One thread per request, so a slow request doesn't hold the others. Storage
+# gives each thread its own db connection.
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
 # LOCAL is very important: this has NO SECURITY AT ALL so don't configure this
 # to accept connections from anything else than localhost!
 class LocalReviewServer(BaseHTTPRequestHandler):
@@ -50,6 +91,15 @@ class LocalReviewServer(BaseHTTPRequestHandler):
         elif path_without_qs in ("/dumpreview", "/dumpreview/"):
             self.do_dumpreview(query_string_dict)
 
+        elif path_without_qs in ("/duereviews", "/duereviews/"):
+            self.do_duereviews(query_string_dict)
+
+        elif path_without_qs in ("/cachestats", "/cachestats/"):
+            self.do_cachestats()
+
+        elif path_without_qs in ("/sqlstats", "/sqlstats/"):
+            self.do_sqlstats()
+
         elif path_without_qs in ("/debug", "/debug/"):
             self.do_debug()
 
@@ -63,7 +113,8 @@ class LocalReviewServer(BaseHTTPRequestHandler):
         global _GLOBAL_STORAGE
 
         review_id = int(query_string_dict['reviewid'][0])
-        review_obj = Revision.get_revision_from_id(_GLOBAL_STORAGE, review_id)
+        review_obj = Revision.get_revision_from_id(_GLOBAL_STORAGE, review_id,
+                                                   load_diff_content=True)
 
         self.send_response(200)
         self.end_headers()
@@ -74,9 +125,20 @@ class LocalReviewServer(BaseHTTPRequestHandler):
         global _GLOBAL_STORAGE
 
         review_id = int(query_string_dict['reviewid'][0])
-        review_obj = Revision.get_revision_from_id(_GLOBAL_STORAGE, review_id)
 
-        review_obj.set_hidden_state(True)
+        try:
+            with _GLOBAL_STORAGE.lock(timeout=HIDE_REVIEW_LOCK_TIMEOUT):
+                review_obj = Revision.get_revision_from_id(_GLOBAL_STORAGE,
+                                                           review_id)
+
+                review_obj.set_hidden_state(True)
+        except StoreLockTimeout:
+            self.send_response(503)
+            self.end_headers()
+            self.wfile.write(json.dumps({ 'operation': 'hidereview',
+                                          'review_id': review_id,
+                                          'result': 'busy' }))
+            return
 
         self.send_response(200)
         self.end_headers()
@@ -88,6 +150,69 @@ class LocalReviewServer(BaseHTTPRequestHandler):
         
         self.wfile.write(json.dumps(result_obj))
 
+    # A page of the reviews due (the most overdue first), e.g.
+    #     /duereviews/?days=2&limit=50
+    # then, for the next page, the 'next' value of the previous one:
+    #     /duereviews/?days=2&limit=50&after=2012-01-03,1234
+    # so a session only loads the reviews it gets to.
+    def do_duereviews(self, query_string_dict):
+        global _GLOBAL_STORAGE
+
+        parsed = parse_due_reviews_query(query_string_dict)
+        if parsed is None:
+            self.send_response(400)
+            self.end_headers()
+            return
+        days_in_advance, limit, after = parsed
+
+        the_date = datetime.date.today() + \
+                        datetime.timedelta(days=days_in_advance)
+        page = Revision.get_all_revisions_scheduled_before(_GLOBAL_STORAGE,
+                                    the_date, limit=limit, after=after)
+
+        next_page = None
+        if len(page) == limit:
+            scheduled_date, revision_id = page[-1].get_due_order_key()
+            next_page = "%s,%d" % (get_formatted_date(scheduled_date),
+                                   revision_id)
+
+        self.send_response(200)
+        self.end_headers()
+
+        result_obj = { 'operation': 'duereviews',
+                       'reviews': [{ 'review_id': rev.id,
+                                     'review_path': rev.document_relative_path,
+                                     'datetime_diffed_on': \
+                                get_formatted_datetime(rev.datetime_diffed_on),
+                                     'scheduled_date': \
+                                get_formatted_date(rev.scheduled_date) } \
+                                        for rev in page],
+                       'next': next_page }
+
+        self.wfile.write(json.dumps(result_obj))
+
+    # hits and misses of the payload cache, to size payload_cache_bytes
+    def do_cachestats(self):
+        global _GLOBAL_STORAGE
+
+        self.send_response(200)
+        self.end_headers()
+
+        self.wfile.write(json.dumps(_GLOBAL_STORAGE.payload_cache.get_stats()))
+
+    # the SQL statements run by the server, when started with --sql-stats
+    # (see core.sql_stats)
+    def do_sqlstats(self):
+        self.send_response(200)
+        self.end_headers()
+
+        self.wfile.write(json.dumps({ 'enabled': sql_stats.STATS.enabled,
+                'statements': [{ 'statement': statement,
+                                 'count': count,
+                                 'seconds': seconds } \
+                        for statement, count, seconds \
+                            in sql_stats.STATS.get_stats()] }))
+
     def do_debug(self):
         parsed_path = urlparse.urlparse(self.path)
 